@@ -0,0 +1,69 @@
+from collections import Counter
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db.models import Case, Count, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce
+
+from accounts.models import FriendShip, user_cache
+from tweet import shards
+from tweet.models import Tweet
+
+User = get_user_model()
+
+
+def count_of(model, field):
+    return Coalesce(
+        Subquery(
+            model.objects.filter(**{field: OuterRef("pk")})
+            .order_by()
+            .values(field)
+            .annotate(count=Count("pk"))
+            .values("count")
+        ),
+        0,
+    )
+
+
+def tweet_counts(pks):
+    counts = Counter()
+    for db in shards.aliases():
+        counts.update(
+            dict(
+                Tweet.objects.using(db)
+                .filter(user__in=pks)
+                .order_by()
+                .values_list("user")
+                .annotate(count=Count("pk"))
+            )
+        )
+    return Case(*[When(pk=pk, then=Value(counts[pk])) for pk in pks], default=Value(0))
+
+
+class Command(BaseCommand):
+    help = "MyUser のフォロワー数・フォロー数・ツイート数を実データから再計算する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+
+    def handle(self, *args, chunk_size, **options):
+        total = 0
+        last_pk = 0
+        while True:
+            pks = list(User.objects.filter(pk__gt=last_pk).order_by("pk").values_list("pk", flat=True)[:chunk_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
+            # 1 チャンクを 1 つの UPDATE で再計算するので、途中のフォローやツイートも取りこぼさない
+            counts = {
+                "followers_count": count_of(FriendShip, "follower"),
+                "followees_count": count_of(FriendShip, "followee"),
+            }
+            if shards.is_sharded():
+                # ツイートは別のデータベースにあって副問い合わせにできないので、シャードごとに数えて足す
+                counts["tweets_count"] = tweet_counts(pks)
+            else:
+                counts["tweets_count"] = count_of(Tweet, "user")
+            total += User.objects.filter(pk__in=pks).update(**counts)
+            user_cache.invalidate(*pks)
+        self.stdout.write(f"recomputed counts for {total} users")
@@ -0,0 +1,56 @@
+# Generated by Django 4.0.2 on 2026-10-18 16:48
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_of(model, field):
+    return Coalesce(
+        Subquery(
+            model.objects.filter(**{field: OuterRef('pk')})
+            .order_by()
+            .values(field)
+            .annotate(count=Count('pk'))
+            .values('count')
+        ),
+        0,
+    )
+
+
+def populate_counts(apps, schema_editor):
+    MyUser = apps.get_model('accounts', 'MyUser')
+    FriendShip = apps.get_model('accounts', 'FriendShip')
+    Tweet = apps.get_model('tweet', 'Tweet')
+    MyUser.objects.update(
+        followers_count=count_of(FriendShip, 'follower'),
+        followees_count=count_of(FriendShip, 'followee'),
+        tweets_count=count_of(Tweet, 'user'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_myuser_followees_myuser_followers'),
+        ('tweet', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='myuser',
+            name='followees_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='フォロー数'),
+        ),
+        migrations.AddField(
+            model_name='myuser',
+            name='followers_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='フォロワー数'),
+        ),
+        migrations.AddField(
+            model_name='myuser',
+            name='tweets_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='ツイート数'),
+        ),
+        migrations.RunPython(populate_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.0.2 on 2026-10-18 16:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0004_myuser_counts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='friendship',
+            index=models.Index(fields=['followee', '-id'], name='friendship_followee_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='friendship',
+            index=models.Index(fields=['follower', '-id'], name='friendship_follower_id_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.0.2 on 2026-10-18 16:52
+
+from django.db import migrations, models
+import django.db.models.expressions
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0005_friendship_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(django.db.models.functions.text.Lower('username'), django.db.models.expressions.F('id'), name='myuser_username_lower_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(django.db.models.functions.text.Lower('nickname'), django.db.models.expressions.F('id'), name='myuser_nickname_lower_idx'),
+        ),
+    ]
@@ -4,7 +4,11 @@ from django.contrib.auth.models import (
     PermissionsMixin,
 )
 from django.core.validators import MinLengthValidator, RegexValidator
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest, Lower
+
+from base.objectcache import ObjectCache
 
 
 class MyUserManager(BaseUserManager):
@@ -34,6 +38,13 @@ class MyUserManager(BaseUserManager):
         user.save(using=self._db)
         return user
 
+    def adjust_counts(self, pk, **deltas):
+        # 例: adjust_counts(user.pk, followers_count=1)
+        self.filter(pk=pk).update(
+            **{field: Greatest(F(field) + delta, 0) for field, delta in deltas.items()}
+        )
+        user_cache.invalidate(pk)
+
 
 class MyUser(AbstractBaseUser, PermissionsMixin):
 
@@ -61,6 +72,11 @@ class MyUser(AbstractBaseUser, PermissionsMixin):
     is_staff = models.BooleanField(default=False)
     is_admin = models.BooleanField(default=False)
 
+    # FriendShip / Tweet の件数を非正規化して持つ（recompute_user_counts で再計算できる）
+    followers_count = models.PositiveIntegerField(verbose_name="フォロワー数", default=0)
+    followees_count = models.PositiveIntegerField(verbose_name="フォロー数", default=0)
+    tweets_count = models.PositiveIntegerField(verbose_name="ツイート数", default=0)
+
     followees = models.ManyToManyField(
         'MyUser', verbose_name='フォロー中のユーザー', through='FriendShip',
         related_name='+', through_fields=('follower', 'followee')
@@ -76,10 +92,40 @@ class MyUser(AbstractBaseUser, PermissionsMixin):
     # ユーザーを作成するときにプロンプ​​トに表示されるフィールド名のリストです。
     REQUIRED_FIELDS = ["username"]
 
+    class Meta:
+        indexes = [
+            # ユーザー一覧の並び順と、大文字小文字を区別しない前方一致検索に使う
+            models.Index(Lower("username"), F("id"), name="myuser_username_lower_idx"),
+            models.Index(Lower("nickname"), F("id"), name="myuser_nickname_lower_idx"),
+        ]
+
     def __str__(self):
         return self.username
 
 
+# プロフィールなどで username / email から引くユーザーのキャッシュ
+# パスワードのハッシュは共有のキャッシュ（ファイルキャッシュならディスク）に載せない
+user_cache = ObjectCache(MyUser, lookups=("username", "email"), exclude=("password",))
+
+
+class FriendShipManager(models.Manager):
+    def follow(self, followee, follower):
+        with transaction.atomic():
+            _, created = self.get_or_create(followee=followee, follower=follower)
+            if created:
+                MyUser.objects.adjust_counts(followee.pk, followees_count=1)
+                MyUser.objects.adjust_counts(follower.pk, followers_count=1)
+        return created
+
+    def unfollow(self, followee, follower):
+        with transaction.atomic():
+            deleted, _ = self.filter(followee=followee, follower=follower).delete()
+            if deleted:
+                MyUser.objects.adjust_counts(followee.pk, followees_count=-1)
+                MyUser.objects.adjust_counts(follower.pk, followers_count=-1)
+        return bool(deleted)
+
+
 class FriendShip(models.Model):
     followee = models.ForeignKey(
         MyUser, related_name="followee", on_delete=models.CASCADE
@@ -88,9 +134,15 @@ class FriendShip(models.Model):
         MyUser, related_name="follower", on_delete=models.CASCADE
     )
 
+    objects = FriendShipManager()
+
     class Meta:
         constraints = [
             models.UniqueConstraint(
                 fields=["followee", "follower"], name="follow_unique"
             ),
         ]
+        indexes = [
+            models.Index(fields=["followee", "-id"], name="friendship_followee_id_idx"),
+            models.Index(fields=["follower", "-id"], name="friendship_follower_id_idx"),
+        ]
@@ -1,11 +1,21 @@
+from io import StringIO
+from unittest import mock
+
 from django.contrib.auth import SESSION_KEY, get_user_model
 from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
+from base.asyncviews import async_views
+from tweet.models import LikeForTweet, Tweet
 from ttter import settings
 
-from .models import FriendShip
+from .models import FriendShip, user_cache
+from .views import UserListView
 
 User = get_user_model()
 
@@ -266,6 +276,112 @@ class TestUserProfilesView(TestCase):
         self.assertEqual(response.context["followee_count"], self.user.followee.count())
         self.assertEqual(response.context["follower_count"], self.user.follower.count())
 
+    def test_counts_follow_and_tweet(self):
+        other = User.objects.create_user(username="otheruser", email="other@co.jp")
+        self.client.post(reverse("accounts:follow", kwargs={"username": other.username}))
+        self.client.post(reverse("tweet:tweet_create"), {"content": "数える"})
+        response = self.client.get(
+            reverse("accounts:user_page", kwargs={"username": self.user.username})
+        )
+        self.assertEqual(response.context["followee_count"], 1)
+        self.assertEqual(response.context["follower_count"], 0)
+        self.assertEqual(response.context["user"].tweets_count, 1)
+        other.refresh_from_db()
+        self.assertEqual(other.followers_count, 1)
+
+        self.client.post(reverse("accounts:unfollow", kwargs={"username": other.username}))
+        self.client.post(
+            reverse("tweet:tweet_delete", kwargs={"pk": Tweet.objects.get(content="数える").pk})
+        )
+        self.user.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(self.user.followees_count, 0)
+        self.assertEqual(self.user.tweets_count, 0)
+        self.assertEqual(other.followers_count, 0)
+
+    def test_recompute_user_counts(self):
+        other = User.objects.create_user(username="otheruser", email="other@co.jp")
+        FriendShip.objects.create(followee=self.user, follower=other)
+        Tweet.objects.create(user=self.user, content="数える")
+        User.objects.filter(pk=other.pk).update(followers_count=10)
+
+        call_command("recompute_user_counts", chunk_size=1, stdout=StringIO())
+
+        self.user.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(
+            (self.user.followees_count, self.user.followers_count, self.user.tweets_count), (1, 0, 1)
+        )
+        self.assertEqual((other.followees_count, other.followers_count, other.tweets_count), (0, 1, 0))
+
+    def test_success_get_paginated_tweets(self):
+        Tweet.objects.bulk_create(
+            [Tweet(user=self.user, content=f"tweet{i}") for i in range(3)]
+        )
+        url = reverse("accounts:user_page", kwargs={"username": self.user.username})
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(url)
+        Tweet.objects.bulk_create(
+            [Tweet(user=self.user, content=f"tweet{i}") for i in range(3, 30)]
+        )
+        with self.assertNumQueries(len(small)):
+            response = self.client.get(url)
+        self.assertEqual(
+            list(response.context["post_item"]),
+            list(Tweet.objects.filter(user=self.user).order_by("-created_at", "-id")[:20]),
+        )
+        response_next = self.client.get(url, {"cursor": response.context["page_obj"].next_cursor})
+        self.assertEqual(len(response_next.context["post_item"]), 10)
+
+    def test_success_get_like_state(self):
+        liked = Tweet.objects.create(user=self.user, content="いいね済み")
+        Tweet.objects.create(user=self.user, content="未いいね")
+        LikeForTweet.objects.create(user=self.user, tweet=liked)
+        response = self.client.get(
+            reverse("accounts:user_page", kwargs={"username": self.user.username})
+        )
+        for tweet in response.context["post_item"]:
+            self.assertEqual(tweet.is_liked, tweet.pk == liked.pk)
+
+
+class TestUserPageAsync(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.enterContext(async_views(True))
+        self.user = User.objects.create_user(username="asyncuser", email="async@co.jp")
+        self.other = User.objects.create_user(username="otheruser", email="other@co.jp")
+        self.async_client.force_login(self.user)
+        FriendShip.objects.follow(followee=self.user, follower=self.other)
+        Tweet.objects.bulk_create([Tweet(user=self.other, content=f"tweet{i}") for i in range(25)])
+        User.objects.adjust_counts(self.other.pk, tweets_count=25)
+
+    async def test_other_user_page(self):
+        response = await self.async_client.get(
+            reverse("accounts:user_page", kwargs={"username": self.other.username})
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context["is_followed"])
+        self.assertEqual(response.context["follower_count"], 1)
+        self.assertEqual(len(response.context["post_item"]), 20)
+        self.assertContains(response, "tweet  25")
+
+        response = await self.async_client.get(
+            reverse("accounts:user_page", kwargs={"username": self.other.username}),
+            {"cursor": response.context["page_obj"].next_cursor},
+        )
+        self.assertEqual(len(response.context["post_item"]), 5)
+
+    async def test_own_page(self):
+        response = await self.async_client.get(
+            reverse("accounts:user_page", kwargs={"username": self.user.username})
+        )
+        self.assertNotIn("is_followed", response.context)
+        self.assertEqual(response.context["followee_count"], 1)
+
+    async def test_not_exist_user(self):
+        response = await self.async_client.get(reverse("accounts:user_page", kwargs={"username": "nobody"}))
+        self.assertEqual(response.status_code, 404)
+
 
 class TestFollowView(TestCase):
     def setUp(self):
@@ -550,3 +666,140 @@ class TestFollowerListView(TestCase):
                 )
             ],
         )
+
+
+class TestFriendShipListPagination(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", email="test@co.jp")
+        self.client.force_login(self.user)
+        self.users = User.objects.bulk_create(
+            [User(username=f"user{i:03}", email=f"user{i}@co.jp") for i in range(55)]
+        )
+        # 全員が testuser をフォローし、testuser は最初の 1 人だけフォローし返している
+        FriendShip.objects.bulk_create(
+            [FriendShip(followee=user, follower=self.user) for user in self.users]
+        )
+        FriendShip.objects.create(followee=self.user, follower=self.users[0])
+
+    def test_success_get_follower_list(self):
+        url = reverse("accounts:follower_list", kwargs={"username": self.user.username})
+        response = self.client.get(url)
+        followers = response.context["followers"]
+        self.assertEqual(followers, list(reversed(self.users))[:50])
+        self.assertFalse(any(follower.is_following for follower in followers))
+
+        response_next = self.client.get(url, {"cursor": response.context["page_obj"].next_cursor})
+        followers_next = response_next.context["followers"]
+        self.assertEqual(followers_next, list(reversed(self.users))[50:])
+        self.assertTrue(followers_next[-1].is_following)
+        self.assertFalse(response_next.context["page_obj"].has_next())
+
+    def test_query_count_does_not_depend_on_page_size(self):
+        url = reverse("accounts:follower_list", kwargs={"username": self.user.username})
+        with CaptureQueriesContext(connection) as first_queries:
+            response = self.client.get(url)
+        with self.assertNumQueries(len(first_queries)):
+            self.client.get(url, {"cursor": response.context["page_obj"].next_cursor})
+
+
+class TestUserListView(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="viewer", email="viewer@co.jp")
+        self.client.force_login(self.user)
+        User.objects.bulk_create(
+            [
+                User(username="Yukiy", nickname="ゆき", email="yukiy@co.jp"),
+                User(username="yukko", nickname="ユッコ", email="yukko@co.jp"),
+                User(username="taro1", nickname="yukichi", email="taro1@co.jp"),
+                User(username="hanako", nickname="はな", email="hanako@co.jp"),
+            ]
+        )
+
+    def usernames(self, response):
+        return [user.username for user in response.context["object_list"]]
+
+    def test_success_get(self):
+        response = self.client.get(reverse("accounts:userlist"))
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, "accounts/user_list.html")
+        self.assertEqual(self.usernames(response), ["hanako", "taro1", "Yukiy", "yukko"])
+
+    def test_success_get_with_prefix_search(self):
+        response = self.client.get(reverse("accounts:userlist"), {"q": "yuk"})
+        # ユーザー名の一致を先に、ニックネームの一致を後に並べる
+        self.assertEqual(self.usernames(response), ["Yukiy", "yukko", "taro1"])
+        response_viewer = self.client.get(reverse("accounts:userlist"), {"q": "view"})
+        self.assertEqual(self.usernames(response_viewer), [])
+
+    @mock.patch.object(UserListView, "paginate_by", 2)
+    def test_paginate_across_username_and_nickname_matches(self):
+        url = reverse("accounts:userlist")
+        seen = []
+        params = {"q": "yuk"}
+        while True:
+            response = self.client.get(url, params)
+            seen += self.usernames(response)
+            page = response.context["page_obj"]
+            if not page.has_next():
+                break
+            params["cursor"] = page.next_cursor
+        response_previous = self.client.get(url, {"q": "yuk", "cursor": page.previous_cursor})
+        self.assertEqual(seen, ["Yukiy", "yukko", "taro1"])
+        self.assertEqual(self.usernames(response_previous), ["Yukiy", "yukko"])
+
+    def test_success_get_suggest(self):
+        response = self.client.get(reverse("accounts:user_suggest"), {"q": "YUKK"})
+        self.assertEqual(response.json(), {"users": [{"username": "yukko", "nickname": "ユッコ"}]})
+
+
+class TestUserObjectCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="cacheuser", email="cache@co.jp")
+        self.client.force_login(self.user)
+        self.url = reverse("accounts:user_page", kwargs={"username": self.user.username})
+
+    def test_lookup_by_username_and_email_hits_cache(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(user_cache.get(username="cacheuser"), self.user)
+            self.assertEqual(user_cache.get(email="cache@co.jp"), self.user)
+            self.assertEqual(user_cache.get(pk=self.user.pk), self.user)
+
+    def test_miss_is_cached(self):
+        stats = user_cache.stats()
+        with self.assertNumQueries(1):
+            self.assertIsNone(user_cache.get(username="nobody"))
+            self.assertIsNone(user_cache.get(username="nobody"))
+        self.assertEqual(user_cache.stats()["misses"], stats.get("misses", 0) + 1)
+        self.assertEqual(user_cache.stats()["hits"], stats.get("hits", 0) + 1)
+
+        User.objects.create_user(username="nobody", email="nobody@co.jp")
+        self.assertEqual(user_cache.get(username="nobody").email, "nobody@co.jp")
+
+    def test_renamed_user_is_not_found_by_old_username(self):
+        self.user.username = "renamed"
+        self.user.save()
+        self.assertIsNone(user_cache.get(username="cacheuser"))
+        self.assertEqual(user_cache.get(username="renamed"), self.user)
+
+    def test_counts_are_invalidated(self):
+        other = User.objects.create_user(username="otheruser", email="other@co.jp")
+        self.client.get(self.url)
+        self.client.post(reverse("accounts:follow", kwargs={"username": other.username}))
+        response = self.client.get(self.url)
+        self.assertEqual(response.context["followee_count"], 1)
+
+    def test_password_is_not_cached(self):
+        self.user.set_password("cachepass")
+        self.user.save()
+        with self.assertNumQueries(0):
+            user = user_cache.get(username="cacheuser")
+        self.assertNotIn(self.user.password, cache.get(user_cache.pk_key(self.user.pk)))
+        self.assertEqual(user.get_deferred_fields(), {"password"})
+        with self.assertNumQueries(1):
+            self.assertTrue(user.check_password("cachepass"))
+
+    def test_deleted_user_is_not_found(self):
+        self.client.get(self.url)
+        self.user.delete()
+        self.assertIsNone(user_cache.get(username="cacheuser"))
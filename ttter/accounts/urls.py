@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.contrib.auth import views as auth_views
 from django.urls import path
 
@@ -5,6 +6,8 @@ from . import views
 
 app_name = "accounts"
 
+user_page_view = views.user_page_async if settings.ASYNC_VIEWS else views.UserPage.as_view()
+
 urlpatterns = [
     path("user_data_input/", views.UserDataInput.as_view(), name="user_data_input"),
     path(
@@ -17,7 +20,7 @@ urlpatterns = [
         name="login",
     ),
     path("logout/", auth_views.LogoutView.as_view(), name="logout"),
-    path("<str:username>/user_page/", views.UserPage.as_view(), name="user_page"),
+    path("<str:username>/user_page/", user_page_view, name="user_page"),
     path(
         "<str:username>/following_list/",
         views.FollowingListView.as_view(),
@@ -30,5 +33,6 @@ urlpatterns = [
     ),
     path("<str:username>/follow/", views.FollowView.as_view(), name="follow"),
     path("userlist/", views.UserListView.as_view(), name="userlist"),
+    path("userlist/suggest/", views.UserSuggestView.as_view(), name="user_suggest"),
     path("<str:username>/unfollow/", views.UnFollowView.as_view(), name="unfollow"),
 ]
@@ -1,13 +1,23 @@
+from asgiref.sync import sync_to_async
 from django.contrib import messages
 from django.contrib.auth import get_user_model, login
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.shortcuts import get_object_or_404, redirect, render
+from django.db.models import Exists, OuterRef, Q
+from django.db.models.functions import Lower
+from django.http import JsonResponse
+from django.shortcuts import redirect, render
 from django.urls import reverse_lazy
-from django.views.generic import CreateView, FormView, ListView, TemplateView
+from django.views.generic import CreateView, FormView, ListView, TemplateView, View
+
+from base.asyncviews import async_login_required, async_require_http_methods, gather_queries
+from base.pagination import ChainedKeysetPaginator, KeysetPaginationMixin, KeysetPaginator, pagination_query
+from base.routers import ReplicaReadMixin, use_replica_for
+from tweet import timeline
+from tweet.loaders import prepare_tweets
 from tweet.models import Tweet
 
 from .forms import SignUpFrom
-from .models import FriendShip
+from .models import FriendShip, user_cache
 
 # Create your views here.
 User = get_user_model()
@@ -45,48 +55,176 @@ class UserDataCreate(CreateView):
         return render(self.request, "accounts/create.html", {"form": form})
 
 
-class UserListView(LoginRequiredMixin, ListView):
+# 前方一致の範囲検索 (q <= x < q + PREFIX_UPPER_BOUND) の上限に使う
+PREFIX_UPPER_BOUND = "\U0010ffff"
+
+
+def user_directory_paginator(viewer, query, per_page):
+    """ユーザー名の小文字順のディレクトリ。q があればユーザー名、ニックネームの順に前方一致させる。
+
+    どちらも LOWER() の式インデックスを範囲で読むだけなので、1 ページのコストは件数に依存しない。
+    """
+    users = (
+        User.objects.exclude(pk=viewer.pk)
+        .annotate(username_lower=Lower("username"))
+        .only("id", "username", "nickname")
+    )
+    if not query:
+        return KeysetPaginator(users, ("username_lower", "id"), per_page)
+    query = query.lower()
+    username_match = Q(username_lower__gte=query, username_lower__lt=query + PREFIX_UPPER_BOUND)
+    nickname_users = users.annotate(nickname_lower=Lower("nickname")).filter(
+        nickname_lower__gte=query, nickname_lower__lt=query + PREFIX_UPPER_BOUND
+    )
+    return ChainedKeysetPaginator(
+        [
+            KeysetPaginator(users.filter(username_match), ("username_lower", "id"), per_page),
+            KeysetPaginator(nickname_users.exclude(username_match), ("nickname_lower", "id"), per_page),
+        ],
+        per_page,
+    )
+
+
+class UserListView(LoginRequiredMixin, ReplicaReadMixin, KeysetPaginationMixin, ListView):
     template_name = "accounts/user_list.html"
     model = User
-    queryset = User.objects.values_list("username", flat=True)
+    paginate_by = 50
+
+    def get_queryset(self):
+        return User.objects.none()
+
+    def get_keyset_paginator(self, queryset, page_size):
+        return user_directory_paginator(self.request.user, self.request.GET.get("q", "").strip(), page_size)
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["query"] = self.request.GET.get("q", "")
+        return context
 
-class UserPage(LoginRequiredMixin, TemplateView):
+
+class UserSuggestView(LoginRequiredMixin, ReplicaReadMixin, View):
+    # 入力補完用に、上位数件だけを JSON で返す
+    limit = 10
+
+    def get(self, request, *args, **kwargs):
+        query = request.GET.get("q", "").strip()
+        users = []
+        if query:
+            users = user_directory_paginator(request.user, query, self.limit).page().object_list
+        return JsonResponse(
+            {"users": [{"username": user.username, "nickname": user.nickname} for user in users]}
+        )
+
+
+class UserPage(LoginRequiredMixin, ReplicaReadMixin, KeysetPaginationMixin, TemplateView):
     template_name = "accounts/user_page.html"
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         request_user = self.request.user
-        user = get_object_or_404(User, username=self.kwargs.get("username"))
+        user = user_cache.get_or_404(username=self.kwargs.get("username"))
         if request_user != user:
             context["is_followed"] = FriendShip.objects.filter(
                 followee=request_user, follower=user
             ).exists()
         context["user"] = user
-        context["post_item"] = user.tweet_set.all()
-        context["followee_count"] = user.followee.count()
-        context["follower_count"] = user.follower.count()
+        tweets = Tweet.objects.posted_by(user)
+        _, page, post_item, _ = self.paginate_queryset(tweets, self.paginate_by)
+        context["page_obj"] = page
+        context["post_item"] = prepare_tweets(post_item, request_user)
+        context["followee_count"] = user.followees_count
+        context["follower_count"] = user.followers_count
         return context
 
 
-class FollowerListView(LoginRequiredMixin, TemplateView):
-    template_name = "accounts/follower_list.html"
+@async_login_required
+@async_require_http_methods(["GET", "HEAD"])
+async def user_page_async(request, username):
+    """UserPage の async 版（settings.ASYNC_VIEWS のとき urls.py が割り当てる）。
+
+    ユーザーを引いた後、フォロー状態の確認とツイートのページ（といいね状態）を別々の接続で同時に読む。
+    フォロー数・フォロワー数はユーザーの行に非正規化してあるので、追加のクエリはいらない。
+    """
+    use_replica_for(request)
+    view = UserPage()
+    view.setup(request, username=username)
+    request_user = request.user
+    user = await sync_to_async(user_cache.get_or_404)(username=username)
+    paginator = view.get_keyset_paginator(Tweet.objects.posted_by(user), view.paginate_by)
+
+    def load_tweets():
+        page = view.get_cursor_page(paginator)
+        return page, prepare_tweets(page.object_list, request_user)
+
+    def is_followed():
+        return FriendShip.objects.filter(followee=request_user, follower=user).exists()
+
+    queries = [load_tweets]
+    if request_user != user:
+        queries.append(is_followed)
+    (page, post_item), *followed = await gather_queries(*queries)
+    context = {
+        "user": user,
+        "page_obj": page,
+        "post_item": post_item,
+        "followee_count": user.followees_count,
+        "follower_count": user.followers_count,
+    }
+    if followed:
+        context["is_followed"] = followed[0]
+    context["pagination_query"] = pagination_query(request, view.cursor_kwarg)
+    return await sync_to_async(render)(request, view.template_name, context)
+
+
+class FriendShipListMixin(LoginRequiredMixin, ReplicaReadMixin, KeysetPaginationMixin):
+    paginate_by = 50
+    # 新しくフォローされた順
+    cursor_ordering = ("-id",)
+    # 対象ユーザーで絞り込む FriendShip のフィールドと、一覧に表示する側のフィールド
+    filter_field = None
+    user_field = None
+    context_object_name = None
+
+    def get_keyset_paginator(self, queryset, page_size):
+        return KeysetPaginator(queryset, self.cursor_ordering, page_size, transform=self.to_user)
+
+    def to_user(self, friendship):
+        user = getattr(friendship, self.user_field)
+        user.is_following = friendship.is_following
+        return user
 
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
-        user = get_object_or_404(User, username=self.kwargs["username"])
-        ctx["followers"] = user.followees.all()
+        user = user_cache.get_or_404(username=self.kwargs["username"])
+        friendships = (
+            FriendShip.objects.filter(**{self.filter_field: user})
+            .select_related(self.user_field)
+            .only("id", self.user_field, f"{self.user_field}__username", f"{self.user_field}__nickname")
+            .annotate(
+                # 閲覧ユーザーが一覧の各ユーザーをフォローしているか
+                is_following=Exists(
+                    FriendShip.objects.filter(followee=self.request.user, follower=OuterRef(self.user_field))
+                )
+            )
+        )
+        _, page, users, _ = self.paginate_queryset(friendships, self.paginate_by)
+        ctx["page_obj"] = page
+        ctx[self.context_object_name] = users
         return ctx
 
 
-class FollowingListView(LoginRequiredMixin, TemplateView):
-    template_name = "accounts/following_list.html"
+class FollowerListView(FriendShipListMixin, TemplateView):
+    template_name = "accounts/follower_list.html"
+    filter_field = "follower"
+    user_field = "followee"
+    context_object_name = "followers"
 
-    def get_context_data(self, **kwargs):
-        ctx = super().get_context_data(**kwargs)
-        user = get_object_or_404(User, username=self.kwargs["username"])
-        ctx["followings"] = user.followers.all()
-        return ctx
+
+class FollowingListView(FriendShipListMixin, TemplateView):
+    template_name = "accounts/following_list.html"
+    filter_field = "followee"
+    user_field = "follower"
+    context_object_name = "followings"
 
 
 class FollowView(LoginRequiredMixin, TemplateView):
@@ -94,24 +232,23 @@ class FollowView(LoginRequiredMixin, TemplateView):
 
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
-        ctx["follower"] = get_object_or_404(User, username=self.kwargs["username"])
+        ctx["follower"] = user_cache.get_or_404(username=self.kwargs["username"])
         return ctx
 
     def post(self, *args, **kwargs):
-        follower = get_object_or_404(User, username=self.kwargs["username"])
-        followee = get_object_or_404(User, id=self.request.user.id)
+        follower = user_cache.get_or_404(username=self.kwargs["username"])
+        followee = user_cache.get_or_404(pk=self.request.user.id)
         if followee == follower:
             messages.warning(self.request, "自分自身はフォローできません。")
             return render(self.request, "accounts/follow.html", {"follower": follower})
         else:
-            _, created = FriendShip.objects.get_or_create(
-                followee=followee, follower=follower
-            )
+            created = FriendShip.objects.follow(followee=followee, follower=follower)
             if not created:
                 messages.warning(self.request, f"{follower.username}さんはすでにフォローしています。")
                 return render(
                     self.request, "accounts/follow.html", {"follower": follower}
                 )
+            timeline.backfill(owner=followee, author=follower)
         return redirect("tweet:home")
 
 
@@ -120,19 +257,19 @@ class UnFollowView(LoginRequiredMixin, TemplateView):
 
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
-        ctx["follower"] = get_object_or_404(User, username=self.kwargs["username"])
+        ctx["follower"] = user_cache.get_or_404(username=self.kwargs["username"])
         return ctx
 
     def post(self, *args, **kwargs):
-        follower = get_object_or_404(User, username=self.kwargs["username"])
-        followee = get_object_or_404(User, id=self.request.user.id)
+        follower = user_cache.get_or_404(username=self.kwargs["username"])
+        followee = user_cache.get_or_404(pk=self.request.user.id)
         if followee == follower:
             messages.warning(self.request, "自分自身のフォロー解除はできません。")
             return render(
                 self.request, "accounts/unfollow.html", {"follower": follower}
             )
-        if FriendShip.objects.filter(followee=followee, follower=follower).exists():
-            FriendShip.objects.filter(followee=followee, follower=follower).delete()
+        if FriendShip.objects.unfollow(followee=followee, follower=follower):
+            timeline.remove_author(owner=followee, author=follower)
         else:
             messages.warning(self.request, f"{follower.username}さんはフォローしていません。")
             return render(
@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class BaseConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'base'
+
+    def ready(self):
+        from .db import apply_sqlite_pragmas
+        from .queries import install_query_timer
+        from .slowqueries import install_slow_query_log
+
+        connection_created.connect(apply_sqlite_pragmas, dispatch_uid="base.apply_sqlite_pragmas")
+        connection_created.connect(install_slow_query_log, dispatch_uid="base.install_slow_query_log")
+        connection_created.connect(install_query_timer, dispatch_uid="base.install_query_timer")
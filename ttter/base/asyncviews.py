@@ -0,0 +1,109 @@
+"""ASGI で動かす async ビューの補助。
+
+Django 4.0 の ORM には async API (aget() など、4.1 以降) がないので、クエリは sync_to_async でスレッドに渡して実行する。
+settings.ASYNC_VIEWS で、URL に同期ビューと async ビューのどちらを割り当てるかを切り替える。
+"""
+import asyncio
+import importlib
+from contextlib import contextmanager
+from functools import partial, wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.views import redirect_to_login
+from django.db import close_old_connections, connections
+from django.http import Http404, HttpResponseNotAllowed
+from django.test.utils import override_settings
+from django.urls import clear_url_caches
+
+from .pagination import InvalidCursor, MergedKeysetPaginator
+
+
+def async_login_required(view):
+    """LoginRequiredMixin の async ビュー版。
+
+    request.user の読み込み（セッションとユーザーの検索）もスレッドで行い、以降はイベントループから参照できるようにする。
+    """
+
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if not await sync_to_async(lambda: request.user.is_authenticated)():
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+
+    return wrapper
+
+
+def async_require_http_methods(methods):
+    """require_http_methods の async ビュー版（Django 4.0 のデコレーターは async ビューを包めない）。"""
+
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return HttpResponseNotAllowed(methods)
+            return await view(request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def in_atomic_block():
+    return any(conn.in_atomic_block for conn in connections.all())
+
+
+def run_in_own_connection(func):
+    # Django がリクエストの前後で行うのと同じく、スレッドの接続を CONN_MAX_AGE に従って閉じる
+    close_old_connections()
+    try:
+        return func()
+    finally:
+        close_old_connections()
+
+
+async def gather_queries(*funcs):
+    """引数なしの関数をそれぞれ別のスレッド（別の DB 接続）で同時に実行し、結果をリストで返す。
+
+    トランザクションの中（TestCase や ATOMIC_REQUESTS）では、コミット前の行が他の接続から見えないので、
+    リクエストのスレッドで順番に実行する。
+    """
+    if not settings.ASYNC_CONCURRENT_QUERIES or await sync_to_async(in_atomic_block)():
+        return [await sync_to_async(func)() for func in funcs]
+    return await asyncio.gather(
+        *(sync_to_async(run_in_own_connection, thread_sensitive=False)(func) for func in funcs)
+    )
+
+
+async def get_cursor_page(paginator, token):
+    """KeysetPaginationMixin.get_cursor_page の async 版。
+
+    MergedKeysetPaginator（シャードごとのタイムラインなど）は、各ソースを gather_queries で同時に読んでマージする。
+    """
+    try:
+        if not isinstance(paginator, MergedKeysetPaginator):
+            return await sync_to_async(paginator.page)(token)
+        values, reverse = paginator.decode(token) if token else (None, False)
+        streams = await gather_queries(
+            *(partial(paginator.fetch_stream, source, values, reverse) for source in paginator.paginators)
+        )
+        return paginator.merge(streams, values, reverse)
+    except InvalidCursor as e:
+        raise Http404(str(e))
+
+
+@contextmanager
+def async_views(enabled):
+    """ASYNC_VIEWS を切り替えて URLconf を読み込み直す（ベンチマークやテスト用）。"""
+
+    def reload_urlconf():
+        for name in ("tweet.urls", "accounts.urls", settings.ROOT_URLCONF):
+            importlib.reload(importlib.import_module(name))
+        clear_url_caches()
+
+    try:
+        with override_settings(ASYNC_VIEWS=enabled):
+            reload_urlconf()
+            yield
+    finally:
+        reload_urlconf()
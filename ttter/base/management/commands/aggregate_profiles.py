@@ -0,0 +1,52 @@
+import io
+import pstats
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.backends.utils import CursorWrapper
+from django.db.models.sql.compiler import SQLCompiler
+from django.template.base import Template
+
+from base import profiling
+
+# 時間の内訳として出す関数。テンプレートから発行されたクエリは、テンプレートと ORM の両方に含まれる
+BREAKDOWN = [
+    ("template rendering", Template.render),
+    ("ORM (execute_sql)", SQLCompiler.execute_sql),
+    ("SQL (cursor execute)", CursorWrapper._execute_with_wrappers),
+]
+
+
+def stats_key(func):
+    code = func.__code__
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+class Command(BaseCommand):
+    help = (
+        "ProfilerMiddleware が書いた .prof をまとめ、テンプレートの描画・ORM・SQL にかかった時間の割合と、"
+        "累積時間の長い関数を出す"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="*", help="省略時は PROFILE_DIR の .prof すべて")
+        parser.add_argument("--view", help="この URL 名のリクエストだけを集計する（例: tweet:home）")
+        parser.add_argument("--sort", choices=("cumulative", "tottime", "calls"), default="cumulative")
+        parser.add_argument("--limit", type=int, default=30)
+
+    def handle(self, *args, paths, view, sort, limit, **options):
+        paths = paths or profiling.profile_paths()
+        if view:
+            paths = [path for path in paths if profiling.read_metadata(path).get("view") == view]
+        if not paths:
+            raise CommandError("集計するプロファイルがありません。")
+
+        output = io.StringIO()
+        stats = pstats.Stats(*paths, stream=output)
+        total = stats.total_tt
+        self.stdout.write(f"{len(paths)} profiles, {total:.3f}s profiled")
+        for label, func in BREAKDOWN:
+            seconds = stats.stats.get(stats_key(func), (0, 0, 0, 0))[3]
+            self.stdout.write(f"{label:<24}{seconds:>10.3f}s{seconds / total * 100 if total else 0:>7.1f}%")
+
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+        self.stdout.write(output.getvalue(), ending="")
@@ -0,0 +1,189 @@
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from io import BytesIO
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test import Client
+from django.test.utils import override_settings, setup_databases, teardown_databases
+from django.urls import reverse
+from django.utils.crypto import get_random_string
+
+from base.asyncviews import async_views
+from tweet import shards
+from tweet.models import Tweet
+
+User = get_user_model()
+
+# 同期ビューを WSGI で、async ビューを ASGI で動かす
+MODES = ("wsgi", "asgi")
+
+
+def call_wsgi(application, method, path, headers):
+    environ = {
+        "REQUEST_METHOD": method,
+        "PATH_INFO": path,
+        "QUERY_STRING": "",
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "80",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "CONTENT_LENGTH": "0",
+        "wsgi.input": BytesIO(),
+        "wsgi.url_scheme": "http",
+        **{"HTTP_" + name.upper().replace("-", "_"): value for name, value in headers.items()},
+    }
+    statuses = []
+    response = application(environ, lambda status, response_headers, exc_info=None: statuses.append(status))
+    for _ in response:
+        pass
+    # サーバーと同じく close() で request_finished を送り、接続を片付けさせる
+    response.close()
+    return int(statuses[0].split()[0])
+
+
+async def call_asgi(application, method, path, headers):
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "server": ("localhost", 80),
+        "client": ("127.0.0.1", 0),
+        "headers": [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+    }
+    status = None
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await application(scope, receive, send)
+    return status
+
+
+class Command(BaseCommand):
+    help = "同期ビュー (WSGI) と async ビュー (ASGI) に同じリクエストを同時に送り、スループットとレイテンシを比べる"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=50, help="同時に処理中にするリクエスト数")
+        parser.add_argument("--requests", type=int, default=1000, help="方式ごとのリクエスト数")
+        parser.add_argument("--tweets", type=int, default=200, help="ベンチマーク用のユーザーに投稿させるツイート数")
+        parser.add_argument("--write-ratio", type=float, default=0.2, help="いいね・いいね解除の割合")
+        parser.add_argument("--mode", choices=MODES, action="append", help="省略時は両方")
+
+    def handle(self, *args, mode, **options):
+        with ExitStack() as stack:
+            # bench_views と同じくテスト用のデータベースで動かす。同時に書き込むので、メモリ上ではなく一時ファイルに置く
+            tmpdir = stack.enter_context(tempfile.TemporaryDirectory())
+            for alias in connections:
+                test_settings = connections[alias].settings_dict.setdefault("TEST", {})
+                test_settings["NAME"] = os.path.join(tmpdir, f"bench_{alias}.sqlite3")
+            # debug_toolbar はレスポンスを書き換えて計測を歪めるので外す
+            middleware = [name for name in settings.MIDDLEWARE if not name.startswith("debug_toolbar")]
+            stack.enter_context(override_settings(DEBUG=False, MIDDLEWARE=middleware))
+            old_config = setup_databases(verbosity=0, interactive=False, aliases=set(connections))
+            stack.callback(teardown_databases, old_config, verbosity=0)
+            self.run(mode or MODES, **options)
+
+    def run(self, modes, concurrency, requests, tweets, write_ratio, **options):
+        viewer, author = self.seed(tweets)
+        client = Client()
+        client.force_login(viewer)
+        headers = self.headers(client)
+        plan = self.plan(author, requests, write_ratio)
+        self.stdout.write(f"concurrency={concurrency} requests={requests} write_ratio={write_ratio}")
+        self.stdout.write(f"{'mode':<8}{'req/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'errors':>8}")
+        for name in modes:
+            with async_views(name == "asgi"):
+                started = time.perf_counter()
+                results = getattr(self, f"run_{name}")(plan, headers, concurrency)
+                elapsed = time.perf_counter() - started
+            latencies = [latency for _, latency in results]
+            errors = sum(status != 200 for status, _ in results)
+            p95 = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0]
+            self.stdout.write(
+                f"{name:<8}{len(results) / elapsed:>10.0f}{statistics.median(latencies) * 1000:>9.1f}"
+                f"{p95 * 1000:>9.1f}{errors:>8}"
+            )
+
+    def seed(self, tweets):
+        viewer = User.objects.create_user(username="benchview", email="viewer@bench.invalid")
+        author = User.objects.create_user(username="benchauth", email="author@bench.invalid")
+        Tweet.objects.using(shards.for_user(author.pk)).bulk_create(
+            [Tweet(user=author, content=f"bench {i}") for i in range(tweets)]
+        )
+        User.objects.adjust_counts(author.pk, tweets_count=tweets)
+        return viewer, author
+
+    def headers(self, client):
+        # 実際のハンドラーに通すので CSRF も検査される。Cookie とヘッダーに同じトークンを送る
+        csrf_token = get_random_string(32)
+        return {
+            "Host": "localhost",
+            "Cookie": f"{settings.SESSION_COOKIE_NAME}={client.session.session_key}; "
+            f"{settings.CSRF_COOKIE_NAME}={csrf_token}",
+            "X-CSRFToken": csrf_token,
+        }
+
+    def plan(self, author, requests, write_ratio):
+        # URL は同期ビューと async ビューで同じ
+        rng = random.Random(0)
+        tweet_ids = list(
+            Tweet.objects.using(shards.for_user(author.pk)).filter(user=author).values_list("pk", flat=True)
+        )
+        reads = [reverse("tweet:home"), reverse("accounts:user_page", args=[author.username])]
+        plan = []
+        for _ in range(requests):
+            if tweet_ids and rng.random() < write_ratio:
+                name = rng.choice(["tweet:like", "tweet:unlike"])
+                plan.append(("POST", reverse(name, args=[rng.choice(tweet_ids)])))
+            else:
+                plan.append(("GET", rng.choice(reads)))
+        return plan
+
+    def run_wsgi(self, plan, headers, concurrency):
+        application = WSGIHandler()
+
+        def send(request):
+            started = time.perf_counter()
+            status = call_wsgi(application, *request, headers)
+            return status, time.perf_counter() - started
+
+        # スレッドで処理する WSGI サーバー（gunicorn の gthread など）と同じく、同時実行数だけスレッドを使う
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            return list(pool.map(send, plan))
+
+    def run_asgi(self, plan, headers, concurrency):
+        application = ASGIHandler()
+
+        async def run():
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def send(request):
+                async with semaphore:
+                    started = time.perf_counter()
+                    status = await call_asgi(application, *request, headers)
+                    return status, time.perf_counter() - started
+
+            return await asyncio.gather(*(send(request) for request in plan))
+
+        return asyncio.run(run())
@@ -0,0 +1,147 @@
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# 既定の設定（ロールバックジャーナル・リクエストごとの接続）と本番プロファイルを比べる
+PROFILES = {
+    "default": {"pragmas": {}, "persistent": False},
+    "production": {"pragmas": settings.SQLITE_PRODUCTION_PRAGMAS, "persistent": True},
+}
+
+SCHEMA = """
+CREATE TABLE bench_tweet (
+    id INTEGER PRIMARY KEY,
+    content TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    like_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX bench_tweet_created_at_idx ON bench_tweet (created_at DESC, id DESC);
+CREATE TABLE bench_like (
+    user_id INTEGER NOT NULL,
+    tweet_id INTEGER NOT NULL,
+    UNIQUE (user_id, tweet_id)
+);
+"""
+
+
+def connect(path, profile):
+    # Django と同じく autocommit にして、書き込みは BEGIN ... COMMIT で囲む
+    conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+    for name, value in profile["pragmas"].items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    return conn
+
+
+def read_timeline(conn, rng, tweets):
+    conn.execute(
+        "SELECT id, content, like_count FROM bench_tweet ORDER BY created_at DESC, id DESC LIMIT 20"
+    ).fetchall()
+
+
+def write_like(conn, rng, tweets):
+    tweet_id = rng.randrange(1, tweets + 1)
+    conn.execute("BEGIN")
+    try:
+        inserted = conn.execute(
+            "INSERT OR IGNORE INTO bench_like (user_id, tweet_id) VALUES (?, ?)", (rng.randrange(1000), tweet_id)
+        ).rowcount
+        if inserted:
+            conn.execute("UPDATE bench_tweet SET like_count = like_count + 1 WHERE id = ?", (tweet_id,))
+        conn.execute("COMMIT")
+    except sqlite3.Error:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def write_tweet(conn, rng, tweets):
+    conn.execute("INSERT INTO bench_tweet (content, created_at) VALUES (?, ?)", ("bench", time.time()))
+
+
+class Command(BaseCommand):
+    help = "SQLite の既定設定と本番プロファイル (TTTER_DB_PROFILE=production) で、読み書き混在の同時実行スループットを比べる"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=8)
+        parser.add_argument("--duration", type=float, default=5.0, help="プロファイルごとの計測秒数")
+        parser.add_argument("--write-ratio", type=float, default=0.2)
+        parser.add_argument("--tweets", type=int, default=10000, help="事前に投入するツイート数")
+        parser.add_argument("--profile", choices=sorted(PROFILES), action="append", help="省略時は両方")
+
+    def handle(self, *args, threads, duration, write_ratio, tweets, profile, **options):
+        self.stdout.write(f"threads={threads} duration={duration}s write_ratio={write_ratio}")
+        self.stdout.write(f"{'profile':<12}{'ops/s':>10}{'reads':>9}{'writes':>9}{'locked':>8}{'p95 ms':>9}")
+        for name in profile or sorted(PROFILES):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, "bench.sqlite3")
+                self.seed(path, PROFILES[name], tweets)
+                counts, latencies = self.run(path, PROFILES[name], threads, duration, write_ratio, tweets)
+            p95 = statistics.quantiles(latencies, n=20)[-1] * 1000 if len(latencies) > 1 else 0.0
+            self.stdout.write(
+                f"{name:<12}{(counts['reads'] + counts['writes']) / duration:>10.0f}"
+                f"{counts['reads']:>9}{counts['writes']:>9}{counts['locked']:>8}{p95:>9.1f}"
+            )
+
+    def seed(self, path, profile, tweets):
+        conn = connect(path, profile)
+        conn.executescript(SCHEMA)
+        now = time.time()
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT INTO bench_tweet (content, created_at) VALUES (?, ?)",
+            (("bench", now - i) for i in range(tweets)),
+        )
+        conn.execute("COMMIT")
+        conn.close()
+
+    def run(self, path, profile, threads, duration, write_ratio, tweets):
+        deadline = time.monotonic() + duration
+        counts = Counter()
+        latencies = []
+        lock = threading.Lock()
+
+        def worker(seed):
+            rng = random.Random(seed)
+            local_counts = Counter()
+            local_latencies = []
+            conn = None
+            while time.monotonic() < deadline:
+                if rng.random() < write_ratio:
+                    kind, operation = "writes", rng.choice([write_like, write_like, write_tweet])
+                else:
+                    kind, operation = "reads", read_timeline
+                start = time.perf_counter()
+                try:
+                    # 永続接続でなければ、リクエストごとに接続し直す (CONN_MAX_AGE = 0) のと同じにする
+                    if conn is None:
+                        conn = connect(path, profile)
+                    operation(conn, rng, tweets)
+                except sqlite3.OperationalError as e:
+                    if "locked" not in str(e) and "busy" not in str(e):
+                        raise
+                    local_counts["locked"] += 1
+                else:
+                    local_counts[kind] += 1
+                    local_latencies.append(time.perf_counter() - start)
+                if not profile["persistent"] and conn is not None:
+                    conn.close()
+                    conn = None
+            if conn is not None:
+                conn.close()
+            with lock:
+                counts.update(local_counts)
+                latencies.extend(local_latencies)
+
+        workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        return counts, latencies
@@ -0,0 +1,232 @@
+import json
+import os
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import ExitStack
+from datetime import timedelta
+from io import StringIO
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings, setup_databases, teardown_databases
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts.models import FriendShip
+from tweet import shards
+from tweet.models import LikeForTweet, Tweet
+
+User = get_user_model()
+
+
+def zipf_cum_weights(n, exponent):
+    """順位 r の重みが 1 / r^exponent になる累積重み（random.choices の cum_weights 用）。"""
+    total, cum_weights = 0.0, []
+    for rank in range(1, n + 1):
+        total += 1 / rank**exponent
+        cum_weights.append(total)
+    return cum_weights
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class Command(BaseCommand):
+    help = (
+        "テスト用のデータベースに偏りのある大量のデータを入れ、主要なビューのクエリ数・レイテンシ・"
+        "メモリのピークを計測して JSON に書き出す"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=2000)
+        parser.add_argument("--tweets", type=int, default=20000)
+        parser.add_argument("--likes", type=int, default=50000)
+        parser.add_argument("--follows", type=int, default=20, help="1 ユーザーあたりの平均フォロー数")
+        parser.add_argument(
+            "--skew", type=float, default=1.1, help="フォロワー数・いいね数の偏り（Zipf 分布の指数）"
+        )
+        parser.add_argument("--iterations", type=int, default=30, help="ビューごとの計測回数")
+        parser.add_argument("--warmup", type=int, default=3)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--on-disk", action="store_true", help="メモリ上ではなく一時ファイルの SQLite に入れる")
+        parser.add_argument("--output", default="bench_views.json", help="- なら標準出力に書く")
+
+    def handle(self, *args, on_disk, output, **options):
+        with ExitStack() as stack:
+            if on_disk:
+                tmpdir = stack.enter_context(tempfile.TemporaryDirectory())
+                for alias in connections:
+                    test_settings = connections[alias].settings_dict.setdefault("TEST", {})
+                    test_settings["NAME"] = os.path.join(tmpdir, f"bench_{alias}.sqlite3")
+            # 計測値を歪めないよう debug_toolbar とクエリの記録 (DEBUG) を外す
+            middleware = [name for name in settings.MIDDLEWARE if not name.startswith("debug_toolbar")]
+            stack.enter_context(override_settings(DEBUG=False, MIDDLEWARE=middleware))
+            old_config = setup_databases(verbosity=0, interactive=False, aliases=set(connections))
+            stack.callback(teardown_databases, old_config, verbosity=0)
+            report = self.run(**options)
+
+        report = json.dumps(report, indent=2, sort_keys=True, ensure_ascii=False) + "\n"
+        if output == "-":
+            self.stdout.write(report, ending="")
+        else:
+            with open(output, "w") as f:
+                f.write(report)
+
+    def run(self, users, tweets, likes, follows, skew, iterations, warmup, seed, **options):
+        rng = random.Random(seed)
+        started = time.perf_counter()
+        dataset = self.seed(rng, users, tweets, likes, follows, skew)
+        self.stdout.write(
+            f"seeded {users} users, {dataset['follows']} follows, {tweets} tweets and {dataset['likes']} likes "
+            f"in {time.perf_counter() - started:.1f}s"
+        )
+
+        self.stdout.write(f"{'view':<26}{'queries':>8}{'p50 ms':>9}{'p95 ms':>9}{'peak KiB':>10}")
+        results = {}
+        for name, method, paths in self.scenarios(dataset):
+            results[name] = self.measure(dataset["viewer"], method, paths, iterations, warmup)
+            self.stdout.write(
+                f"{name:<26}{results[name]['queries']:>8}{results[name]['p50_ms']:>9.2f}"
+                f"{results[name]['p95_ms']:>9.2f}{results[name]['peak_memory_kib']:>10.0f}"
+            )
+        return {
+            "commit": self.commit(),
+            "dataset": {
+                "users": users,
+                "tweets": tweets,
+                "likes": dataset["likes"],
+                "follows": dataset["follows"],
+                "skew": skew,
+                "seed": seed,
+                "shards": len(shards.aliases()),
+            },
+            "iterations": iterations,
+            "views": results,
+        }
+
+    def seed(self, rng, users, tweets, likes, follows, skew):
+        # 0 番目のユーザーが最も人気（フォロワーが多く、よく投稿する）になるよう、順位で重みを付ける
+        user_objs = User.objects.bulk_create(
+            [
+                User(username=f"user{i:06d}", email=f"user{i}@bench.invalid", nickname=f"nick{i}", password="!")
+                for i in range(users)
+            ],
+            batch_size=1000,
+        )
+        popularity = zipf_cum_weights(users, skew)
+
+        friendships = set()
+        for followee in range(users):
+            count = min(users - 1, int(rng.expovariate(1 / follows)) + 1)
+            for follower in rng.choices(range(users), cum_weights=popularity, k=count):
+                if follower != followee:
+                    friendships.add((followee, follower))
+        FriendShip.objects.bulk_create(
+            [FriendShip(followee=user_objs[a], follower=user_objs[b]) for a, b in friendships], batch_size=1000
+        )
+
+        now = timezone.now()
+        activity = zipf_cum_weights(users, skew * 0.7)
+        tweet_objs = [
+            Tweet(
+                user=user_objs[author],
+                content=f"tweet {i}",
+                created_at=now - timedelta(seconds=rng.uniform(0, 30 * 24 * 3600)),
+            )
+            for i, author in enumerate(rng.choices(range(users), cum_weights=activity, k=tweets))
+        ]
+        for db, group in shards.group_by_shard(tweet_objs).items():
+            Tweet.objects.using(db).bulk_create(group, batch_size=1000)
+
+        # 一部のツイートにいいねが集中する（バズったツイート）
+        virality = zipf_cum_weights(tweets, skew)
+        viral_order = rng.sample(tweet_objs, len(tweet_objs))
+        pairs = set()
+        for _ in range(likes * 2):
+            if len(pairs) >= likes:
+                break
+            tweet = rng.choices(viral_order, cum_weights=virality)[0]
+            pairs.add((rng.randrange(users), tweet))
+        by_shard = defaultdict(list)
+        for user, tweet in pairs:
+            by_shard[shards.for_tweet(tweet)].append(LikeForTweet(user=user_objs[user], tweet=tweet))
+        for db, group in by_shard.items():
+            LikeForTweet.objects.using(db).bulk_create(group, batch_size=1000)
+
+        call_command("reconcile_like_counts", stdout=StringIO())
+        call_command("recompute_user_counts", stdout=StringIO())
+        return {
+            "celebrity": user_objs[0],
+            "typical": user_objs[users // 2],
+            "viewer": user_objs[users // 3],
+            "viral_tweet": viral_order[0],
+            "likes": len(pairs),
+            "follows": len(friendships),
+        }
+
+    def scenarios(self, dataset):
+        celebrity, typical, tweet = dataset["celebrity"], dataset["typical"], dataset["viral_tweet"]
+        return [
+            ("tweet_list", "get", [reverse("tweet:home")]),
+            ("user_page_celebrity", "get", [reverse("accounts:user_page", args=[celebrity.username])]),
+            ("user_page_typical", "get", [reverse("accounts:user_page", args=[typical.username])]),
+            ("follower_list_celebrity", "get", [reverse("accounts:follower_list", args=[celebrity.username])]),
+            # いいねといいね解除を交互に送り、状態を保つ
+            (
+                "like_viral_tweet",
+                "post",
+                [reverse("tweet:like", args=[tweet.pk]), reverse("tweet:unlike", args=[tweet.pk])],
+            ),
+            ("user_list", "get", [reverse("accounts:userlist")]),
+            ("user_list_search", "get", [reverse("accounts:userlist") + "?q=user00"]),
+        ]
+
+    def measure(self, viewer, method, paths, iterations, warmup):
+        client = Client()
+        client.force_login(viewer)
+        request = getattr(client, method)
+        for i in range(warmup):
+            request(paths[i % len(paths)])
+
+        latencies = []
+        for i in range(iterations):
+            started = time.perf_counter()
+            response = request(paths[i % len(paths)])
+            latencies.append(time.perf_counter() - started)
+
+        # クエリの記録と tracemalloc は遅くなるので、別の 1 回で測る
+        with ExitStack() as stack:
+            captures = [stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in connections]
+            tracemalloc.start()
+            try:
+                baseline = tracemalloc.get_traced_memory()[0]
+                response = request(paths[iterations % len(paths)])
+                peak = tracemalloc.get_traced_memory()[1] - baseline
+            finally:
+                tracemalloc.stop()
+        return {
+            "status": response.status_code,
+            "queries": sum(len(capture) for capture in captures),
+            "p50_ms": round(statistics.median(latencies) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+            "peak_memory_kib": round(peak / 1024, 1),
+        }
+
+    def commit(self):
+        try:
+            return subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,96 @@
+import glob
+import json
+import statistics
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from base.queries import fingerprint
+
+
+def top(counts, n=3):
+    # counts は多い順に並んだ dict
+    return ", ".join(f"{name} ({count})" for name, count in list(counts.items())[:n])
+
+
+class Command(BaseCommand):
+    help = "スロークエリのログ (SLOW_QUERY_LOG) を正規化した SQL ごとにまとめ、時間のかかっているものから出す"
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="*", help="省略時は SLOW_QUERY_LOG とローテートされたファイル")
+        parser.add_argument("--sort", choices=("total", "count", "max"), default="total")
+        parser.add_argument("--limit", type=int, default=20)
+        parser.add_argument("--json", action="store_true", dest="as_json", help="表ではなく JSON で出す")
+
+    def handle(self, *args, paths, sort, limit, as_json, **options):
+        paths = paths or self.default_paths()
+        if not paths:
+            raise CommandError("ログが見つかりません。パスを指定するか SLOW_QUERY_LOG を設定してください。")
+
+        groups = defaultdict(lambda: {"durations": [], "views": Counter(), "frames": Counter(), "slowest": None})
+        malformed = 0
+        for entry in self.read(paths):
+            try:
+                key, duration = fingerprint(entry["sql"]), float(entry["duration_ms"])
+            except (KeyError, TypeError, ValueError):
+                malformed += 1
+                continue
+            group = groups[key]
+            group["durations"].append(duration)
+            group["views"][entry.get("view") or "-"] += 1
+            group["frames"][entry.get("frame") or "-"] += 1
+            if group["slowest"] is None or duration > group["slowest"]["duration_ms"]:
+                group["slowest"] = entry
+
+        summary = sorted(
+            (self.summarize(key, group) for key, group in groups.items()), key=lambda row: row[sort], reverse=True
+        )[:limit]
+        if as_json:
+            self.stdout.write(json.dumps(summary, indent=2, ensure_ascii=False))
+        else:
+            self.write_table(summary)
+        if malformed:
+            self.stderr.write(f"skipped {malformed} malformed entries")
+
+    def default_paths(self):
+        if not getattr(settings, "SLOW_QUERY_LOG", None):
+            return []
+        pattern = settings.SLOW_QUERY_LOG.replace("{pid}", "*")
+        return sorted(glob.glob(pattern) + glob.glob(pattern + ".[0-9]*"))
+
+    def read(self, paths):
+        for path in paths:
+            try:
+                f = open(path, encoding="utf-8")
+            except OSError as e:
+                raise CommandError(f"{path} を開けません: {e}")
+            with f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        yield {}
+
+    def summarize(self, key, group):
+        durations = group["durations"]
+        p95 = statistics.quantiles(durations, n=20, method="inclusive")[-1] if len(durations) > 1 else durations[0]
+        return {
+            "fingerprint": key,
+            "count": len(durations),
+            "total": round(sum(durations), 3),
+            "p95": round(p95, 3),
+            "max": round(max(durations), 3),
+            "views": dict(group["views"].most_common()),
+            "frames": dict(group["frames"].most_common()),
+            "slowest": group["slowest"],
+        }
+
+    def write_table(self, summary):
+        self.stdout.write(f"{'count':>7}{'total ms':>12}{'p95 ms':>10}{'max ms':>10}  fingerprint")
+        for row in summary:
+            self.stdout.write(
+                f"{row['count']:>7}{row['total']:>12.1f}{row['p95']:>10.1f}{row['max']:>10.1f}  {row['fingerprint']}"
+            )
+            self.stdout.write(f"{'':>41}views: {top(row['views'])}")
+            self.stdout.write(f"{'':>41}frames: {top(row['frames'])}")
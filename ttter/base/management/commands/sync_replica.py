@@ -0,0 +1,39 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from base.routers import REPLICA_DB_ALIAS
+
+
+class Command(BaseCommand):
+    help = "プライマリの SQLite ファイルを複製 (DATABASES['replica']) にコピーする。--interval で定期的に繰り返す"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, help="指定した秒数ごとにコピーし続ける")
+        parser.add_argument("--pages", type=int, default=1024, help="1 ステップでコピーするページ数")
+
+    def handle(self, *args, interval, pages, **options):
+        if REPLICA_DB_ALIAS not in settings.DATABASES:
+            raise CommandError("複製のデータベースが設定されていません (TTTER_REPLICA_NAME)。")
+        primary = settings.DATABASES["default"]["NAME"]
+        replica = settings.DATABASES[REPLICA_DB_ALIAS]["NAME"]
+        while True:
+            started = time.monotonic()
+            self.copy(primary, replica, pages)
+            self.stdout.write(f"copied {primary} to {replica} in {time.monotonic() - started:.2f}s")
+            if interval is None:
+                break
+            time.sleep(interval)
+
+    def copy(self, primary, replica, pages):
+        # オンラインバックアップ API は途中で書き込みがあってもコピー先を一貫した状態で終える
+        # （ページ単位で進めるので、コピー中もプライマリへの書き込みは止まらない）
+        source = sqlite3.connect(primary)
+        target = sqlite3.connect(replica)
+        try:
+            source.backup(target, pages=pages)
+        finally:
+            target.close()
+            source.close()
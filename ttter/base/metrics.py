@@ -0,0 +1,168 @@
+"""リクエストごとの計測値をプロセス内で集計し、Prometheus のテキスト形式で出力する。
+
+集計はプロセスごとなので、複数のワーカーで動かすときは Prometheus 側で各ワーカーを集める（sum など）。
+"""
+import threading
+from bisect import bisect_left
+
+from . import objectcache
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def reset(self):
+        with self.lock:
+            self.values = {}
+
+    def inc(self, labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for labels, value in sorted(values.items()):
+            yield self.name, format_labels(self.labelnames, labels), value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # ラベルの値ごとに [バケットごとの件数..., +Inf の件数, 合計]。累積は出力時に取る
+        self.series = {}
+
+    def reset(self):
+        with self.lock:
+            self.series = {}
+
+    def observe(self, labels, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0]
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self.lock:
+            series = {labels: list(values) for labels, values in self.series.items()}
+        for labels, values in sorted(series.items()):
+            count = 0
+            for bound, observed in zip(self.buckets + (float("inf"),), values):
+                count += observed
+                yield (
+                    f"{self.name}_bucket",
+                    format_labels(self.labelnames + ("le",), labels + (format_value(bound),)),
+                    count,
+                )
+            yield f"{self.name}_sum", format_labels(self.labelnames, labels), values[-1]
+            yield f"{self.name}_count", format_labels(self.labelnames, labels), count
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def reset(self):
+        for metric in self.metrics:
+            metric.reset()
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(f"{name}{labels} {format_value(value)}" for name, labels, value in metric.samples())
+        lines.extend(objectcache_lines())
+        return "\n".join(lines) + "\n"
+
+
+def objectcache_lines():
+    # ObjectCache は自分で件数を数えているので、出力するときに読む
+    name = "ttter_objectcache_lookups_total"
+    lines = [
+        f"# HELP {name} ObjectCache lookups by result.",
+        f"# TYPE {name} counter",
+    ]
+    for cache in objectcache.caches:
+        for result, value in sorted(cache.stats().items()):
+            lines.append(f"{name}{format_labels(('cache', 'result'), (cache.prefix, result))} {value}")
+    return lines
+
+
+registry = Registry()
+
+requests_total = registry.register(
+    Counter("ttter_requests_total", "Requests by URL name, method and status code.", ["view", "method", "status"])
+)
+request_duration = registry.register(
+    Histogram(
+        "ttter_request_duration_seconds", "Time spent in the view and middleware.", ["view", "method"], LATENCY_BUCKETS
+    )
+)
+db_queries = registry.register(
+    Histogram("ttter_db_queries", "SQL queries per request.", ["view"], QUERY_COUNT_BUCKETS)
+)
+db_duration = registry.register(
+    Histogram("ttter_db_query_duration_seconds", "Total SQL time per request.", ["view"], LATENCY_BUCKETS)
+)
+template_duration = registry.register(
+    Histogram(
+        "ttter_template_render_seconds", "TemplateResponse render time per request.", ["view"], LATENCY_BUCKETS
+    )
+)
+response_size = registry.register(
+    Histogram("ttter_response_size_bytes", "Response body size.", ["view"], SIZE_BUCKETS)
+)
+
+
+def observe_request(view, method, status, duration, queries, query_seconds, template_seconds, size):
+    requests_total.inc((view, method, str(status)))
+    request_duration.observe((view, method), duration)
+    db_queries.observe((view,), queries)
+    db_duration.observe((view,), query_seconds)
+    if template_seconds is not None:
+        template_duration.observe((view,), template_seconds)
+    if size is not None:
+        response_size.observe((view,), size)
@@ -0,0 +1,201 @@
+import cProfile
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+
+from . import metrics, profiling, slowqueries
+from .queries import QueryTimer
+from .routers import replica_reads
+
+# セッションに保存する「この時刻まではプライマリから読む」
+REPLICA_PINNED_UNTIL_KEY = "_replica_pinned_until"
+
+
+class SyncAndAsyncMiddleware:
+    """同期・async のどちらのハンドラーの中にも置けるミドルウェア。
+
+    同期だけのミドルウェアが 1 つでもあると、ASGI では async ビューも async_to_sync でスレッドに移される。
+    get_response が coroutine 関数なら、サブクラスの __call__ は __acall__ を返して await させる。
+    """
+
+    sync_capable = async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+
+class ReplicaRoutingMiddleware(SyncAndAsyncMiddleware):
+    """書き込んだセッションを REPLICA_STICKY_SECONDS の間プライマリに固定し、自分の書き込みが見えるようにする。
+
+    SessionMiddleware / AuthenticationMiddleware より後に置く。
+    """
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        self.load_pin(request)
+        token = replica_reads.set(False)
+        try:
+            response = self.get_response(request)
+        finally:
+            replica_reads.reset(token)
+        self.save_pin(request, response)
+        return response
+
+    async def __acall__(self, request):
+        # セッションとユーザーの読み込みはデータベースを使うのでスレッドで行う
+        await sync_to_async(self.load_pin)(request)
+        token = replica_reads.set(False)
+        try:
+            response = await self.get_response(request)
+        finally:
+            replica_reads.reset(token)
+        await sync_to_async(self.save_pin)(request, response)
+        return response
+
+    def load_pin(self, request):
+        request.replica_pinned = time.time() < request.session.get(REPLICA_PINNED_UNTIL_KEY, 0)
+
+    def save_pin(self, request, response):
+        if (
+            request.method not in ("GET", "HEAD", "OPTIONS")
+            and response.status_code < 400
+            and request.user.is_authenticated
+        ):
+            request.session[REPLICA_PINNED_UNTIL_KEY] = time.time() + settings.REPLICA_STICKY_SECONDS
+
+
+class MetricsMiddleware(SyncAndAsyncMiddleware):
+    """URL 名ごとのレイテンシ、SQL の件数と時間、テンプレートの描画時間、レスポンスの大きさを base.metrics に記録する。
+
+    TemplateResponse の描画時間を計るため MIDDLEWARE の先頭に置く（process_template_response が最後に呼ばれる）。
+    render() で描画するビューの描画時間は、ビューの時間に含まれる。
+    """
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        started = time.perf_counter()
+        request.template_render_seconds = None
+        with QueryTimer() as queries:
+            response = self.get_response(request)
+        self.observe(request, response, started, queries)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        request.template_render_seconds = None
+        with QueryTimer() as queries:
+            response = await self.get_response(request)
+        self.observe(request, response, started, queries)
+        return response
+
+    def observe(self, request, response, started, queries):
+        match = request.resolver_match
+        metrics.observe_request(
+            # ラベルの種類が増えすぎないよう、URL ではなく URL 名でまとめる
+            view=match.view_name if match and match.view_name else "unresolved",
+            method=request.method,
+            status=response.status_code,
+            duration=time.perf_counter() - started,
+            queries=queries.count,
+            query_seconds=queries.seconds,
+            template_seconds=request.template_render_seconds,
+            size=None if response.streaming else len(response.content),
+        )
+
+    def process_template_response(self, request, response):
+        started = time.perf_counter()
+        response.render()
+        request.template_render_seconds = time.perf_counter() - started
+        return response
+
+
+class SlowQueryLogMiddleware(SyncAndAsyncMiddleware):
+    """スロークエリのログに URL 名を残すため、ビューの実行中は base.slowqueries.current_view に URL 名を入れる。"""
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        token = slowqueries.current_view.set(None)
+        try:
+            return self.get_response(request)
+        finally:
+            slowqueries.current_view.reset(token)
+
+    async def __acall__(self, request):
+        token = slowqueries.current_view.set(None)
+        try:
+            return await self.get_response(request)
+        finally:
+            slowqueries.current_view.reset(token)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        slowqueries.current_view.set(request.resolver_match.view_name)
+
+
+class ProfilerMiddleware(SyncAndAsyncMiddleware):
+    """PROFILE_SAMPLE_RATE の割合のリクエストと、PROFILE_SLOW_MS を超えたリクエストを cProfile で計測して書き出す。
+
+    ビューとテンプレートの描画を計るので MIDDLEWARE の後ろに置く。cProfile はスレッドごとなので、async ビューでは
+    sync_to_async で渡したクエリは計測されず、同じイベントループで並行して動く他のリクエストの処理が含まれる。
+    """
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        profile, sampled = self.start()
+        if profile is None:
+            return self.get_response(request)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            profile.disable()
+        self.finish(request, response, profile, sampled, started)
+        return response
+
+    async def __acall__(self, request):
+        profile, sampled = self.start()
+        if profile is None:
+            return await self.get_response(request)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            profile.disable()
+        self.finish(request, response, profile, sampled, started)
+        return response
+
+    def start(self):
+        enabled, sampled = profiling.should_profile()
+        if not enabled:
+            return None, sampled
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # 別のプロファイラーが動いている
+            return None, sampled
+        return profile, sampled
+
+    def finish(self, request, response, profile, sampled, started):
+        duration_ms = (time.perf_counter() - started) * 1000
+        reason = profiling.sampling_reason(duration_ms, sampled)
+        if reason:
+            match = request.resolver_match
+            profiling.save_profile(
+                profile,
+                {
+                    "view": match.view_name if match else None,
+                    "route": match.route if match else None,
+                    "method": request.method,
+                    "status": response.status_code,
+                    "duration_ms": round(duration_ms, 3),
+                    "reason": reason,
+                },
+            )
@@ -0,0 +1,138 @@
+import hashlib
+import threading
+from collections import Counter
+
+from django.core.cache import cache
+from django.db import router, transaction
+from django.db.models.signals import post_delete, post_save
+from django.http import Http404
+
+# 「存在しない」ことを短時間キャッシュするための目印
+MISS = "__objectcache_miss__"
+
+# 作られた ObjectCache（base.metrics がヒット率を出力する）
+caches = []
+
+
+class ObjectCache:
+    """主キーと一意なフィールド (username など) による単一オブジェクトの取得をキャッシュする。
+
+    インスタンスはフィールドの値だけを主キーで保存し、別名のキーには主キーだけを持たせる。
+    保存時は post_save で書き込み、削除時は post_delete で「存在しない」を記録する。
+    update() で書き換える場合は invalidate() を呼ぶ。
+    exclude に挙げたフィールド (パスワードのハッシュなど) はキャッシュに載せず、読み込んだインスタンスでは
+    遅延読み込みのフィールドになる（アクセスしたときにデータベースから読む）。
+    """
+
+    def __init__(self, model, lookups=(), exclude=(), timeout=300, miss_timeout=30):
+        self.model = model
+        self.lookups = tuple(lookups)
+        self.exclude = frozenset(exclude)
+        self.timeout = timeout
+        self.miss_timeout = miss_timeout
+        self.prefix = f"objectcache:{model._meta.label_lower}"
+        self._stats = Counter()
+        self._lock = threading.Lock()
+        post_save.connect(self._on_save, sender=model, weak=False)
+        post_delete.connect(self._on_delete, sender=model, weak=False)
+        caches.append(self)
+
+    def pk_key(self, pk):
+        return f"{self.prefix}:pk:{pk}"
+
+    def lookup_key(self, field, value):
+        digest = hashlib.md5(str(value).encode()).hexdigest()
+        return f"{self.prefix}:{field}:{digest}"
+
+    def count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def get(self, **lookup):
+        ((field, value),) = lookup.items()
+        if field in ("pk", self.model._meta.pk.name):
+            return self._get_by_pk(value)
+        if field not in self.lookups:
+            raise ValueError(f"{field} is not a cached lookup for {self.model._meta.label}.")
+
+        key = self.lookup_key(field, value)
+        pk = cache.get(key)
+        if pk == MISS:
+            self.count("hits")
+            return None
+        if pk is not None:
+            obj = self.load(cache.get(self.pk_key(pk)))
+            # 別名が古くなっている（ユーザー名の変更など）場合はデータベースから引き直す
+            if obj is not None and getattr(obj, field) == value:
+                self.count("hits")
+                return obj
+
+        self.count("misses")
+        obj = self.fetch(**{field: value})
+        if obj is None:
+            cache.set(key, MISS, self.miss_timeout)
+        else:
+            self.store(obj)
+        return obj
+
+    def _get_by_pk(self, pk):
+        values = cache.get(self.pk_key(pk))
+        if values is not None:
+            self.count("hits")
+            return self.load(values)
+        self.count("misses")
+        obj = self.fetch(pk=pk)
+        if obj is None:
+            cache.set(self.pk_key(pk), MISS, self.miss_timeout)
+        else:
+            self.store(obj)
+        return obj
+
+    def queryset(self):
+        # 複製の遅れた値をキャッシュしないよう、常に書き込み先のデータベースから読む
+        return self.model._default_manager.db_manager(router.db_for_write(self.model)).all()
+
+    def fetch(self, **lookup):
+        return self.queryset().filter(**lookup).first()
+
+    def get_or_404(self, **lookup):
+        obj = self.get(**lookup)
+        if obj is None:
+            raise Http404(f"No {self.model._meta.object_name} matches the given query.")
+        return obj
+
+    def load(self, values):
+        if values is None or values == MISS:
+            return None
+        return self.model.from_db(None, self.field_names, values)
+
+    @property
+    def field_names(self):
+        return [field.attname for field in self.model._meta.concrete_fields if field.attname not in self.exclude]
+
+    def store(self, obj):
+        # 関連オブジェクトやビューが付けた属性は持たせず、カラムの値だけを保存する
+        values = {self.pk_key(obj.pk): [getattr(obj, name) for name in self.field_names]}
+        values.update({self.lookup_key(field, getattr(obj, field)): obj.pk for field in self.lookups})
+        cache.set_many(values, self.timeout)
+
+    def invalidate(self, *pks, using=None):
+        """using には書き換えたデータベースを渡す（そのトランザクションのコミット後にもう一度消す）。"""
+        keys = [self.pk_key(pk) for pk in pks]
+        cache.delete_many(keys)
+        # コミット前に古い値が読み直されてキャッシュされることがあるので、コミット後にも消す
+        transaction.on_commit(lambda: cache.delete_many(keys), using=using)
+
+    def _on_save(self, sender, instance, using=None, **kwargs):
+        # キャッシュから読んだインスタンスは除外したフィールドが遅延読み込みのまま保存される
+        if instance.get_deferred_fields() - self.exclude:
+            self.invalidate(instance.pk, using=using)
+        else:
+            self.store(instance)
+
+    def _on_delete(self, sender, instance, **kwargs):
+        cache.set(self.pk_key(instance.pk), MISS, self.miss_timeout)
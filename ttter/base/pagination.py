@@ -0,0 +1,266 @@
+import base64
+import binascii
+import heapq
+import json
+from functools import reduce
+from operator import itemgetter, or_
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.paginator import InvalidPage
+from django.db.models import Q
+from django.http import Http404
+
+
+class InvalidCursor(InvalidPage):
+    pass
+
+
+def encode_cursor(values, reverse=False):
+    # datetime / UUID は str() で文字列化し、復元時にモデルフィールドの to_python で戻す
+    payload = json.dumps([list(values), reverse], default=str, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        values, reverse = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, UnicodeError, ValueError, TypeError):
+        raise InvalidCursor("不正なカーソルです。")
+    if not isinstance(values, list) or not isinstance(reverse, bool):
+        raise InvalidCursor("不正なカーソルです。")
+    return values, reverse
+
+
+def parse_ordering(ordering):
+    return [(name.lstrip("-"), name.startswith("-")) for name in ordering]
+
+
+def keyset_filter(queryset, ordering, values, reverse=False):
+    """ordering 上で values の位置より後ろ（reverse なら前）の行に絞り込む。
+
+    先頭キーに範囲条件を付けることで、複合インデックスを使ったシークになる。
+    """
+    fields = parse_ordering(ordering)
+    clauses = []
+    for i, (name, desc) in enumerate(fields):
+        lookup = "lt" if desc != reverse else "gt"
+        clause = Q(**{f"{name}__{lookup}": values[i]})
+        for prev_name, prev_value in zip([f[0] for f in fields[:i]], values[:i]):
+            clause &= Q(**{prev_name: prev_value})
+        clauses.append(clause)
+    first_name, first_desc = fields[0]
+    bound = Q(**{f"{first_name}__{'lte' if first_desc != reverse else 'gte'}": values[0]})
+    return queryset.filter(bound & reduce(or_, clauses))
+
+
+def reverse_ordering(ordering):
+    return [name[1:] if name.startswith("-") else f"-{name}" for name in ordering]
+
+
+class CursorPage:
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        return f"<CursorPage ({len(self.object_list)} items)>"
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    """OFFSET を使わず、ordering のキー値をカーソルにしてページングする。
+
+    ordering の最後のキーは一意である必要がある（例: ("-created_at", "-id")）。
+    """
+
+    def __init__(self, queryset, ordering, per_page, transform=None):
+        self.queryset = queryset
+        self.ordering = list(ordering)
+        self.per_page = int(per_page)
+        self.transform = transform
+        self.fields = parse_ordering(self.ordering)
+
+    def key(self, obj):
+        return tuple(getattr(obj, name) for name, _ in self.fields)
+
+    def decode(self, token):
+        values, reverse = decode_cursor(token)
+        return self.to_python(values), reverse
+
+    def to_python(self, values):
+        if len(values) != len(self.fields):
+            raise InvalidCursor("不正なカーソルです。")
+        opts = self.queryset.model._meta
+        try:
+            return [self._to_python(opts, name, value) for (name, _), value in zip(self.fields, values)]
+        except ValidationError:
+            raise InvalidCursor("不正なカーソルです。")
+
+    @staticmethod
+    def _to_python(opts, name, value):
+        try:
+            field = opts.get_field(name)
+        except FieldDoesNotExist:
+            # annotate した値など、モデルフィールドでないキーはそのまま使う
+            return value
+        return field.to_python(value)
+
+    def fetch(self, values=None, reverse=False, limit=None):
+        """カーソル位置から ordering 順（reverse なら逆順）に最大 limit 件取得する。"""
+        queryset = self.queryset
+        if values is not None:
+            queryset = keyset_filter(queryset, self.ordering, values, reverse)
+        ordering = reverse_ordering(self.ordering) if reverse else self.ordering
+        return list(queryset.order_by(*ordering)[: limit or self.per_page])
+
+    def page(self, token=None):
+        values, reverse = self.decode(token) if token else (None, False)
+        rows = self.fetch(values, reverse, self.per_page + 1)
+        keyed_rows = [(self.key(row), self.transform(row) if self.transform else row) for row in rows]
+        return build_cursor_page(keyed_rows, self.per_page, values is not None, reverse)
+
+
+class MergedKeysetPaginator:
+    """同じ並び順の複数のキーセットを heap でマージしてページングする。
+
+    各ソースからはページサイズ + 1 件しか読まないので、コストはソース数 × ページサイズで抑えられる。
+    キーが同じ行（同一ツイートなど）は 1 件にまとめる。
+    """
+
+    def __init__(self, paginators, per_page):
+        self.paginators = list(paginators)
+        self.per_page = int(per_page)
+        directions = {desc for paginator in self.paginators for _, desc in paginator.fields}
+        if len(directions) > 1:
+            raise ValueError("MergedKeysetPaginator requires every key to be ordered in the same direction.")
+        self.descending = directions == {True}
+
+    def decode(self, token):
+        return self.paginators[0].decode(token)
+
+    def page(self, token=None):
+        values, reverse = self.decode(token) if token else (None, False)
+        streams = [self.fetch_stream(paginator, values, reverse) for paginator in self.paginators]
+        return self.merge(streams, values, reverse)
+
+    def fetch_stream(self, paginator, values, reverse):
+        rows = paginator.fetch(values, reverse, self.per_page + 1)
+        return [(paginator.key(row), paginator.transform(row) if paginator.transform else row) for row in rows]
+
+    def merge(self, streams, values, reverse):
+        """各ソースから fetch_stream で読んだ (キー, オブジェクト) のリストをマージしてページにする。"""
+        keyed_rows = []
+        for key, obj in heapq.merge(*streams, key=itemgetter(0), reverse=self.descending != reverse):
+            if keyed_rows and keyed_rows[-1][0] == key:
+                continue
+            keyed_rows.append((key, obj))
+            if len(keyed_rows) > self.per_page:
+                break
+        return build_cursor_page(keyed_rows, self.per_page, values is not None, reverse)
+
+
+class ChainedKeysetPaginator:
+    """複数のキーセットを順番につなげてページングする（1 つ目を読み切ったら 2 つ目へ）。
+
+    カーソルの先頭にソースの番号を持たせるので、ソースごとに並び順が違ってもよい。
+    """
+
+    def __init__(self, paginators, per_page):
+        self.paginators = list(paginators)
+        self.per_page = int(per_page)
+
+    def decode(self, token):
+        values, reverse = decode_cursor(token)
+        if not values or values[0] not in range(len(self.paginators)):
+            raise InvalidCursor("不正なカーソルです。")
+        index = values[0]
+        return index, self.paginators[index].to_python(values[1:]), reverse
+
+    def page(self, token=None):
+        index, values, reverse = self.decode(token) if token else (0, None, False)
+        has_cursor = values is not None
+        step = -1 if reverse else 1
+        keyed_rows = []
+        while 0 <= index < len(self.paginators) and len(keyed_rows) <= self.per_page:
+            paginator = self.paginators[index]
+            for row in paginator.fetch(values, reverse, self.per_page + 1 - len(keyed_rows)):
+                obj = paginator.transform(row) if paginator.transform else row
+                keyed_rows.append(((index,) + paginator.key(row), obj))
+            index += step
+            values = None
+        return build_cursor_page(keyed_rows, self.per_page, has_cursor, reverse)
+
+
+def build_cursor_page(keyed_rows, per_page, has_cursor, reverse):
+    """(キー, オブジェクト) のリストからページと前後のカーソルを組み立てる。
+
+    keyed_rows はカーソル位置から読み進めた順に並び、最大 per_page + 1 件とする。
+    """
+    has_more = len(keyed_rows) > per_page
+    keyed_rows = keyed_rows[:per_page]
+    next_cursor = previous_cursor = None
+    if reverse:
+        keyed_rows.reverse()
+        if has_more:
+            previous_cursor = encode_cursor(keyed_rows[0][0], reverse=True)
+        if keyed_rows:
+            next_cursor = encode_cursor(keyed_rows[-1][0])
+    else:
+        if has_more:
+            next_cursor = encode_cursor(keyed_rows[-1][0])
+        if has_cursor and keyed_rows:
+            previous_cursor = encode_cursor(keyed_rows[0][0], reverse=True)
+    return CursorPage([obj for _, obj in keyed_rows], next_cursor, previous_cursor)
+
+
+def pagination_query(request, cursor_kwarg):
+    # ページ送りのリンクでカーソル以外のクエリパラメータを引き継ぐ
+    query = request.GET.copy()
+    query.pop(cursor_kwarg, None)
+    return query.urlencode()
+
+
+class KeysetPaginationMixin:
+    """ListView の paginate_queryset をキーセットページングに置き換える。"""
+
+    paginate_by = 20
+    cursor_ordering = ("-created_at", "-id")
+    cursor_kwarg = "cursor"
+
+    def get_keyset_paginator(self, queryset, page_size):
+        return KeysetPaginator(queryset, self.cursor_ordering, page_size)
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = self.get_keyset_paginator(queryset, page_size)
+        page = self.get_cursor_page(paginator)
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["pagination_query"] = pagination_query(self.request, self.cursor_kwarg)
+        return context
+
+    def get_cursor_page(self, paginator):
+        try:
+            return paginator.page(self.request.GET.get(self.cursor_kwarg))
+        except InvalidCursor as e:
+            raise Http404(str(e))
@@ -0,0 +1,65 @@
+"""リクエストの cProfile の結果を PROFILE_DIR に書き、古いものから消して PROFILE_MAX_FILES 件に抑える。
+
+1 リクエストにつき、pstats で読める <name>.prof と、URL 名などを入れた <name>.json を書く。
+ユーザーを特定できる値（パス、クエリ文字列、ユーザー ID）は残さず、URL のパターンだけを残す。
+"""
+import glob
+import json
+import os
+import random
+import uuid
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+
+def sampling_reason(duration_ms, sampled):
+    """ファイルに残す理由。残さないなら None。"""
+    if sampled:
+        return "sample"
+    if settings.PROFILE_SLOW_MS is not None and duration_ms >= settings.PROFILE_SLOW_MS:
+        return "slow"
+    return None
+
+
+def should_profile():
+    """(プロファイラーを動かすか, 遅さに関係なく残す標本か)"""
+    sampled = random.random() < settings.PROFILE_SAMPLE_RATE
+    return sampled or settings.PROFILE_SLOW_MS is not None, sampled
+
+
+def save_profile(profile, metadata):
+    os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+    now = datetime.now(timezone.utc)
+    view = (metadata.get("view") or "unresolved").replace(":", "-")
+    # 名前の順が時刻の順になるようにする（prune が古いものから消す）
+    name = f"{now:%Y%m%dT%H%M%S%f}-{view}-{uuid.uuid4().hex[:8]}"
+    base = os.path.join(settings.PROFILE_DIR, name)
+    profile.dump_stats(base + ".prof")
+    with open(base + ".json", "w") as f:
+        json.dump({**metadata, "time": now.isoformat(timespec="milliseconds")}, f, ensure_ascii=False)
+    prune()
+    return base + ".prof"
+
+
+def profile_paths(directory=None):
+    return sorted(glob.glob(os.path.join(directory or settings.PROFILE_DIR, "*.prof")))
+
+
+def prune():
+    paths = profile_paths()
+    for path in paths[: max(0, len(paths) - settings.PROFILE_MAX_FILES)]:
+        for filename in (path, path[: -len(".prof")] + ".json"):
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                # 別のワーカーが先に消した
+                pass
+
+
+def read_metadata(path):
+    try:
+        with open(path[: -len(".prof")] + ".json") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
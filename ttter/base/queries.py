@@ -0,0 +1,162 @@
+"""実行された SQL を、発行元（アプリのコードの行とテンプレートの行）と一緒に記録する。"""
+import os
+import re
+import sys
+import threading
+import time
+from collections import namedtuple
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+
+Query = namedtuple("Query", ["alias", "sql", "fingerprint", "template", "frame"])
+
+STRING = re.compile(r"'(?:[^']|'')*'")
+NUMBER = re.compile(r"(?<![\w\"])-?\d+(?:\.\d+)?\b")
+PLACEHOLDER = re.compile(r"%s|\?")
+SAVEPOINT = re.compile(r'(SAVEPOINT) "[^"]+"')
+# IN (?, ?, ?) や VALUES (?, ?), (?, ?)、bulk_create の SELECT ?, ? UNION ALL SELECT ?, ? の件数の違いはまとめる
+VALUE_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*")
+UNION_ROWS = re.compile(r"SELECT \?(?:, \?)*(?: UNION ALL SELECT \?(?:, \?)*)+")
+WHITESPACE = re.compile(r"\s+")
+
+
+def fingerprint(sql):
+    """値を ? に置き換えた SQL。値と IN の要素数だけが違うクエリは同じ fingerprint になる。"""
+    sql = STRING.sub("?", sql)
+    sql = NUMBER.sub("?", sql)
+    sql = PLACEHOLDER.sub("?", sql)
+    sql = SAVEPOINT.sub(r"\1 ?", sql)
+    sql = VALUE_LIST.sub("(...)", sql)
+    sql = WHITESPACE.sub(" ", sql).strip()
+    return UNION_ROWS.sub("SELECT ... UNION ALL ...", sql)
+
+
+# リクエスト全体やクエリの実行を包むだけで、発行元としては意味のないファイル
+WRAPPER_FILES = {
+    os.path.join("base", "middleware.py"),
+    os.path.join("base", "queries.py"),
+    os.path.join("base", "slowqueries.py"),
+}
+
+
+def is_application_file(filename):
+    filename = os.path.abspath(filename)
+    return (
+        filename.startswith(str(settings.BASE_DIR) + os.sep)
+        and "site-packages" not in filename
+        and os.path.relpath(filename, settings.BASE_DIR) not in WRAPPER_FILES
+    )
+
+
+def application_frame(frame=None):
+    """スタックのうち、このリポジトリのコードで最も内側のフレームを "path:行 in 関数" で返す。"""
+    frame = frame or sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if is_application_file(filename):
+            path = os.path.relpath(filename, settings.BASE_DIR)
+            return f"{path}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+    return None
+
+
+def template_line(frame=None):
+    """テンプレートの描画中なら、最も内側のノードの "テンプレート名:行" を返す。"""
+    frame = frame or sys._getframe(1)
+    while frame is not None:
+        if frame.f_code.co_name == "render_annotated":
+            node = frame.f_locals.get("self")
+            origin, token = getattr(node, "origin", None), getattr(node, "token", None)
+            if origin is not None and token is not None:
+                return f"{origin.template_name or origin.name}:{token.lineno}"
+        frame = frame.f_back
+    return None
+
+
+class QueryRecorder:
+    """with の間にすべてのデータベースで実行された SQL を Query として queries に記録する。
+
+    CaptureQueriesContext と違い DEBUG に関係なく動き、発行元のフレームとテンプレートの行も残す。
+    """
+
+    def __init__(self, aliases=None):
+        self.aliases = aliases
+        self.queries = []
+
+    def __len__(self):
+        return len(self.queries)
+
+    def __call__(self, execute, sql, params, many, context):
+        frame = sys._getframe(1)
+        self.queries.append(
+            Query(
+                alias=context["connection"].alias,
+                sql=sql,
+                fingerprint=fingerprint(sql),
+                template=template_line(frame),
+                frame=application_frame(frame),
+            )
+        )
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self.stack = ExitStack()
+        for alias in self.aliases or connections:
+            self.stack.enter_context(connections[alias].execute_wrapper(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stack.close()
+
+
+# 計測中の QueryTimer。sync_to_async や asyncio.gather の先にもコンテキストごと引き継がれる
+current_timers = ContextVar("query_timers", default=())
+
+
+def timing_wrapper(execute, sql, params, many, context):
+    timers = current_timers.get()
+    if not timers:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        seconds = time.perf_counter() - started
+        for timer in timers:
+            timer.add(seconds)
+
+
+def install_query_timer(sender, connection, **kwargs):
+    """connection_created で、接続に timing_wrapper を付ける（QueryTimer の外では何もしない）。"""
+    if timing_wrapper not in connection.execute_wrappers:
+        # execute_wrapper() は抜けるときに末尾を取り除くので、先頭に入れる
+        connection.execute_wrappers.insert(0, timing_wrapper)
+
+
+class QueryTimer:
+    """with の間にすべてのデータベースで実行された SQL の件数と合計時間だけを数える（本番で常に使う軽い版）。
+
+    接続はスレッドごとなので、各接続の timing_wrapper が ContextVar から QueryTimer を探す。
+    async ビューが sync_to_async や gather_queries でほかのスレッドに渡したクエリも数える。
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        # gather_queries では複数のスレッドから同時に呼ばれる
+        with self.lock:
+            self.count += 1
+            self.seconds += seconds
+
+    def __enter__(self):
+        self.token = current_timers.set(current_timers.get() + (self,))
+        return self
+
+    def __exit__(self, *exc_info):
+        current_timers.reset(self.token)
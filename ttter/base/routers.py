@@ -0,0 +1,53 @@
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+REPLICA_DB_ALIAS = "replica"
+
+# 現在のリクエストで複製から読んでよいか（ReplicaReadMixin が立て、ReplicaRoutingMiddleware が戻す）
+replica_reads = ContextVar("replica_reads", default=False)
+
+
+def replica_configured():
+    return REPLICA_DB_ALIAS in settings.DATABASES
+
+
+def use_replica_for(request):
+    """読み込みだけのリクエストなら、以降のクエリ（このコンテキストの中）を複製に流す。"""
+    if request.method in ("GET", "HEAD") and getattr(request, "replica_pinned", None) is False:
+        replica_reads.set(True)
+
+
+class PrimaryReplicaRouter:
+    """書き込みは常にプライマリ、読み込みは ReplicaReadMixin のビューの中だけ複製に振り分ける。
+
+    それ以外の読み込み（書き込み前の存在確認やセッションの読み込みなど）はプライマリから読む。
+    """
+
+    def db_for_read(self, model, **hints):
+        if replica_reads.get() and replica_configured():
+            return REPLICA_DB_ALIAS
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # 複製はプライマリのコピーなので、どちらから読んだオブジェクトでも関連付けてよい
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaReadMixin:
+    """読み込みだけのビューで、GET / HEAD のクエリを複製に流す。
+
+    直前に書き込んだセッション（request.replica_pinned）はプライマリから読む。
+    ReplicaRoutingMiddleware がなければ（複製を設定していなければ）何もしない。
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        use_replica_for(request)
+        return super().dispatch(request, *args, **kwargs)
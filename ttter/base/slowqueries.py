@@ -0,0 +1,106 @@
+"""SLOW_QUERY_THRESHOLD_MS を超えたクエリを、発行元と一緒に JSON Lines で SLOW_QUERY_LOG に書く。
+
+settings.SLOW_QUERY_LOG を指定したときだけ、connection_created で各接続に execute wrapper を付ける。
+集計は summarize_slow_queries で行う。
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+
+from django.conf import settings
+
+from .queries import application_frame
+
+# 実行中のビューの URL 名（SlowQueryLogMiddleware が設定する）
+current_view = ContextVar("slow_query_view", default=None)
+
+logger = logging.getLogger("ttter.slowqueries")
+logger.propagate = False
+_handler_lock = threading.Lock()
+
+
+def redact(value):
+    """パラメーターのうち、数値・真偽値・None 以外は型と長さだけを残す（文字列には個人情報が入りうる）。"""
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, (str, bytes)):
+        return f"<{type(value).__name__}:{len(value)}>"
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    return f"<{type(value).__name__}>"
+
+
+def redact_params(params, many):
+    if many:
+        # executemany は行数だけ
+        return {"rows": len(params) if hasattr(params, "__len__") else None}
+    if isinstance(params, dict):
+        return {key: redact(value) for key, value in params.items()}
+    return redact(list(params or ()))
+
+
+def log_path():
+    # 複数のワーカーが同じファイルをローテートし合わないよう、{pid} でプロセスごとのファイルにできる
+    # format() では {pid} 以外の波括弧を含むパスで KeyError などになるので、置き換えるだけにする
+    return settings.SLOW_QUERY_LOG.replace("{pid}", str(os.getpid()))
+
+
+def get_logger():
+    if not logger.handlers:
+        with _handler_lock:
+            if not logger.handlers:
+                handler = RotatingFileHandler(
+                    log_path(),
+                    maxBytes=settings.SLOW_QUERY_LOG_MAX_BYTES,
+                    backupCount=settings.SLOW_QUERY_LOG_BACKUP_COUNT,
+                    encoding="utf-8",
+                    delay=True,
+                )
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                logger.addHandler(handler)
+                logger.setLevel(logging.INFO)
+    return logger
+
+
+def close_log():
+    """ファイルを閉じる。次に書くときに SLOW_QUERY_LOG を開き直す。"""
+    with _handler_lock:
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+
+
+def slow_query_wrapper(execute, sql, params, many, context):
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - started
+        if duration * 1000 >= settings.SLOW_QUERY_THRESHOLD_MS:
+            entry = {
+                "time": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+                "duration_ms": round(duration * 1000, 3),
+                "alias": context["connection"].alias,
+                "view": current_view.get(),
+                "frame": application_frame(sys._getframe(1)),
+                "sql": sql,
+                "params": redact_params(params, many),
+                "many": many,
+            }
+            get_logger().info(json.dumps(entry, ensure_ascii=False, default=str))
+
+
+def install_slow_query_log(sender, connection, **kwargs):
+    """connection_created で、SLOW_QUERY_LOG が指定されていれば接続に slow_query_wrapper を付ける。"""
+    if not getattr(settings, "SLOW_QUERY_LOG", None):
+        return
+    if slow_query_wrapper not in connection.execute_wrappers:
+        # execute_wrapper() は抜けるときに末尾を取り除くので、その途中で接続されても外されないよう先頭に入れる
+        # （先頭が最も内側になり、他の wrapper の時間を含まない）
+        connection.execute_wrappers.insert(0, slow_query_wrapper)
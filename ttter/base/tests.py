@@ -1,3 +1,525 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+import time
+from collections import Counter
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+from django.views.generic import View
+
+from accounts import urls as accounts_urls
+from accounts.models import FriendShip
+from tweet import timeline
+from tweet import urls as tweet_urls
+from tweet.models import LikeForTweet, Tweet
+
+from . import metrics, profiling, slowqueries
+from .asyncviews import async_views, run_in_own_connection
+from .db import apply_sqlite_pragmas
+from .middleware import (
+    REPLICA_PINNED_UNTIL_KEY,
+    MetricsMiddleware,
+    ProfilerMiddleware,
+    ReplicaRoutingMiddleware,
+    SlowQueryLogMiddleware,
+)
+from .queries import QueryRecorder, QueryTimer, fingerprint
+from .routers import PrimaryReplicaRouter, ReplicaReadMixin
+
+User = get_user_model()
+
+# debug_toolbar のクエリを数えないようにする
+WITHOUT_DEBUG_TOOLBAR = [name for name in settings.MIDDLEWARE if not name.startswith("debug_toolbar")]
+
+
+class TestSqlitePragmas(TestCase):
+    def pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute(f"PRAGMA {name}")
+            return cursor.fetchone()[0]
+
+    def test_apply_pragmas(self):
+        original = self.pragma("cache_size")
+        with override_settings(SQLITE_PRAGMAS={"cache_size": -1234}):
+            apply_sqlite_pragmas(sender=connection.__class__, connection=connection)
+        self.assertEqual(self.pragma("cache_size"), -1234)
+        with override_settings(SQLITE_PRAGMAS={"cache_size": original}):
+            apply_sqlite_pragmas(sender=connection.__class__, connection=connection)
+
+
+class TestBenchSqliteConcurrency(TestCase):
+    def test_compare_profiles(self):
+        stdout = StringIO()
+        call_command(
+            "bench_sqlite_concurrency", threads=2, duration=0.2, tweets=100, stdout=stdout
+        )
+        lines = stdout.getvalue().splitlines()
+        self.assertTrue(lines[2].startswith("default"))
+        self.assertTrue(lines[3].startswith("production"))
+
+
+class TestBenchViews(TestCase):
+    # テスト用のデータベースはすでにあるので、コマンドが作り直さないようにする
+    @mock.patch("base.management.commands.bench_views.teardown_databases")
+    @mock.patch("base.management.commands.bench_views.setup_databases")
+    def test_report(self, *_):
+        self.addCleanup(cache.clear)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output = os.path.join(tmpdir, "report.json")
+            call_command(
+                "bench_views",
+                users=30,
+                tweets=100,
+                likes=200,
+                follows=3,
+                iterations=2,
+                output=output,
+                stdout=StringIO(),
+            )
+            with open(output) as f:
+                report = json.load(f)
+        self.assertEqual(report["dataset"]["likes"], 200)
+        self.assertEqual(
+            set(report["views"]),
+            {
+                "tweet_list",
+                "user_page_celebrity",
+                "user_page_typical",
+                "follower_list_celebrity",
+                "like_viral_tweet",
+                "user_list",
+                "user_list_search",
+            },
+        )
+        for result in report["views"].values():
+            self.assertEqual(result["status"], 200)
+            self.assertGreater(result["queries"], 0)
+            self.assertLessEqual(result["p50_ms"], result["p95_ms"])
+        # 件数の列は実データから数え直してある
+        celebrity = User.objects.get(username="user000000")
+        self.assertEqual(celebrity.followers_count, FriendShip.objects.filter(follower=celebrity).count())
+
+
+@override_settings(METRICS_TOKEN="secret")
+class TestMetrics(TestCase):
+    def setUp(self):
+        metrics.registry.reset()
+        self.addCleanup(metrics.registry.reset)
+        self.user = User.objects.create_user(username="metrics", email="metrics@co.jp")
+
+    def scrape(self, **headers):
+        return self.client.get(reverse("metrics"), **headers)
+
+    def test_records_view_metrics(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse("tweet:home"))
+        self.client.logout()
+
+        response = self.scrape(HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(response["Content-Type"], metrics.CONTENT_TYPE)
+        body = response.content.decode()
+        self.assertIn('ttter_requests_total{view="tweet:home",method="GET",status="200"} 1\n', body)
+        self.assertIn('ttter_request_duration_seconds_count{view="tweet:home",method="GET"} 1\n', body)
+        self.assertIn('ttter_template_render_seconds_bucket{view="tweet:home",le="+Inf"} 1\n', body)
+        self.assertIn('ttter_db_queries_bucket{view="tweet:home",le="0"} 0\n', body)
+        self.assertIn('ttter_response_size_bytes_count{view="tweet:home"} 1\n', body)
+        self.assertIn("# TYPE ttter_objectcache_lookups_total counter", body)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram("h", "test", ["view"], (1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(("v",), value)
+        self.assertEqual(
+            [(name, labels, value) for name, labels, value in histogram.samples()],
+            [
+                ("h_bucket", '{view="v",le="1"}', 2),
+                ("h_bucket", '{view="v",le="5"}', 3),
+                ("h_bucket", '{view="v",le="+Inf"}', 4),
+                ("h_sum", '{view="v"}', 14.5),
+                ("h_count", '{view="v"}', 4),
+            ],
+        )
+
+    def test_requires_token_or_staff(self):
+        self.assertEqual(self.scrape().status_code, 403)
+        self.assertEqual(self.scrape(HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+        self.client.force_login(self.user)
+        self.assertEqual(self.scrape().status_code, 403)
+        self.user.is_staff = True
+        self.user.save()
+        self.assertEqual(self.scrape().status_code, 200)
+
+
+class TestAsyncMiddleware(TestCase):
+    def setUp(self):
+        metrics.registry.reset()
+        self.addCleanup(metrics.registry.reset)
+        self.enterContext(async_views(True))
+        self.user = User.objects.create_user(username="metrics", email="metrics@co.jp")
+        self.async_client.force_login(self.user)
+
+    def test_middleware_follows_get_response(self):
+        async def async_get_response(request):
+            return HttpResponse()
+
+        for middleware in (MetricsMiddleware, ReplicaRoutingMiddleware, SlowQueryLogMiddleware, ProfilerMiddleware):
+            with self.subTest(middleware=middleware.__name__):
+                self.assertTrue(asyncio.iscoroutinefunction(middleware(async_get_response)))
+                self.assertFalse(asyncio.iscoroutinefunction(middleware(lambda request: HttpResponse())))
+
+    @override_settings(MIDDLEWARE=["base.middleware.MetricsMiddleware"] + WITHOUT_DEBUG_TOOLBAR[1:])
+    async def test_records_async_view_metrics(self):
+        response = await self.async_client.get(reverse("tweet:home"))
+        self.assertEqual(response.status_code, 200)
+        body = metrics.registry.expose()
+        self.assertIn('ttter_requests_total{view="tweet:home",method="GET",status="200"} 1\n', body)
+        # クエリはスレッドで実行されるが、イベントループ側の QueryTimer で数えられる
+        self.assertIn('ttter_db_queries_bucket{view="tweet:home",le="0"} 0\n', body)
+
+    async def test_query_timer_counts_worker_threads(self):
+        with QueryTimer() as queries:
+            # gather_queries が同時に読むときと同じく、別のスレッドの別の接続で実行する
+            await sync_to_async(run_in_own_connection, thread_sensitive=False)(Tweet.objects.exists)
+        self.assertEqual(queries.count, 1)
+
+
+class TestSlowQueryLog(TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, "slow.jsonl")
+        self.enterContext(
+            override_settings(
+                SLOW_QUERY_LOG=self.path,
+                SLOW_QUERY_THRESHOLD_MS=0,
+                MIDDLEWARE=WITHOUT_DEBUG_TOOLBAR + ["base.middleware.SlowQueryLogMiddleware"],
+            )
+        )
+        self.addCleanup(slowqueries.close_log)
+        slowqueries.install_slow_query_log(sender=connection.__class__, connection=connection)
+        self.addCleanup(connection.execute_wrappers.remove, slowqueries.slow_query_wrapper)
+        self.user = User.objects.create_user(username="slow", email="slow@co.jp")
+
+    def read_log(self):
+        slowqueries.close_log()
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_logs_view_frame_and_redacted_params(self):
+        Tweet.objects.create(user=self.user, content="遅い")
+        self.client.force_login(self.user)
+        self.client.get(reverse("accounts:user_page", args=[self.user.username]))
+        entries = [entry for entry in self.read_log() if entry["view"] == "accounts:user_page"]
+        self.assertTrue(entries)
+        # 発行元はミドルウェアではなく、クエリを組み立てたアプリのコード
+        frames = {entry["frame"] for entry in entries if "tweet_likefortweet" in entry["sql"]}
+        self.assertTrue(frames)
+        self.assertTrue(all(frame.startswith("tweet/loaders.py:") for frame in frames), frames)
+        # セッションキーなどの文字列は型と長さだけになる
+        params = [param for entry in entries for param in entry["params"]]
+        self.assertNotIn(self.client.session.session_key, params)
+        self.assertIn("<str:32>", params)
+
+    def test_summarize_groups_by_fingerprint(self):
+        for username in ("slow", "nobody"):
+            User.objects.filter(username=username).first()
+        stdout = StringIO()
+        call_command("summarize_slow_queries", self.path, "--json", stdout=stdout)
+        summary = json.loads(stdout.getvalue())
+        lookup = next(row for row in summary if 'WHERE "accounts_myuser"."username" = ?' in row["fingerprint"])
+        self.assertEqual(lookup["count"], 2)
+        self.assertTrue(lookup["frames"])
+
+    def test_log_path_only_substitutes_pid(self):
+        path = os.path.join(os.path.dirname(self.path), "{0}-{x}-{pid}.jsonl")
+        with override_settings(SLOW_QUERY_LOG=path):
+            self.assertEqual(slowqueries.log_path(), path.replace("{pid}", str(os.getpid())))
+
+
+class TestProfiler(TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.directory = tmpdir.name
+        self.enterContext(
+            override_settings(
+                PROFILE_DIR=self.directory,
+                PROFILE_MAX_FILES=2,
+                PROFILE_SAMPLE_RATE=1,
+                PROFILE_SLOW_MS=None,
+                MIDDLEWARE=WITHOUT_DEBUG_TOOLBAR + ["base.middleware.ProfilerMiddleware"],
+            )
+        )
+        self.user = User.objects.create_user(username="profiled", email="profiled@co.jp")
+        Tweet.objects.create(user=self.user, content="計測される")
+        self.client.force_login(self.user)
+
+    def test_dumps_are_bounded_and_user_agnostic(self):
+        for _ in range(3):
+            self.client.get(reverse("accounts:user_page", args=[self.user.username]))
+        paths = profiling.profile_paths()
+        self.assertEqual(len(paths), 2)
+        self.assertEqual(len(os.listdir(self.directory)), 4)
+        metadata = profiling.read_metadata(paths[-1])
+        self.assertEqual(metadata["view"], "accounts:user_page")
+        self.assertEqual(metadata["reason"], "sample")
+        self.assertEqual(metadata["route"], "accounts/<str:username>/user_page/")
+        self.assertNotIn(self.user.username, json.dumps(metadata))
+
+    def test_slow_requests_only(self):
+        with override_settings(PROFILE_SAMPLE_RATE=0, PROFILE_SLOW_MS=60 * 1000):
+            self.client.get(reverse("tweet:home"))
+        self.assertEqual(profiling.profile_paths(), [])
+        with override_settings(PROFILE_SAMPLE_RATE=0, PROFILE_SLOW_MS=0):
+            self.client.get(reverse("tweet:home"))
+        (path,) = profiling.profile_paths()
+        self.assertEqual(profiling.read_metadata(path)["reason"], "slow")
+
+    def test_aggregate(self):
+        self.client.get(reverse("tweet:home"))
+        self.client.get(reverse("accounts:userlist"))
+        stdout = StringIO()
+        call_command("aggregate_profiles", view="tweet:home", limit=5, stdout=stdout)
+        lines = stdout.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith("1 profiles"))
+        self.assertTrue(lines[1].startswith("template rendering"))
+        self.assertNotIn(" 0.0%", lines[1])
+
+
+class ReadView(ReplicaReadMixin, View):
+    def get(self, request):
+        return HttpResponse(PrimaryReplicaRouter().db_for_read(User))
+
+    def post(self, request):
+        return HttpResponse(PrimaryReplicaRouter().db_for_read(User))
+
+
+@override_settings(REPLICA_STICKY_SECONDS=5)
+@mock.patch("base.routers.replica_configured", return_value=True)
+class TestReplicaRouting(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="router", email="router@co.jp")
+        self.session = SessionStore()
+        self.middleware = ReplicaRoutingMiddleware(ReadView.as_view())
+
+    def request(self, method):
+        request = getattr(RequestFactory(), method)("/")
+        request.session = self.session
+        request.user = self.user
+        return self.middleware(request)
+
+    def test_read_view_uses_replica(self, _):
+        self.assertEqual(self.request("get").content, b"replica")
+        # ビューの外（ミドルウェアの後）ではプライマリに戻る
+        self.assertEqual(PrimaryReplicaRouter().db_for_read(User), "default")
+
+    def test_write_pins_session_to_primary(self, _):
+        self.assertEqual(self.request("post").content, b"default")
+        self.assertEqual(self.request("get").content, b"default")
+
+        self.session[REPLICA_PINNED_UNTIL_KEY] = time.time() - 1
+        self.assertEqual(self.request("get").content, b"replica")
+
+    def test_writes_go_to_primary(self, _):
+        self.assertEqual(PrimaryReplicaRouter().db_for_write(User), "default")
+        self.assertFalse(PrimaryReplicaRouter().allow_migrate("replica", "tweet"))
+
+
+@override_settings(MIDDLEWARE=WITHOUT_DEBUG_TOOLBAR)
+class TestFingerprint(TestCase):
+    def test_values_are_normalized(self):
+        self.assertEqual(
+            fingerprint('SELECT * FROM "t" WHERE "a" = 1 AND "b" IN (%s, %s, %s) AND "c" = \'x\'  LIMIT 20'),
+            'SELECT * FROM "t" WHERE "a" = ? AND "b" IN (...) AND "c" = ? LIMIT ?',
+        )
+        self.assertEqual(
+            fingerprint('SELECT "id" FROM "t" WHERE "b" IN (%s)'),
+            fingerprint('SELECT "id" FROM "t" WHERE "b" IN (%s, %s)'),
+        )
+
+    def test_recorder_reports_origin(self):
+        User.objects.create_user(username="recorder", email="recorder@co.jp")
+        template = Template("{% for user in users %}\n{{ user.username }}{% endfor %}")
+        with QueryRecorder() as recorder:
+            template.render(Context({"users": User.objects.all()}))
+        (query,) = recorder.queries
+        self.assertTrue(query.template.endswith(":1"))
+        self.assertTrue(query.frame.startswith("base/tests.py:"))
+
+
+# URL 名ごとのクエリ数の上限（メソッド, 上限）。TestQueryBudgets が小さいデータと大きいデータで描画し、
+# 上限を超えたときと、クエリ数がデータ量とともに増えたとき（N+1）に失敗させる
+QUERY_BUDGETS = {
+    "tweet:tweet_create": ("post", 14),
+    "tweet:home": ("get", 4),
+    "tweet:following": ("get", 5),
+    "tweet:search": ("get", 5),
+    "tweet:tweet_detail": ("get", 5),
+    "tweet:tweet_delete": ("post", 10),
+    "tweet:like": ("post", 10),
+    "tweet:unlike": ("post", 7),
+    "tweet:like_batch": ("post", 9),
+    "tweet:api_timeline": ("get", 4),
+    "tweet:api_user_tweets": ("get", 5),
+    "tweet:api_tweet": ("get", 5),
+    "accounts:user_data_input": ("get", 2),
+    "accounts:login": ("get", 2),
+    "accounts:user_page": ("get", 6),
+    "accounts:following_list": ("get", 4),
+    "accounts:follower_list": ("get", 4),
+    "accounts:follow": ("post", 13),
+    "accounts:userlist": ("get", 4),
+    "accounts:user_suggest": ("get", 4),
+    "accounts:unfollow": ("post", 10),
+}
+
+# 上限を設けない URL とその理由
+UNBUDGETED = {
+    "accounts:user_data_confirm": "入力画面からの POST でしか表示されず、既存のデータを読まない",
+    "accounts:user_data_create": "新規登録で、既存のデータ量に関係しない",
+    "accounts:logout": "セッションを消すだけ",
+}
+
+
+@override_settings(MIDDLEWARE=WITHOUT_DEBUG_TOOLBAR)
+class TestQueryBudgets(TestCase):
+    # 大きいデータはどのページも埋まり（ツイートは 2 ページ以上）、いいねやフォローが集中する
+    SMALL = 1
+    LARGE = 45
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.viewer = User.objects.create_user(username="viewer", email="viewer@mail.com")
+        self.author = User.objects.create_user(username="author", email="author@mail.com")
+        self.people = []
+        self.author_tweets = []
+
+    def populate(self, size):
+        """size 人が viewer と相互にフォローし、author は size 件ツイートする。人気のツイートには全員がいいねする。"""
+        tweets = []
+        for i in range(len(self.people), size):
+            if i == 0:
+                person = self.author
+            else:
+                person = User.objects.create_user(username=f"user{i}", email=f"user{i}@mail.com")
+            FriendShip.objects.follow(followee=self.viewer, follower=person)
+            FriendShip.objects.follow(followee=person, follower=self.viewer)
+            if person != self.author:
+                FriendShip.objects.follow(followee=person, follower=self.author)
+                tweets.append(Tweet.objects.create(user=person, content=f"{person.username}のツイート"))
+            self.people.append(person)
+        new_tweets = [
+            Tweet.objects.create(user=self.author, content=f"ツイート{i}")
+            for i in range(len(self.author_tweets), size)
+        ]
+        self.author_tweets += new_tweets
+        for i, tweet in enumerate(new_tweets):
+            if i % 2 == 0:
+                LikeForTweet.objects.like(self.viewer, tweet)
+        popular = self.author_tweets[0]
+        for person in self.people:
+            if not LikeForTweet.objects.filter(user=person, tweet=popular).exists():
+                LikeForTweet.objects.like(person, popular)
+        call_command("recompute_user_counts", stdout=StringIO())
+        for tweet in tweets + new_tweets:
+            timeline.fan_out(Tweet.objects.get(pk=tweet.pk))
+
+    def request_for(self, name):
+        """URL 名に対して送るリクエスト（URL とデータ）。書き込みの対象はその都度作る。"""
+        popular = self.author_tweets[0]
+        if name in ("tweet:tweet_detail", "tweet:api_tweet"):
+            return reverse(name, kwargs={"pk": popular.pk}), None
+        if name == "tweet:tweet_delete":
+            tweet = Tweet.objects.create(user=self.viewer, content="消す")
+            return reverse(name, kwargs={"pk": tweet.pk}), None
+        if name == "tweet:like":
+            tweet = Tweet.objects.create(user=self.author, content="いいねする")
+            return reverse(name, kwargs={"pk": tweet.pk}), None
+        if name == "tweet:unlike":
+            tweet = Tweet.objects.create(user=self.author, content="いいねを外す")
+            LikeForTweet.objects.like(self.viewer, tweet)
+            return reverse(name, kwargs={"pk": tweet.pk}), None
+        if name == "tweet:like_batch":
+            # 操作の数もデータの大きさに合わせて増やす
+            tweets = [Tweet.objects.create(user=self.author, content="まとめていいねする") for _ in self.people]
+            operations = [{"tweet_id": str(tweet.pk), "liked": True} for tweet in tweets]
+            return reverse(name), json.dumps({"operations": operations})
+        if name == "tweet:tweet_create":
+            return reverse(name), {"content": "新しいツイート"}
+        if name == "tweet:search":
+            return reverse(name) + "?q=ツイート", None
+        if name in ("accounts:userlist", "accounts:user_suggest"):
+            return reverse(name) + "?q=user", None
+        if name in ("tweet:api_user_tweets", "accounts:following_list", "accounts:follower_list"):
+            return reverse(name, kwargs={"username": self.author.username}), None
+        if name == "accounts:user_page":
+            return reverse(name, kwargs={"username": self.author.username}), None
+        if name == "accounts:follow":
+            username = f"new{len(self.people)}"
+            person = User.objects.create_user(username=username, email=f"{username}@mail.com")
+            return reverse(name, kwargs={"username": person.username}), None
+        if name == "accounts:unfollow":
+            return reverse(name, kwargs={"username": self.people[-1].username}), None
+        return reverse(name), None
+
+    def measure(self, name, method):
+        path, data = self.request_for(name)
+        self.client.force_login(self.viewer)
+        # キャッシュに載っていない状態で数える
+        cache.clear()
+        kwargs = {"content_type": "application/json"} if isinstance(data, str) else {}
+        with QueryRecorder() as recorder:
+            response = getattr(self.client, method)(path, data, **kwargs)
+        self.assertLess(response.status_code, 400, f"{method.upper()} {path}")
+        return recorder
+
+    def report(self, name, budget, small, large):
+        lines = [
+            f"{name}: {len(large)} queries with the large fixture, {len(small)} with the small one (budget {budget})"
+        ]
+        small_counts = Counter(query.fingerprint for query in small.queries)
+        growth = [
+            (sql, count - small_counts[sql])
+            for sql, count in Counter(query.fingerprint for query in large.queries).items()
+            if count > small_counts[sql]
+        ]
+        # データ量とともに増えたクエリがなければ、大きいデータのクエリをすべて出す
+        for sql, extra in growth or Counter(query.fingerprint for query in large.queries).items():
+            query = next(query for query in large.queries if query.fingerprint == sql)
+            origin = ", ".join(filter(None, [query.template, query.frame])) or "unknown"
+            lines.append(f"  {'+' if growth else ''}{extra} x {sql[:300]}\n      at {origin}")
+        return "\n".join(lines)
+
+    def test_every_route_has_a_budget(self):
+        names = {
+            f"{urls.app_name}:{pattern.name}"
+            for urls in (tweet_urls, accounts_urls)
+            for pattern in urls.urlpatterns
+            if pattern.name
+        }
+        self.assertEqual(names - set(QUERY_BUDGETS) - set(UNBUDGETED), set())
+        self.assertEqual((set(QUERY_BUDGETS) | set(UNBUDGETED)) - names, set())
+
+    def test_query_budgets(self):
+        self.populate(self.SMALL)
+        small = {name: self.measure(name, method) for name, (method, _) in QUERY_BUDGETS.items()}
+        self.populate(self.LARGE)
+        large = {name: self.measure(name, method) for name, (method, _) in QUERY_BUDGETS.items()}
+        for name, (_, budget) in QUERY_BUDGETS.items():
+            with self.subTest(name):
+                if len(large[name]) > min(budget, len(small[name])):
+                    self.fail(self.report(name, budget, small[name], large[name]))
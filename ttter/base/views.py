@@ -1,7 +1,25 @@
-from django.views.generic import TemplateView
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+from django.views.generic import TemplateView, View
+
+from . import metrics
 
 
 class TopView(TemplateView):
     template_name = "base/top.html"
 
 
+class MetricsView(View):
+    """Prometheus のテキスト形式の計測値。METRICS_TOKEN の Bearer トークンか、スタッフのログインで読める。"""
+
+    def get(self, request, *args, **kwargs):
+        if not self.is_allowed(request):
+            return HttpResponseForbidden()
+        return HttpResponse(metrics.registry.expose(), content_type=metrics.CONTENT_TYPE)
+
+    def is_allowed(self, request):
+        token = settings.METRICS_TOKEN
+        if token and constant_time_compare(request.headers.get("Authorization", ""), f"Bearer {token}"):
+            return True
+        return request.user.is_staff
@@ -10,31 +10,96 @@ const getCookie = (name) => {
 };
 const csrftoken = getCookie('csrftoken');
 
-const LikeAction = async (tweet) => {
-    const url = tweet.dataset.url;
-    const data = {
-        method: "POST",
-        headers: {
-            "Content-Type": "application/json",
-            "X-CSRFToken": csrftoken,
-        },
+const BATCH_URL = '/like/batch/';
+// 連打をまとめるため、最後のクリックからこの時間だけ待って送信する
+const FLUSH_DELAY = 300;
+
+// 送信待ちの操作 (tweet_id => いいねするか)、最後にサーバーへ送った状態、サーバーで確定した状態
+const pending = new Map();
+const sent = new Map();
+const confirmed = new Map();
+let flushTimer = null;
+let flushing = false;
+
+const LikeAction = (tweet) => {
+    const tweetId = tweet.dataset.tweetId;
+    const liked = tweet.dataset.liked === 'true';
+    const count = document.querySelector(`[name="count_${tweetId}"]`);
+    if (!confirmed.has(tweetId)) {
+        confirmed.set(tweetId, {tweet_id: tweetId, is_liked: liked, liked_count: Number(count.innerHTML)});
+        sent.set(tweetId, liked);
+    }
+    // 応答を待たずに表示を切り替える
+    changeStyle({
+        tweet_id: tweetId,
+        is_liked: !liked,
+        liked_count: Math.max(Number(count.innerHTML) + (liked ? -1 : 1), 0),
+    });
+    pending.set(tweetId, !liked);
+    clearTimeout(flushTimer);
+    flushTimer = setTimeout(flushLikes, FLUSH_DELAY);
+}
+
+const flushLikes = async () => {
+    // 送信は 1 つずつ行う。送信中のクリックは、応答の後に続けて送る
+    if (flushing) {
+        return;
+    }
+    flushing = true;
+    try {
+        while (pending.size > 0) {
+            const operations = [...pending].map(([tweet_id, liked]) => ({tweet_id, liked}));
+            pending.clear();
+            // 最後に送った状態に戻っただけの操作は送らない（送信中のものは、まだ確定していなくても送った状態と比べる）
+            const changed = operations.filter((op) => sent.get(op.tweet_id) !== op.liked);
+            if (changed.length > 0) {
+                await sendLikes(changed);
+            }
+        }
+    } finally {
+        flushing = false;
     }
-    const response = await fetch(url, data);
-    const tweet_data = await response.json();
-    changeStyle(tweet_data, tweet);
 }
 
-const changeStyle = (tweet_data, selector) => {
-    const count = document.querySelector(`[name="count_${tweet_data.tweet_id}"]`)
-    if (tweet_data.is_liked) {
-        const unlike_url = `/unlike/${tweet_data.tweet_id}/`
-        selector.setAttribute('data-url', unlike_url);
-        selector.innerHTML = "いいね解除";
-        count.innerHTML = tweet_data.liked_count;
-    } else {
-        const like_url = `/like/${tweet_data.tweet_id}/`
-        selector.setAttribute('data-url', like_url);
-        selector.innerHTML = "いいね";
-        count.innerHTML = tweet_data.liked_count;
+const sendLikes = async (operations) => {
+    for (const op of operations) {
+        sent.set(op.tweet_id, op.liked);
     }
+    try {
+        const response = await fetch(BATCH_URL, {
+            method: "POST",
+            headers: {
+                "Content-Type": "application/json",
+                "X-CSRFToken": csrftoken,
+            },
+            body: JSON.stringify({operations}),
+        });
+        if (!response.ok) {
+            throw new Error(response.statusText);
+        }
+        const data = await response.json();
+        for (const tweet_data of data.tweets) {
+            confirmed.set(tweet_data.tweet_id, tweet_data);
+            // 送信中に再びクリックされたツイートは表示を上書きしない
+            if (!pending.has(tweet_data.tweet_id)) {
+                changeStyle(tweet_data);
+            }
+        }
+    } catch (error) {
+        // 失敗したら確定済みの状態に戻す
+        for (const op of operations) {
+            sent.set(op.tweet_id, confirmed.get(op.tweet_id).is_liked);
+            if (!pending.has(op.tweet_id)) {
+                changeStyle(confirmed.get(op.tweet_id));
+            }
+        }
+    }
+}
+
+const changeStyle = (tweet_data) => {
+    const selector = document.getElementById(`tweet_${tweet_data.tweet_id}`);
+    const count = document.querySelector(`[name="count_${tweet_data.tweet_id}"]`);
+    selector.setAttribute('data-liked', tweet_data.is_liked);
+    selector.innerHTML = tweet_data.is_liked ? "いいね解除" : "いいね";
+    count.innerHTML = tweet_data.liked_count;
 }
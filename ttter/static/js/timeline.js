@@ -0,0 +1,56 @@
+// タイムラインの先頭ページで、新しいツイートといいね数の変化をサーバーから受け取って反映する (tweet/events.py)
+const tweetList = document.getElementById('tweet_list');
+
+const element = (tag, properties = {}, children = []) => {
+    const node = Object.assign(document.createElement(tag), properties);
+    node.append(...children);
+    return node;
+};
+
+// tweet_card.html と同じ構造のカードを作る（本文などは textContent で入れる）
+const tweetCard = (tweet) => {
+    const count = element('span', {className: 'count', textContent: tweet.like_count});
+    count.setAttribute('name', `count_${tweet.id}`);
+    const button = element('button', {id: `tweet_${tweet.id}`, textContent: 'いいね', onclick: () => LikeAction(button)});
+    Object.assign(button.dataset, {tweetId: tweet.id, liked: 'false'});
+    return element('p', {}, [
+        element('div', {className: 'frame_tweet'}, [
+            element('div', {}, [
+                element('p', {textContent: tweet.user}),
+                element('p', {textContent: new Date(tweet.created_at).toLocaleString()}),
+                element('a', {href: tweet.url, textContent: tweet.content}),
+                count,
+                button,
+            ]),
+        ]),
+    ]);
+};
+
+if (tweetList && window.EventSource) {
+    const source = new EventSource(tweetList.dataset.streamUrl);
+
+    source.addEventListener('tweet', (event) => {
+        const tweet = JSON.parse(event.data);
+        if (!document.getElementById(`tweet_${tweet.id}`)) {
+            tweetList.prepend(tweetCard(tweet));
+        }
+    });
+
+    source.addEventListener('like', (event) => {
+        const data = JSON.parse(event.data);
+        const count = document.querySelector(`[name="count_${data.tweet_id}"]`);
+        // 自分の操作の送信待ちの間は、like.js の楽観的な表示を優先する
+        if (count && !pending.has(data.tweet_id)) {
+            count.textContent = data.like_count;
+        }
+    });
+
+    // 受け取りが追いつかずに更新を取りこぼした。サーバーが閉じた接続は EventSource が張り直す
+    source.addEventListener('resync', () => {
+        if (!document.getElementById('timeline_resync')) {
+            tweetList.before(element('p', {id: 'timeline_resync'}, [
+                element('a', {href: location.pathname, textContent: '新しい更新があります。再読み込みしてください'}),
+            ]));
+        }
+    });
+}
@@ -13,4 +13,16 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ttter.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Django の初期化 (get_asgi_application) の後に読み込む
+from django.conf import settings  # noqa: E402
+
+from tweet.events import stream_application  # noqa: E402
+
+
+async def application(scope, receive, send):
+    # タイムラインのストリームは、接続ごとにスレッドを使わないよう Django を通さずに扱う
+    if settings.TWEET_STREAM and scope["type"] == "http" and scope["path"] == settings.TWEET_STREAM_PATH:
+        return await stream_application(scope, receive, send)
+    return await django_application(scope, receive, send)
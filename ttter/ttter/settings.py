@@ -44,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "base.middleware.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -84,6 +85,83 @@ DATABASES = {
     }
 }
 
+# TTTER_DB_PROFILE=production で、接続ごとに下の PRAGMA を設定し (base.db.apply_sqlite_pragmas)、接続を使い回す
+SQLITE_PRODUCTION_PRAGMAS = {
+    # 読み込みが書き込みを待たないように WAL にする（ファイルに記録され、以降も WAL のまま）
+    "journal_mode": "wal",
+    # WAL ではコミットごとの fsync を省いても壊れない（電源断で直前のコミットが失われうる）
+    "synchronous": "normal",
+    # ロック中は即座に "database is locked" にせず、ミリ秒単位で待つ
+    "busy_timeout": 5000,
+    "mmap_size": 256 * 1024 * 1024,
+    # 負の値は KiB 単位（64 MiB）
+    "cache_size": -64 * 1024,
+    "temp_store": "memory",
+}
+
+if os.environ.get("TTTER_DB_PROFILE") == "production":
+    SQLITE_PRAGMAS = SQLITE_PRODUCTION_PRAGMAS
+    DATABASES["default"].update(
+        {
+            # CONN_HEALTH_CHECKS は付けない（Django 4.0 にはなく、SQLite の接続は is_usable() が常に True で検査にならない）
+            "CONN_MAX_AGE": int(os.environ.get("TTTER_CONN_MAX_AGE", 600)),
+            "OPTIONS": {"timeout": 5},
+        }
+    )
+else:
+    SQLITE_PRAGMAS = {}
+
+DATABASE_ROUTERS = []
+
+# TTTER_REPLICA_NAME に SQLite ファイルを指定すると、読み込み専用のビューをそこから読む。
+# 手元では sync_replica でプライマリを定期的にコピーして、複製の遅れを再現する。
+if os.environ.get("TTTER_REPLICA_NAME"):
+    DATABASES["replica"] = {
+        **DATABASES["default"],
+        "NAME": os.environ["TTTER_REPLICA_NAME"],
+        "TEST": {"MIRROR": "default"},
+    }
+    DATABASE_ROUTERS.append("base.routers.PrimaryReplicaRouter")
+    MIDDLEWARE.append("base.middleware.ReplicaRoutingMiddleware")
+
+# 書き込んだセッションをプライマリから読ませる秒数（複製の遅れより長くする）
+REPLICA_STICKY_SECONDS = int(os.environ.get("TTTER_REPLICA_STICKY_SECONDS", 5))
+
+# TTTER_TWEET_SHARDS=N (N >= 2) で、ツイートといいねを投稿者ごとに N 個の SQLite ファイルに分ける (tweet.shards)。
+# 各シャードは migrate --database shardN で作る。シャードは末尾にだけ足し、rebalance_tweet_shards で移す
+TWEET_SHARDS = []
+if int(os.environ.get("TTTER_TWEET_SHARDS", 1)) > 1:
+    TWEET_SHARDS.append("default")
+    for i in range(1, int(os.environ["TTTER_TWEET_SHARDS"])):
+        DATABASES[f"shard{i}"] = {**DATABASES["default"], "NAME": os.path.join(BASE_DIR, f"db_shard{i}.sqlite3")}
+        TWEET_SHARDS.append(f"shard{i}")
+    DATABASE_ROUTERS.insert(0, "tweet.shards.TweetShardRouter")
+else:
+    # 分割しないときも shard1 を定義しておき、テストが override_settings(TWEET_SHARDS=...) で分割を試せるようにする
+    # （TWEET_SHARDS に入れなければ使われず、接続しない限りファイルも作られない）
+    DATABASES["shard1"] = {**DATABASES["default"], "NAME": os.path.join(BASE_DIR, "db_shard1.sqlite3")}
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+# 既定はプロセス内のメモリ。TTTER_CACHE=file で単一ホストの複数プロセスから共有できるファイルキャッシュにする
+
+if os.environ.get("TTTER_CACHE") == "file":
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": os.environ.get("TTTER_CACHE_DIR", os.path.join(BASE_DIR, "cache")),
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "ttter",
+            "OPTIONS": {"MAX_ENTRIES": 10000},
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
@@ -130,6 +208,61 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 AUTH_USER_MODEL = "accounts.MyUser"
 
+# Home timeline
+# "fanout": 書き込み時に配ったタイムラインを読む / "pull": フォロー中のユーザーごとに読んでマージする
+TIMELINE_ENGINE = "fanout"
+# フォロワーがこの数を超えるアカウントは書き込み時に配らず、読み込み時にマージする
+TIMELINE_FANOUT_THRESHOLD = 1000
+# フォローした直後にタイムラインへ書き込む相手のツイート数
+TIMELINE_BACKFILL_SIZE = 100
+
+# Async views
+# https://docs.djangoproject.com/en/4.0/topics/async/
+# TTTER_ASYNC_VIEWS=1 で、タイムライン・いいね・ユーザーページを async ビューにする（ASGI で動かすとき用）
+ASYNC_VIEWS = os.environ.get("TTTER_ASYNC_VIEWS") == "1"
+# async ビューで、互いに依存しないクエリを別々の接続で同時に実行する
+ASYNC_CONCURRENT_QUERIES = True
+
+# Live timeline (Server-Sent Events)
+# TTTER_TWEET_STREAM=1 で、ASGI (ttter.asgi) から新しいツイートといいね数の変化を送る (tweet.events)。
+# ハブはプロセス内なので、ワーカーは 1 つで動かす
+TWEET_STREAM = os.environ.get("TTTER_TWEET_STREAM") == "1"
+TWEET_STREAM_PATH = "/stream/tweets/"
+# 同時に開けるストリームの上限（超えたら 503）
+TWEET_STREAM_MAX_STREAMS = int(os.environ.get("TTTER_TWEET_STREAM_MAX_STREAMS", 5000))
+# 接続ごとに溜めるイベント数。あふれたクライアントには resync を送って閉じる
+TWEET_STREAM_QUEUE_SIZE = 100
+# 何も送らない時間がこの秒数続いたら、プロキシに切られないようコメント行を送る
+TWEET_STREAM_HEARTBEAT_SECONDS = 15
+
+# Metrics
+# base.middleware.MetricsMiddleware がプロセス内で集計し、/metrics で Prometheus のテキスト形式で出す。
+# Prometheus からは Authorization: Bearer <TTTER_METRICS_TOKEN> で読む（未設定ならスタッフのログインでだけ読める）
+METRICS_TOKEN = os.environ.get("TTTER_METRICS_TOKEN")
+
+# Slow query log
+# TTTER_SLOW_QUERY_LOG にファイルを指定すると、しきい値を超えたクエリを URL 名と発行元の行とともに
+# JSON Lines で書く (base.slowqueries)。集計は summarize_slow_queries。
+# ワーカーが複数なら "slow-{pid}.jsonl" のようにプロセスごとのファイルにする
+SLOW_QUERY_LOG = os.environ.get("TTTER_SLOW_QUERY_LOG")
+SLOW_QUERY_THRESHOLD_MS = float(os.environ.get("TTTER_SLOW_QUERY_THRESHOLD_MS", 100))
+SLOW_QUERY_LOG_MAX_BYTES = 10 * 1024 * 1024
+SLOW_QUERY_LOG_BACKUP_COUNT = 5
+if SLOW_QUERY_LOG:
+    MIDDLEWARE.append("base.middleware.SlowQueryLogMiddleware")
+
+# Profiling
+# TTTER_PROFILE_SAMPLE_RATE (0〜1) の割合のリクエストと、TTTER_PROFILE_SLOW_MS を超えたリクエストを cProfile で計測し、
+# PROFILE_DIR に書く (base.profiling)。集計は aggregate_profiles。
+# PROFILE_SLOW_MS を指定すると、遅いかどうかを知るため全リクエストをプロファイラーの下で動かすので、調査の間だけ使う
+PROFILE_SAMPLE_RATE = float(os.environ.get("TTTER_PROFILE_SAMPLE_RATE", 0))
+PROFILE_SLOW_MS = float(os.environ["TTTER_PROFILE_SLOW_MS"]) if os.environ.get("TTTER_PROFILE_SLOW_MS") else None
+PROFILE_DIR = os.environ.get("TTTER_PROFILE_DIR", os.path.join(BASE_DIR, "profiles"))
+# これを超えたら古いものから消す
+PROFILE_MAX_FILES = 500
+if PROFILE_SAMPLE_RATE or PROFILE_SLOW_MS is not None:
+    MIDDLEWARE.append("base.middleware.ProfilerMiddleware")
+
 LOGIN_URL = "accounts:login"
 LOGIN_REDIRECT_URL = "tweet:home"
 LOGOUT_REDIRECT_URL = "base:top"
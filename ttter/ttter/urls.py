@@ -17,8 +17,11 @@ from django.contrib import admin
 from django.urls import include, path
 from django.conf import settings
 
+from base.views import MetricsView
+
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("metrics", MetricsView.as_view(), name="metrics"),
     path("accounts/", include("accounts.urls")),
     path("", include("tweet.urls")),
     path("base", include("base.urls")),
@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
 
 
 class TweetConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'tweet'
+
+    def ready(self):
+        from . import shards, signals  # noqa: F401
+
+        connection_created.connect(shards.disable_foreign_keys, dispatch_uid="tweet.shards.disable_foreign_keys")
+        post_migrate.connect(
+            shards.disable_foreign_keys_after_migrate, dispatch_uid="tweet.shards.disable_foreign_keys_after_migrate"
+        )
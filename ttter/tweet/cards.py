@@ -0,0 +1,39 @@
+import time
+
+from django.core.cache import cache
+
+# ツイートカードのフラグメントキャッシュ ({% cache %}) のキーに含めるバージョン。
+# いいね・いいね解除・削除で上げると、古いフラグメントは参照されなくなる。
+
+
+def version_key(tweet_id):
+    return f"tweet_card_version:{tweet_id}"
+
+
+def new_version():
+    # バージョンが追い出された後に古いフラグメントを拾わないよう、時刻から作る
+    return time.time_ns() // 1000
+
+
+def attach_card_versions(tweets):
+    tweets = list(tweets)
+    keys = {tweet.pk: version_key(tweet.pk) for tweet in tweets}
+    versions = cache.get_many(keys.values())
+    missing = {key: new_version() for key in keys.values() if key not in versions}
+    if missing:
+        cache.set_many(missing, timeout=None)
+        versions.update(missing)
+    for tweet in tweets:
+        tweet.card_version = versions[keys[tweet.pk]]
+    return tweets
+
+
+def bump_card_version(tweet_id):
+    try:
+        cache.incr(version_key(tweet_id))
+    except ValueError:
+        cache.set(version_key(tweet_id), new_version(), timeout=None)
+
+
+def bump_card_versions(tweet_ids):
+    cache.set_many({version_key(tweet_id): new_version() for tweet_id in tweet_ids}, timeout=None)
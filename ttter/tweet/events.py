@@ -0,0 +1,213 @@
+"""新しいツイートといいね数の変化を、接続中のクライアントに Server-Sent Events で送る。
+
+ハブはプロセス内にあるので、ASGI のワーカーは 1 つにする（別のプロセスで作られたツイートは届かない）。
+待機中のクライアントはイベントループ上のコルーチンとキューだけで、スレッドも DB 接続も持たない。
+"""
+import asyncio
+import json
+import threading
+from functools import partial
+from http.cookies import SimpleCookie
+from importlib import import_module
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.urls import reverse
+
+from base.asyncviews import gather_queries
+
+# 遅いクライアントのキューがあふれたときに送り、ストリームを閉じる（クライアントは再接続して読み直す）
+RESYNC = b"event: resync\ndata: {}\n\n"
+HEARTBEAT = b": heartbeat\n\n"
+
+
+class TooManyStreams(Exception):
+    pass
+
+
+def format_event(event, data):
+    payload = json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False, separators=(",", ":"))
+    return f"event: {event}\ndata: {payload}\n\n".encode()
+
+
+class Subscription:
+    def __init__(self, queue_size):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(queue_size)
+        self.overflowed = False
+
+    def push(self, message):
+        # イベントループのスレッドで呼ばれる
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def next_message(self, heartbeat):
+        """次に送るメッセージ。heartbeat 秒何もなければ HEARTBEAT、あふれた後は RESYNC。"""
+        if self.overflowed:
+            return RESYNC
+        try:
+            return await asyncio.wait_for(self.queue.get(), heartbeat)
+        except asyncio.TimeoutError:
+            return HEARTBEAT
+
+
+class EventHub:
+    """どのスレッドからでも publish でき、購読者のイベントループに call_soon_threadsafe で渡す。
+
+    購読者はループごとにまとめ、1 イベントにつきループを起こすのは 1 回だけにする。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(subscriptions) for subscriptions in self.subscriptions.values())
+
+    def subscribe(self, max_streams, queue_size):
+        subscription = Subscription(queue_size)
+        with self.lock:
+            if sum(len(subscriptions) for subscriptions in self.subscriptions.values()) >= max_streams:
+                raise TooManyStreams
+            self.subscriptions.setdefault(subscription.loop, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.loop, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.subscriptions.pop(subscription.loop, None)
+
+    def publish(self, event, data):
+        with self.lock:
+            targets = [(loop, list(subscriptions)) for loop, subscriptions in self.subscriptions.items()]
+        if not targets:
+            return
+        message = format_event(event, data)
+        for loop, subscriptions in targets:
+            try:
+                loop.call_soon_threadsafe(self.deliver, subscriptions, message)
+            except RuntimeError:
+                # ループが閉じている（そのワーカーは終了した）
+                with self.lock:
+                    self.subscriptions.pop(loop, None)
+
+    @staticmethod
+    def deliver(subscriptions, message):
+        for subscription in subscriptions:
+            subscription.push(message)
+
+
+hub = EventHub()
+
+
+def publish_on_commit(event, data):
+    if settings.TWEET_STREAM:
+        transaction.on_commit(partial(hub.publish, event, data))
+
+
+def publish_tweet(tweet):
+    publish_on_commit(
+        "tweet",
+        {
+            "id": tweet.id,
+            "user": tweet.user.username,
+            "content": tweet.content,
+            "created_at": tweet.created_at,
+            "like_count": tweet.like_count,
+            "url": reverse("tweet:tweet_detail", kwargs={"pk": tweet.pk}),
+        },
+    )
+
+
+def publish_like_count(tweet_id, like_count):
+    publish_on_commit("like", {"tweet_id": tweet_id, "like_count": like_count})
+
+
+def stream_url(request, cursor_kwarg="cursor"):
+    """タイムラインの先頭ページを見ているときだけ、ストリームの URL を返す。"""
+    if settings.TWEET_STREAM and not request.GET.get(cursor_kwarg):
+        return settings.TWEET_STREAM_PATH
+    return None
+
+
+async def authenticate(scope):
+    cookie = SimpleCookie()
+    for name, value in scope["headers"]:
+        if name == b"cookie":
+            cookie.load(value.decode("latin-1"))
+    session_key = cookie[settings.SESSION_COOKIE_NAME].value if settings.SESSION_COOKIE_NAME in cookie else None
+    request = SimpleNamespace(session=import_module(settings.SESSION_ENGINE).SessionStore(session_key))
+    (user,) = await gather_queries(partial(get_user, request))
+    return user
+
+
+async def send_error(send, status, text, headers=()):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"text/plain; charset=utf-8"), *headers],
+        }
+    )
+    await send({"type": "http.response.body", "body": text.encode()})
+
+
+async def stream_application(scope, receive, send):
+    """TWEET_STREAM_PATH の ASGI アプリケーション（ttter.asgi が Django の前で振り分ける）。
+
+    Django 4.0 の ASGI ハンドラーは StreamingHttpResponse を同期のイテレーターとしてイベントループの中で回すので、
+    イベントを待つストリームには使えない。
+    """
+    if scope["method"] != "GET":
+        return await send_error(send, 405, "Method Not Allowed", [(b"allow", b"GET")])
+    user = await authenticate(scope)
+    if not user.is_authenticated:
+        return await send_error(send, 403, "Forbidden")
+    try:
+        subscription = hub.subscribe(settings.TWEET_STREAM_MAX_STREAMS, settings.TWEET_STREAM_QUEUE_SIZE)
+    except TooManyStreams:
+        return await send_error(send, 503, "Too many streams", [(b"retry-after", b"30")])
+
+    async def stream():
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"content-type", b"text/event-stream"),
+                    (b"cache-control", b"no-cache"),
+                    # nginx などのプロキシにバッファさせない
+                    (b"x-accel-buffering", b"no"),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": b"retry: 5000\n\n", "more_body": True})
+        while True:
+            message = await subscription.next_message(settings.TWEET_STREAM_HEARTBEAT_SECONDS)
+            await send({"type": "http.response.body", "body": message, "more_body": message is not RESYNC})
+            if message is RESYNC:
+                return
+
+    async def wait_for_disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    tasks = [asyncio.ensure_future(stream()), asyncio.ensure_future(wait_for_disconnect())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        hub.unsubscribe(subscription)
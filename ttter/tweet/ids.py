@@ -0,0 +1,42 @@
+"""時刻順に並ぶ 128 ビットの id (UUID version 7, RFC 9562)。
+
+先頭 48 ビットが Unix 時刻のミリ秒なので、新しいツイートは主キーのインデックスの末尾に追記され、
+id の大小がそのまま作成順になる。UUID なので <uuid:pk> の URL もそのまま使える。
+"""
+import datetime
+import os
+import random
+import threading
+import time
+import uuid
+
+_lock = threading.Lock()
+_last_ms = 0
+_last_seq = 0
+
+# 同じミリ秒の中では rand_a (12 ビット) を連番にする。最初の値は上位 1 ビットを空けて乱数で決める
+SEQ_BITS = 12
+SEQ_START_BITS = SEQ_BITS - 1
+
+
+def uuid7():
+    global _last_ms, _last_seq
+    with _lock:
+        ms = time.time_ns() // 1_000_000
+        if ms <= _last_ms:
+            # 同じミリ秒（または時計の巻き戻り）では直前の id より大きくする
+            ms, seq = _last_ms, _last_seq + 1
+            if seq >> SEQ_BITS:
+                ms, seq = ms + 1, random.getrandbits(SEQ_START_BITS)
+        else:
+            seq = random.getrandbits(SEQ_START_BITS)
+        _last_ms, _last_seq = ms, seq
+    rand_b = int.from_bytes(os.urandom(8), "big") & ((1 << 62) - 1)
+    return uuid.UUID(int=(ms << 80) | (0x7 << 76) | (seq << 64) | (0b10 << 62) | rand_b)
+
+
+def datetime_of(value):
+    """version 7 の id に含まれる作成時刻。それ以外 (uuid4 など) は None。"""
+    if value.version != 7:
+        return None
+    return datetime.datetime.fromtimestamp((value.int >> 80) / 1000, tz=datetime.timezone.utc)
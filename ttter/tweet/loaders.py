@@ -0,0 +1,28 @@
+from . import shards
+from .cards import attach_card_versions
+from .models import LikeForTweet
+
+
+def attach_like_state(tweets, user):
+    """表示するツイートだけを対象に、閲覧ユーザーのいいね状態を is_liked に設定する。
+
+    ページ内のツイート id で 1 回だけ IN 検索するので、閲覧者のいいね総数には依存しない。
+    """
+    tweets = list(tweets)
+    liked = set()
+    if user.is_authenticated and tweets:
+        # いいねはツイートと同じシャードにあるので、シャードごとに検索する
+        for db, group in shards.group_by_shard(tweets).items():
+            liked.update(
+                LikeForTweet.objects.using(db)
+                .filter(user=user, tweet__in=[tweet.pk for tweet in group])
+                .values_list("tweet", flat=True)
+            )
+    for tweet in tweets:
+        tweet.is_liked = tweet.pk in liked
+    return tweets
+
+
+def prepare_tweets(tweets, user):
+    # 一覧で描画するツイートに、閲覧者のいいね状態とカードのキャッシュバージョンを付ける
+    return attach_card_versions(attach_like_state(tweets, user))
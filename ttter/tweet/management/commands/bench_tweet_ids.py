@@ -0,0 +1,75 @@
+import datetime
+import os
+import sqlite3
+import tempfile
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from tweet.ids import uuid7
+
+GENERATORS = {
+    "uuid4": uuid.uuid4,
+    "uuid7": uuid7,
+}
+
+# tweet_tweet と同じ定義（UUIDField は char(32) の 16 進文字列で、主キーには別にインデックスができる）
+SCHEMA = """
+CREATE TABLE "tweet_tweet" (
+    "id" char(32) NOT NULL PRIMARY KEY,
+    "content" varchar(200) NOT NULL,
+    "created_at" datetime NOT NULL,
+    "user_id" bigint NOT NULL,
+    "like_count" integer unsigned NOT NULL CHECK ("like_count" >= 0)
+);
+CREATE INDEX "tweet_tweet_user_id_705f7b09" ON "tweet_tweet" ("user_id");
+CREATE INDEX "tweet_created_at_id_idx" ON "tweet_tweet" ("created_at" DESC, "id" DESC);
+CREATE INDEX "tweet_user_created_at_idx" ON "tweet_tweet" ("user_id", "created_at" DESC, "id" DESC);
+"""
+
+
+class Command(BaseCommand):
+    help = "ツイートの id を uuid4 と uuid7 で生成したときの INSERT のスループットとインデックスの大きさを比べる"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=200000)
+        parser.add_argument("--batch-size", type=int, default=1000, help="1 トランザクションで INSERT する行数")
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument(
+            "--cache-size", type=int, default=2000, help="SQLite のページキャッシュ (KiB)。小さいほど局所性の差が出る"
+        )
+
+    def handle(self, *args, rows, batch_size, users, cache_size, **options):
+        self.stdout.write(f"rows={rows} batch_size={batch_size} cache_size={cache_size}KiB")
+        self.stdout.write(f"{'id':<8}{'rows/s':>10}{'pk index KiB':>14}{'pk fill %':>11}{'total KiB':>11}")
+        for name, generate in GENERATORS.items():
+            with tempfile.TemporaryDirectory() as tmpdir:
+                conn = sqlite3.connect(os.path.join(tmpdir, "bench.sqlite3"), isolation_level=None)
+                conn.execute(f"PRAGMA cache_size = -{cache_size}")
+                conn.executescript(SCHEMA)
+                elapsed = self.insert(conn, generate, rows, batch_size, users)
+                index_size, index_used = conn.execute(
+                    "SELECT SUM(pgsize), SUM(pgsize - unused) FROM dbstat"
+                    " WHERE name = 'sqlite_autoindex_tweet_tweet_1'"
+                ).fetchone()
+                (total,) = conn.execute("SELECT SUM(pgsize) FROM dbstat").fetchone()
+                conn.close()
+            self.stdout.write(
+                f"{name:<8}{rows / elapsed:>10.0f}{index_size / 1024:>14.0f}"
+                f"{index_used / index_size * 100:>11.1f}{total / 1024:>11.0f}"
+            )
+
+    def insert(self, conn, generate, rows, batch_size, users):
+        started = time.perf_counter()
+        for offset in range(0, rows, batch_size):
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT INTO tweet_tweet (id, content, created_at, user_id, like_count) VALUES (?, ?, ?, ?, 0)",
+                [
+                    (generate().hex, "bench", str(datetime.datetime.utcnow()), (offset + i) % users)
+                    for i in range(min(batch_size, rows - offset))
+                ],
+            )
+            conn.execute("COMMIT")
+        return time.perf_counter() - started
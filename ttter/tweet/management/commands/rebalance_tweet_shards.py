@@ -0,0 +1,75 @@
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from tweet import shards
+from tweet.cards import bump_card_versions
+from tweet.models import LikeForTweet, Tweet, TweetSearchDocument, tweet_cache
+
+
+class Command(BaseCommand):
+    help = "TWEET_SHARDS を変えた後、置き場所が変わった投稿者のツイート・いいね・検索用の文書を新しいシャードに移す"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=500)
+        parser.add_argument("--dry-run", action="store_true")
+        parser.add_argument(
+            "--source",
+            action="append",
+            default=[],
+            help="TWEET_SHARDS から外したシャードのエイリアス（DATABASES には残しておく）",
+        )
+
+    def handle(self, *args, chunk_size, dry_run, source, **options):
+        if not shards.is_sharded():
+            raise CommandError("ツイートのシャードが設定されていません (TTTER_TWEET_SHARDS)。")
+        for alias in source:
+            if alias not in settings.DATABASES:
+                raise CommandError(f"{alias} は DATABASES にありません。")
+
+        moved = Counter()
+        for db in shards.aliases() + source:
+            user_ids = Tweet.objects.using(db).order_by().values_list("user_id", flat=True).distinct()
+            for user_id in list(user_ids):
+                target = shards.for_user(user_id)
+                if target != db:
+                    moved[db, target] += self.move(user_id, db, target, chunk_size, dry_run)
+
+        verb = "would move" if dry_run else "moved"
+        for (db, target), count in sorted(moved.items()):
+            self.stdout.write(f"{verb} {count} tweets from {db} to {target}")
+        if moved and not dry_run:
+            # 移動中に入ったいいねで件数がずれることがある
+            self.stdout.write("run reconcile_like_counts to fix like counts changed during the move")
+
+    def move(self, user_id, source, target, chunk_size, dry_run):
+        if dry_run:
+            return Tweet.objects.using(source).filter(user_id=user_id).count()
+        moved = 0
+        while True:
+            tweets = list(Tweet.objects.using(source).filter(user_id=user_id).order_by("pk")[:chunk_size])
+            if not tweets:
+                break
+            tweet_ids = [tweet.pk for tweet in tweets]
+            likes = list(LikeForTweet.objects.using(source).filter(tweet__in=tweet_ids))
+            documents = list(TweetSearchDocument.objects.using(source).filter(tweet__in=tweet_ids))
+            # いいねと文書の id はシャードごとの連番なので振り直す（文書の id は FTS5 の rowid になる）
+            for obj in likes + documents:
+                obj.pk = None
+
+            # 先に移動先へ書き、途中で止まっても再実行すれば続きから移せるよう、重複は無視する
+            with transaction.atomic(using=target):
+                Tweet.objects.using(target).bulk_create(tweets, ignore_conflicts=True)
+                LikeForTweet.objects.using(target).bulk_create(likes, ignore_conflicts=True)
+                TweetSearchDocument.objects.using(target).bulk_create(documents, ignore_conflicts=True)
+            with transaction.atomic(using=source):
+                # いいねと文書は CASCADE、FTS5 の行はトリガーで消える
+                Tweet.objects.using(source).filter(pk__in=tweet_ids).delete()
+                # 削除で「存在しない」とキャッシュされたのを消し、次の参照で移動先から読ませる
+                tweet_cache.invalidate(*tweet_ids, using=source)
+                # 移動中に件数が変わっていることがあるので、キャッシュされたカードも描き直させる
+                transaction.on_commit(lambda tweet_ids=tweet_ids: bump_card_versions(tweet_ids), using=source)
+            moved += len(tweets)
+        return moved
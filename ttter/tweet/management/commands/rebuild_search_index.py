@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from tweet import search, shards
+from tweet.models import Tweet, TweetSearchDocument
+
+
+class Command(BaseCommand):
+    help = "既存のツイートを全文検索用に索引し、FTS5 テーブルを再構築する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument("--reset", action="store_true", help="索引済みのツイートもバイグラムを作り直す")
+
+    def handle(self, *args, chunk_size, reset, **options):
+        if not search.is_supported():
+            raise CommandError("全文検索は SQLite (FTS5) でのみ利用できます。")
+        created = updated = 0
+        # 検索用の文書と FTS5 テーブルはツイートと同じシャードにある
+        for db in shards.aliases():
+            shard_created, shard_updated = self.index(db, chunk_size, reset)
+            search.rebuild(using=db)
+            created += shard_created
+            updated += shard_updated
+        self.stdout.write(f"indexed {created} tweets, reindexed {updated}")
+
+    def index(self, db, chunk_size, reset):
+        created = updated = 0
+        last_pk = None
+        while True:
+            tweets = Tweet.objects.using(db).order_by("pk").only("pk", "content")
+            if last_pk is not None:
+                tweets = tweets.filter(pk__gt=last_pk)
+            chunk = list(tweets[:chunk_size])
+            if not chunk:
+                break
+            last_pk = chunk[-1].pk
+
+            documents = {
+                document.tweet_id: document
+                for document in TweetSearchDocument.objects.using(db).filter(tweet__in=[tweet.pk for tweet in chunk])
+            }
+            missing = [
+                TweetSearchDocument(tweet=tweet, body=search.tokenize(tweet.content))
+                for tweet in chunk
+                if tweet.pk not in documents
+            ]
+            stale = []
+            if reset:
+                for tweet in chunk:
+                    document = documents.get(tweet.pk)
+                    if document is not None and document.body != search.tokenize(tweet.content):
+                        document.body = search.tokenize(tweet.content)
+                        stale.append(document)
+            with transaction.atomic(using=db):
+                TweetSearchDocument.objects.using(db).bulk_create(missing)
+                TweetSearchDocument.objects.using(db).bulk_update(stale, ["body"])
+            created += len(missing)
+            updated += len(stale)
+        return created, updated
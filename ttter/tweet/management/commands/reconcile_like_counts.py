@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from tweet import shards
+from tweet.cards import bump_card_versions
+from tweet.models import LikeForTweet, Tweet, tweet_cache
+
+
+class Command(BaseCommand):
+    help = "Tweet.like_count を LikeForTweet の実数と突き合わせ、ずれていれば修正する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, chunk_size, dry_run, **options):
+        checked = fixed = 0
+        # いいねはツイートと同じシャードにあるので、シャードごとに突き合わせる
+        for db in shards.aliases():
+            shard_checked, shard_fixed = self.reconcile(db, chunk_size, dry_run)
+            checked += shard_checked
+            fixed += shard_fixed
+
+        verb = "would fix" if dry_run else "fixed"
+        self.stdout.write(f"checked {checked} tweets, {verb} {fixed}")
+
+    def reconcile(self, db, chunk_size, dry_run):
+        checked = fixed = 0
+        last_pk = None
+        while True:
+            tweets = Tweet.objects.using(db).order_by("pk").only("pk", "like_count")
+            if last_pk is not None:
+                tweets = tweets.filter(pk__gt=last_pk)
+            chunk = list(tweets[:chunk_size])
+            if not chunk:
+                break
+            last_pk = chunk[-1].pk
+            checked += len(chunk)
+
+            counts = dict(
+                LikeForTweet.objects.using(db)
+                .filter(tweet__in=[tweet.pk for tweet in chunk])
+                .order_by()
+                .values_list("tweet")
+                .annotate(count=Count("pk"))
+            )
+            drifted = [tweet.pk for tweet in chunk if tweet.like_count != counts.get(tweet.pk, 0)]
+            fixed += len(drifted)
+            if drifted and not dry_run:
+                # 集計と書き込みの間に入ったいいねを取りこぼさないよう、UPDATE 内で数え直す
+                Tweet.objects.using(db).filter(pk__in=drifted).update(
+                    like_count=LikeForTweet.objects.like_count_expression()
+                )
+                tweet_cache.invalidate(*drifted, using=db)
+                # キャッシュされたカードには古い件数が描かれている
+                bump_card_versions(drifted)
+        return checked, fixed
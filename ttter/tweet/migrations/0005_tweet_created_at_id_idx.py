@@ -0,0 +1,17 @@
+# Generated by Django 4.0.2 on 2026-10-18 16:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tweet', '0004_likefortweet_unique_like_for_tweet'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='tweet',
+            index=models.Index(fields=['-created_at', '-id'], name='tweet_created_at_id_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.0.2 on 2026-10-18 16:43
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def populate_like_count(apps, schema_editor):
+    Tweet = apps.get_model('tweet', 'Tweet')
+    LikeForTweet = apps.get_model('tweet', 'LikeForTweet')
+    counts = (
+        LikeForTweet.objects.filter(tweet=OuterRef('pk'))
+        .order_by()
+        .values('tweet')
+        .annotate(count=Count('pk'))
+        .values('count')
+    )
+    Tweet.objects.update(like_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tweet', '0005_tweet_created_at_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tweet',
+            name='like_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='like_count'),
+        ),
+        migrations.RunPython(populate_like_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.0.2 on 2026-10-18 16:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tweet', '0007_timelineentry'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='tweet',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='tweet_user_created_at_idx'),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 4.0.2 on 2026-10-18 16:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# 既存のツイートは manage.py rebuild_search_index で索引する
+CREATE_SEARCH_TABLE_SQL = [
+    """CREATE VIRTUAL TABLE tweet_search USING fts5(
+        body, content='tweet_tweetsearchdocument', content_rowid='id', tokenize='unicode61'
+    )""",
+    """CREATE TRIGGER tweet_search_ai AFTER INSERT ON tweet_tweetsearchdocument BEGIN
+        INSERT INTO tweet_search(rowid, body) VALUES (new.id, new.body);
+    END""",
+    """CREATE TRIGGER tweet_search_ad AFTER DELETE ON tweet_tweetsearchdocument BEGIN
+        INSERT INTO tweet_search(tweet_search, rowid, body) VALUES ('delete', old.id, old.body);
+    END""",
+    """CREATE TRIGGER tweet_search_au AFTER UPDATE ON tweet_tweetsearchdocument BEGIN
+        INSERT INTO tweet_search(tweet_search, rowid, body) VALUES ('delete', old.id, old.body);
+        INSERT INTO tweet_search(rowid, body) VALUES (new.id, new.body);
+    END""",
+]
+
+DROP_SEARCH_TABLE_SQL = [
+    "DROP TRIGGER IF EXISTS tweet_search_ai",
+    "DROP TRIGGER IF EXISTS tweet_search_ad",
+    "DROP TRIGGER IF EXISTS tweet_search_au",
+    "DROP TABLE IF EXISTS tweet_search",
+]
+
+
+def run_on_sqlite(statements):
+    def run(apps, schema_editor):
+        # FTS5 は SQLite 専用。他のデータベースでは部分一致検索にフォールバックする
+        if schema_editor.connection.vendor != 'sqlite':
+            return
+        for sql in statements:
+            schema_editor.execute(sql)
+
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tweet', '0008_tweet_user_created_at_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TweetSearchDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('body', models.TextField()),
+                ('tweet', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='tweet.tweet')),
+            ],
+        ),
+        migrations.RunPython(run_on_sqlite(CREATE_SEARCH_TABLE_SQL), run_on_sqlite(DROP_SEARCH_TABLE_SQL)),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.0.2 on 2026-10-18 17:17
+
+from django.db import migrations, models
+import tweet.ids
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tweet', '0009_tweetsearchdocument'),
+    ]
+
+    operations = [
+        # default は Python 側だけの変更なので、SQLite でテーブルを作り直さないよう状態だけ変える
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='tweet',
+                    name='id',
+                    field=models.UUIDField(default=tweet.ids.uuid7, editable=False, primary_key=True, serialize=False),
+                ),
+            ],
+        ),
+    ]
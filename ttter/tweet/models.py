@@ -1,17 +1,126 @@
-import uuid
-
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
+from base.objectcache import ObjectCache
+
+from . import ids, shards
+from .cards import bump_card_version, bump_card_versions
+
 User = get_user_model()
 
 
+class TweetQuerySet(models.QuerySet):
+    def with_user(self):
+        # シャード上のツイートとユーザーは JOIN できないので、別のクエリでまとめて読む
+        if shards.is_sharded():
+            return self.prefetch_related("user")
+        return self.select_related("user")
+
+    def timeline(self):
+        return self.with_user()
+
+    def posted_by(self, user):
+        return self.filter(user=user).using(shards.for_user(user.pk)).with_user()
+
+
 class Tweet(models.Model):
-    id = models.UUIDField(primary_key=True, editable=False, default=uuid.uuid4)
+    # 時刻順の UUID (version 7)。以前に作られたツイートの id は uuid4 のまま
+    id = models.UUIDField(primary_key=True, editable=False, default=ids.uuid7)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     content = models.CharField(verbose_name="content", max_length=200)
     created_at = models.DateTimeField(verbose_name="create_date", default=timezone.now)
+    like_count = models.PositiveIntegerField(verbose_name="like_count", default=0)
+
+    objects = TweetQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["-created_at", "-id"], name="tweet_created_at_id_idx"),
+            models.Index(fields=["user", "-created_at", "-id"], name="tweet_user_created_at_idx"),
+        ]
+
+
+class TweetObjectCache(ObjectCache):
+    def fetch(self, **lookup):
+        if not shards.is_sharded():
+            return super().fetch(**lookup)
+        # 主キーからはシャードが分からないので、見つかるまで順に探す
+        for alias in shards.aliases():
+            tweet = Tweet.objects.using(alias).filter(**lookup).first()
+            if tweet is not None:
+                return tweet
+        return None
+
+
+tweet_cache = TweetObjectCache(Tweet)
+
+
+class LikeForTweetManager(models.Manager):
+    def like(self, user, tweet):
+        # いいねの追加とカウンタの更新を同じトランザクションで行う（いいねはツイートと同じシャードに置く）
+        db = shards.for_tweet(tweet)
+        with transaction.atomic(using=db):
+            _, created = self.using(db).get_or_create(user=user, tweet=tweet)
+            if created:
+                Tweet.objects.using(db).filter(pk=tweet.pk).update(like_count=F("like_count") + 1)
+                tweet.like_count += 1
+                tweet_cache.invalidate(tweet.pk, using=db)
+                transaction.on_commit(lambda: bump_card_version(tweet.pk), using=db)
+        return tweet.like_count
+
+    def unlike(self, user, tweet):
+        db = shards.for_tweet(tweet)
+        with transaction.atomic(using=db):
+            deleted, _ = self.using(db).filter(user=user, tweet=tweet).delete()
+            if deleted:
+                Tweet.objects.using(db).filter(pk=tweet.pk, like_count__gt=0).update(like_count=F("like_count") - 1)
+                tweet.like_count = max(tweet.like_count - 1, 0)
+                tweet_cache.invalidate(tweet.pk, using=db)
+                transaction.on_commit(lambda: bump_card_version(tweet.pk), using=db)
+        return tweet.like_count
+
+    def like_count_expression(self):
+        """Tweet.like_count を LikeForTweet から数え直す式（UPDATE の右辺に使う）。"""
+        counts = (
+            self.filter(tweet=OuterRef("pk")).order_by().values("tweet").annotate(count=Count("pk")).values("count")
+        )
+        return Coalesce(Subquery(counts), 0)
+
+    def apply(self, user, states):
+        """{tweet_id: いいねするか} をまとめて反映し、対象ツイートの {tweet_id: like_count} を返す。
+
+        シャードごとに、追加は bulk_create、解除は 1 回の DELETE で行い、変化したツイートの件数は 1 回の UPDATE で数え直す。
+        存在しないツイートは無視する。
+        """
+        counts = {}
+        for db in shards.aliases():
+            counts.update(self.apply_on(db, user, states))
+        return counts
+
+    def apply_on(self, db, user, states):
+        with transaction.atomic(using=db):
+            tweet_ids = list(Tweet.objects.using(db).filter(pk__in=states).values_list("pk", flat=True))
+            if not tweet_ids:
+                return {}
+            liked = set(self.using(db).filter(user=user, tweet__in=tweet_ids).values_list("tweet", flat=True))
+            to_like = [pk for pk in tweet_ids if states[pk] and pk not in liked]
+            to_unlike = [pk for pk in tweet_ids if not states[pk] and pk in liked]
+            if to_like:
+                # 同時に同じいいねが入っても一意制約で弾かれるだけにする（件数は下で数え直す）
+                self.using(db).bulk_create(
+                    [self.model(user=user, tweet_id=pk) for pk in to_like], ignore_conflicts=True
+                )
+            if to_unlike:
+                self.using(db).filter(user=user, tweet__in=to_unlike).delete()
+            changed = to_like + to_unlike
+            if changed:
+                Tweet.objects.using(db).filter(pk__in=changed).update(like_count=self.like_count_expression())
+                tweet_cache.invalidate(*changed, using=db)
+                transaction.on_commit(lambda: bump_card_versions(changed), using=db)
+            return dict(Tweet.objects.using(db).filter(pk__in=tweet_ids).values_list("pk", "like_count"))
 
 
 class LikeForTweet(models.Model):
@@ -19,9 +128,35 @@ class LikeForTweet(models.Model):
     tweet = models.ForeignKey(Tweet, on_delete=models.CASCADE)
     created_at = models.DateTimeField(verbose_name="create_date", default=timezone.now)
 
+    objects = LikeForTweetManager()
+
     class Meta:
         constraints = [
             models.UniqueConstraint(
                 fields=["user", "tweet"], name="unique_like_for_tweet"
             ),
         ]
+
+
+class TimelineEntry(models.Model):
+    # フォローしているユーザーのツイートを、ツイート作成時に各フォロワーへ書き込んでおく
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name="timeline_entries")
+    # ツイート削除時は CASCADE で全員のタイムラインから消える
+    tweet = models.ForeignKey(Tweet, on_delete=models.CASCADE)
+    author = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    created_at = models.DateTimeField(verbose_name="create_date")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["owner", "tweet"], name="unique_timeline_entry"),
+        ]
+        indexes = [
+            models.Index(fields=["owner", "-created_at", "-tweet"], name="timeline_owner_created_idx"),
+            models.Index(fields=["owner", "author"], name="timeline_owner_author_idx"),
+        ]
+
+
+class TweetSearchDocument(models.Model):
+    # 全文検索用にバイグラム化した本文。id が FTS5 テーブル (tweet_search) の rowid になる
+    tweet = models.OneToOneField(Tweet, on_delete=models.CASCADE)
+    body = models.TextField()
@@ -0,0 +1,111 @@
+import re
+import unicodedata
+
+from django.db import connection, connections, router
+from django.db.models.expressions import RawSQL
+
+from base.pagination import InvalidCursor, KeysetPaginator, build_cursor_page, decode_cursor
+
+from . import shards
+from .models import Tweet, TweetSearchDocument
+
+# SQLite の FTS5 仮想テーブル。TweetSearchDocument を外部コンテンツとし、トリガーで同期する
+# （テーブルとトリガーはマイグレーション 0009 で作成）
+SEARCH_TABLE = "tweet_search"
+
+# 文字・数字の連続。記号や空白は区切りとして扱う
+WORD_RE = re.compile(r"[^\W_]+")
+
+
+def is_supported():
+    return connection.vendor == "sqlite"
+
+
+def words(text):
+    return WORD_RE.findall(unicodedata.normalize("NFKC", text).lower())
+
+
+def tokenize(text):
+    """日本語は分かち書きされないので、文字のバイグラムにしてから unicode61 に渡す。
+
+    各文字から始まるトークンを作る（末尾は 1 文字）ので、1 文字の検索も前方一致で引ける。
+    """
+    return " ".join(word[i : i + 2] for word in words(text) for i in range(len(word)))
+
+
+def build_match_query(query):
+    terms = []
+    for word in words(query):
+        if len(word) == 1:
+            terms.append(f'"{word}"*')
+        else:
+            terms.append('"' + " ".join(word[i : i + 2] for i in range(len(word) - 1)) + '"')
+    return " AND ".join(terms)
+
+
+def index_tweet(tweet):
+    TweetSearchDocument.objects.using(shards.for_tweet(tweet)).update_or_create(
+        tweet=tweet, defaults={"body": tokenize(tweet.content)}
+    )
+
+
+def rebuild(using=None):
+    with connections[using or router.db_for_write(TweetSearchDocument)].cursor() as cursor:
+        cursor.execute(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('rebuild')")
+
+
+class SearchPaginator:
+    """bm25 の順位 (rank, rowid) をキーにしたキーセットページング。"""
+
+    def __init__(self, query, per_page):
+        self.match = build_match_query(query)
+        self.per_page = int(per_page)
+
+    def decode(self, token):
+        values, reverse = decode_cursor(token)
+        if len(values) != 2 or not isinstance(values[0], (int, float)) or not isinstance(values[1], int):
+            raise InvalidCursor("不正なカーソルです。")
+        return values, reverse
+
+    def fetch(self, values, reverse, limit):
+        sql = f"SELECT rank, rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s"
+        params = [self.match]
+        if values is not None:
+            op = "<" if reverse else ">"
+            sql += f" AND (rank {op} %s OR (rank = %s AND rowid {op} %s))"
+            params += [values[0], values[0], values[1]]
+        sql += " ORDER BY rank DESC, rowid DESC" if reverse else " ORDER BY rank, rowid"
+        sql += " LIMIT %s"
+        params.append(limit)
+        # 文書の読み込みと同じデータベース（複製を含む）の索引を引く
+        with connections[router.db_for_read(TweetSearchDocument)].cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    def page(self, token=None):
+        values, reverse = self.decode(token) if token else (None, False)
+        if not self.match:
+            return build_cursor_page([], self.per_page, False, False)
+        rows = self.fetch(values, reverse, self.per_page + 1)
+        documents = TweetSearchDocument.objects.filter(pk__in=[rowid for _, rowid in rows]).select_related(
+            "tweet__user"
+        )
+        tweets = {document.pk: document.tweet for document in documents}
+        keyed_rows = [((rank, rowid), tweets[rowid]) for rank, rowid in rows if rowid in tweets]
+        return build_cursor_page(keyed_rows, self.per_page, values is not None, reverse)
+
+
+def search_paginator(query, per_page):
+    if is_supported() and shards.is_sharded():
+        # bm25 の順位はシャードごとの統計で決まり比べられないので、一致したツイートを新しい順に集める
+        match = build_match_query(query)
+        if not match:
+            return KeysetPaginator(Tweet.objects.none(), ("-created_at", "-id"), per_page)
+        matched = RawSQL(f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s", [match])
+        tweets = Tweet.objects.filter(tweetsearchdocument__in=matched).with_user()
+        return shards.scatter_paginator(tweets, ("-created_at", "-id"), per_page)
+    if is_supported():
+        return SearchPaginator(query, per_page)
+    # FTS5 が使えないデータベースでは部分一致にフォールバックする
+    tweets = Tweet.objects.filter(content__icontains=query).select_related("user")
+    return KeysetPaginator(tweets, ("-created_at", "-id"), per_page)
@@ -0,0 +1,114 @@
+"""ツイートを投稿者の user_id ごとに複数のデータベース（シャード）に分けて置く。
+
+settings.TWEET_SHARDS にエイリアスを並べると有効になる。未設定なら分割せず、
+シャードのエイリアスは None（ルーターに任せる）になる。
+いいねと検索用の文書はツイートと同じシャードに置くので、件数の数え直しや CASCADE はシャード内で完結する。
+"""
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from base.pagination import KeysetPaginator, MergedKeysetPaginator
+
+SHARDED_MODELS = {"tweet.tweet", "tweet.likefortweet", "tweet.tweetsearchdocument"}
+
+
+def is_sharded():
+    return bool(getattr(settings, "TWEET_SHARDS", None))
+
+
+def aliases():
+    return list(settings.TWEET_SHARDS) if is_sharded() else [None]
+
+
+def jump_hash(key, buckets):
+    """Jump Consistent Hash (Lamping & Veach)。
+
+    バケットを末尾に 1 つ足したとき、移動するキーは 1 / buckets だけで済む。
+    """
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+def for_user(user_id):
+    shards = aliases()
+    return shards[jump_hash(int(user_id), len(shards))]
+
+
+def for_tweet(tweet):
+    return for_user(tweet.user_id)
+
+
+def group_by_shard(tweets):
+    groups = {}
+    for tweet in tweets:
+        groups.setdefault(for_tweet(tweet), []).append(tweet)
+    return groups
+
+
+def scatter_paginator(queryset, ordering, per_page):
+    """各シャードを同じ並び順で読み、MergedKeysetPaginator でマージする。"""
+    paginators = [KeysetPaginator(queryset.using(alias), ordering, per_page) for alias in aliases()]
+    if len(paginators) == 1:
+        return paginators[0]
+    return MergedKeysetPaginator(paginators, per_page)
+
+
+def shard_of(instance):
+    if instance._state.db:
+        return instance._state.db
+    if instance._meta.label_lower == "tweet.tweet":
+        return for_tweet(instance)
+    tweet = instance._state.fields_cache.get("tweet")
+    return shard_of(tweet) if tweet is not None else None
+
+
+class TweetShardRouter:
+    """インスタンスから分かるときは、ツイート・いいね・検索用の文書をそのシャードに振り分ける。
+
+    主キーだけの検索などシャードが分からないクエリは、呼び出し側で using() を指定する。
+    """
+
+    def route(self, model, instance=None, **hints):
+        if instance is None:
+            return None
+        if model._meta.label_lower in SHARDED_MODELS:
+            if instance._meta.label_lower in SHARDED_MODELS:
+                return shard_of(instance)
+            if instance._meta.label_lower == settings.AUTH_USER_MODEL.lower():
+                # user.tweet_set など
+                return for_user(instance.pk)
+            return None
+        if instance._meta.label_lower in SHARDED_MODELS:
+            # シャード上のツイートから辿ったユーザーなどは既定のデータベースにある
+            return DEFAULT_DB_ALIAS
+        return None
+
+    db_for_read = route
+    db_for_write = route
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if {obj1._meta.label_lower, obj2._meta.label_lower} & SHARDED_MODELS:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # シャードにも全テーブルを作る（ツイート以外のテーブルは空のまま使わない）
+        if db in aliases():
+            return True
+        return None
+
+
+def disable_foreign_keys(sender, connection, **kwargs):
+    """シャードにはユーザーの行がないので、ツイートからユーザーへの外部キー制約を検査しない。"""
+    if connection.vendor == "sqlite" and connection.alias != DEFAULT_DB_ALIAS and connection.alias in aliases():
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA foreign_keys = OFF")
+
+
+def disable_foreign_keys_after_migrate(sender, using, **kwargs):
+    # スキーマエディターは終了時に制約を有効に戻すので、migrate した接続を使い続けるとき（テスト用のデータベースなど）に備える
+    disable_foreign_keys(sender, connections[using])
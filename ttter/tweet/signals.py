@@ -0,0 +1,14 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from . import search
+from .models import Tweet
+
+
+@receiver(post_save, sender=Tweet)
+def index_tweet(sender, instance, created, update_fields=None, **kwargs):
+    # 削除は TweetSearchDocument の CASCADE とトリガーで FTS5 テーブルから消える
+    if not search.is_supported():
+        return
+    if created or update_fields is None or "content" in update_fields:
+        search.index_tweet(instance)
@@ -1,10 +1,26 @@
+import asyncio
+import copy
 import uuid
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, connection, connections
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
-from .models import LikeForTweet, Tweet
+from accounts.models import FriendShip
+from base.asyncviews import async_views
+from base.pagination import KeysetPaginator
+
+from . import cards, events, ids, shards, timeline
+from .models import LikeForTweet, TimelineEntry, Tweet, tweet_cache
 
 User = get_user_model()
 
@@ -55,6 +71,264 @@ class TestTweetCreateView(TestCase):
         )
 
 
+class TestTweetListView(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="test", email="test@mail.com", password="test"
+        )
+        self.client.login(username="test@mail.com", password="test")
+        now = timezone.now()
+        # 同時刻のツイートを混ぜて (created_at, id) の順序を確認する
+        Tweet.objects.bulk_create(
+            [
+                Tweet(user=self.user, content=f"tweet{i}", created_at=now - timedelta(minutes=i // 2))
+                for i in range(25)
+            ]
+        )
+        self.expected = list(Tweet.objects.order_by("-created_at", "-id"))
+
+    def test_success_get(self):
+        response = self.client.get(reverse("tweet:home"))
+        self.assertEquals(response.status_code, 200)
+        self.assertTemplateUsed(response, "tweet/tweet_list.html")
+        self.assertEqual(list(response.context["tweet_list"]), self.expected[:20])
+        self.assertFalse(response.context["page_obj"].has_previous())
+        self.assertTrue(response.context["page_obj"].has_next())
+
+    def test_success_get_next_and_previous_page(self):
+        first = self.client.get(reverse("tweet:home")).context["page_obj"]
+        response_next = self.client.get(reverse("tweet:home"), {"cursor": first.next_cursor})
+        second = response_next.context["page_obj"]
+        self.assertEqual(list(second), self.expected[20:])
+        self.assertFalse(second.has_next())
+        response_previous = self.client.get(reverse("tweet:home"), {"cursor": second.previous_cursor})
+        self.assertEqual(list(response_previous.context["page_obj"]), self.expected[:20])
+
+    def test_query_count_does_not_depend_on_depth(self):
+        with CaptureQueriesContext(connection) as first_queries:
+            first = self.client.get(reverse("tweet:home")).context["page_obj"]
+        with self.assertNumQueries(len(first_queries)):
+            self.client.get(reverse("tweet:home"), {"cursor": first.next_cursor})
+
+    def test_success_get_like_state(self):
+        liked = self.expected[1]
+        LikeForTweet.objects.create(user=self.user, tweet=liked)
+        response = self.client.get(reverse("tweet:home"))
+        for tweet in response.context["tweet_list"]:
+            self.assertEqual(tweet.is_liked, tweet.pk == liked.pk)
+
+    def test_failure_get_with_invalid_cursor(self):
+        response = self.client.get(reverse("tweet:home"), {"cursor": "invalid"})
+        self.assertEquals(response.status_code, 404)
+
+
+class TestHomeTimelineView(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="test", email="test@mail.com", password="test"
+        )
+        self.author = User.objects.create_user(
+            username="author", email="author@mail.com", password="author"
+        )
+        self.stranger = User.objects.create_user(
+            username="stranger", email="stranger@mail.com", password="stranger"
+        )
+        # user が author をフォローしている
+        FriendShip.objects.follow(followee=self.user, follower=self.author)
+
+    def post_tweet(self, user, content):
+        self.client.force_login(user)
+        self.client.post(reverse("tweet:tweet_create"), {"content": content})
+        return Tweet.objects.get(content=content)
+
+    def get_timeline(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse("tweet:following"))
+        self.assertEquals(response.status_code, 200)
+        return list(response.context["tweet_list"])
+
+    def test_success_get(self):
+        followed = self.post_tweet(self.author, "フォロー中のツイート")
+        self.post_tweet(self.stranger, "知らない人のツイート")
+        own = self.post_tweet(self.user, "自分のツイート")
+        self.assertEqual(self.get_timeline(), [own, followed])
+        self.assertTrue(TimelineEntry.objects.filter(owner=self.user, tweet=followed).exists())
+
+    def test_delete_removes_entries(self):
+        tweet = self.post_tweet(self.author, "消すツイート")
+        self.client.post(reverse("tweet:tweet_delete", kwargs={"pk": tweet.pk}))
+        self.assertFalse(TimelineEntry.objects.filter(tweet_id=tweet.pk).exists())
+        self.assertEqual(self.get_timeline(), [])
+
+    def test_follow_backfills_and_unfollow_removes(self):
+        tweet = self.post_tweet(self.stranger, "フォロー前のツイート")
+        self.client.force_login(self.user)
+        self.client.post(reverse("accounts:follow", kwargs={"username": self.stranger.username}))
+        self.assertEqual(self.get_timeline(), [tweet])
+        self.client.post(reverse("accounts:unfollow", kwargs={"username": self.stranger.username}))
+        self.assertEqual(self.get_timeline(), [])
+
+    @override_settings(TIMELINE_FANOUT_THRESHOLD=0)
+    def test_skipped_fanout_is_merged_on_read(self):
+        tweet = self.post_tweet(self.author, "フォロワーの多い人のツイート")
+        self.assertFalse(TimelineEntry.objects.filter(owner=self.user).exists())
+        self.assertEqual(self.get_timeline(), [tweet])
+
+    def test_pull_engine_matches_fanout(self):
+        now = timezone.now()
+        for i in range(15):
+            for user in (self.user, self.author, self.stranger):
+                tweet = Tweet.objects.create(
+                    user=user, content=f"{user.username}{i}", created_at=now - timedelta(minutes=i)
+                )
+                timeline.fan_out(tweet)
+        self.client.force_login(self.user)
+        pages = {}
+        for engine in ("fanout", "pull"):
+            tweets, params = [], {"engine": engine}
+            while True:
+                response = self.client.get(reverse("tweet:following"), params)
+                tweets += response.context["tweet_list"]
+                if not response.context["page_obj"].has_next():
+                    break
+                params["cursor"] = response.context["page_obj"].next_cursor
+            pages[engine] = tweets
+        self.assertEqual(len(pages["pull"]), 30)
+        self.assertEqual(pages["pull"], pages["fanout"])
+
+
+class TestTweetCardCache(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="test", email="test@mail.com", password="test"
+        )
+        self.client.force_login(self.user)
+        self.tweet = Tweet.objects.create(user=self.user, content="キャッシュされる")
+
+    def test_card_is_cached_until_version_bump(self):
+        self.assertContains(self.client.get(reverse("tweet:home")), "キャッシュされる")
+        # バージョンを上げない更新はキャッシュ済みのカードに反映されない
+        Tweet.objects.filter(pk=self.tweet.pk).update(content="書き換えた")
+        self.assertContains(self.client.get(reverse("tweet:home")), "キャッシュされる")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("tweet:like", kwargs={"pk": self.tweet.pk}))
+        response = self.client.get(reverse("tweet:home"))
+        self.assertContains(response, "書き換えた")
+        self.assertContains(response, f'<span name="count_{self.tweet.pk}" class="count">1</span>', html=True)
+
+    def test_like_button_is_rendered_per_viewer(self):
+        self.client.get(reverse("tweet:home"))
+        LikeForTweet.objects.create(user=self.user, tweet=self.tweet)
+        response = self.client.get(reverse("tweet:home"))
+        self.assertContains(response, f'data-tweet-id="{self.tweet.pk}" data-liked="true"')
+
+        other = User.objects.create_user(
+            username="other", email="other@mail.com", password="other"
+        )
+        self.client.force_login(other)
+        response_other = self.client.get(reverse("tweet:home"))
+        self.assertContains(response_other, f'data-tweet-id="{self.tweet.pk}" data-liked="false"')
+        self.assertNotContains(response_other, reverse("tweet:tweet_delete", kwargs={"pk": self.tweet.pk}))
+
+
+class TestTweetSearchView(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="test", email="test@mail.com", password="test"
+        )
+        self.client.force_login(self.user)
+        self.elephant = Tweet.objects.create(user=self.user, content="ぞうがくる像")
+        self.duck = Tweet.objects.create(user=self.user, content="かもがくるかも")
+        self.tea = Tweet.objects.create(user=self.user, content="おーいお茶 Green Tea")
+
+    def search(self, query, **params):
+        response = self.client.get(reverse("tweet:search"), {"q": query, **params})
+        self.assertEquals(response.status_code, 200)
+        return response
+
+    def test_success_get(self):
+        response = self.search("がくる")
+        self.assertTemplateUsed(response, "tweet/tweet_search.html")
+        self.assertCountEqual(response.context["tweet_list"], [self.elephant, self.duck])
+
+    def test_success_get_with_short_and_latin_query(self):
+        self.assertEqual(list(self.search("像").context["tweet_list"]), [self.elephant])
+        self.assertEqual(list(self.search("green").context["tweet_list"]), [self.tea])
+        self.assertEqual(list(self.search("お茶 tea").context["tweet_list"]), [self.tea])
+        self.assertEqual(list(self.search("紅茶").context["tweet_list"]), [])
+
+    def test_deleted_tweet_is_not_found(self):
+        self.elephant.delete()
+        self.assertEqual(list(self.search("ぞう").context["tweet_list"]), [])
+
+    def test_success_get_next_page(self):
+        Tweet.objects.bulk_create(
+            [Tweet(user=self.user, content=f"象の話{i}") for i in range(25)]
+        )
+        call_command("rebuild_search_index", stdout=StringIO())
+        response = self.search("象の")
+        page = response.context["page_obj"]
+        self.assertEqual(len(page), 20)
+        response_next = self.search("象の", cursor=page.next_cursor)
+        self.assertEqual(len(response_next.context["tweet_list"]), 5)
+        self.assertFalse(set(page) & set(response_next.context["tweet_list"]))
+
+
+class TestTweetApiView(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="test", email="test@mail.com", password="test"
+        )
+        self.client.force_login(self.user)
+        self.tweet = Tweet.objects.create(user=self.user, content="秋田に来た")
+
+    def test_success_get(self):
+        for url in (
+            reverse("tweet:api_timeline"),
+            reverse("tweet:api_user_tweets", kwargs={"username": self.user.username}),
+        ):
+            response = self.client.get(url)
+            self.assertEquals(response.status_code, 200)
+            data = response.json()
+            self.assertEqual([tweet["content"] for tweet in data["tweets"]], ["秋田に来た"])
+            self.assertIsNone(data["next_cursor"])
+            self.assertIn("ETag", response.headers)
+            self.assertIn("Last-Modified", response.headers)
+        response = self.client.get(reverse("tweet:api_tweet", kwargs={"pk": self.tweet.pk}))
+        self.assertEqual(response.json()["id"], str(self.tweet.pk))
+
+    def test_not_modified(self):
+        url = reverse("tweet:api_timeline")
+        etag = self.client.get(url).headers["ETag"]
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+
+        # いいね数が変わると ETag も変わる
+        self.client.post(reverse("tweet:like", kwargs={"pk": self.tweet.pk}))
+        response_liked = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response_liked.status_code, 200)
+        self.assertEqual(response_liked.json()["tweets"][0]["like_count"], 1)
+
+    def test_if_modified_since_needs_matching_etag(self):
+        url = reverse("tweet:api_tweet", kwargs={"pk": self.tweet.pk})
+        response = self.client.get(url)
+        etag, since = response.headers["ETag"], response.headers["Last-Modified"]
+
+        # いいねは時刻を残さないので、Last-Modified は変わらず、If-Modified-Since では変化を判断できない
+        self.client.post(reverse("tweet:like", kwargs={"pk": self.tweet.pk}))
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=since)
+        self.assertEquals(response.status_code, 200)
+        self.assertEqual(response.headers["Last-Modified"], since)
+        self.assertEqual(response.json()["like_count"], 1)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag, HTTP_IF_MODIFIED_SINCE=since)
+        self.assertEquals(response.status_code, 200)
+        etag = response.headers["ETag"]
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag, HTTP_IF_MODIFIED_SINCE=since)
+        self.assertEquals(response.status_code, 304)
+
+
 class TestTweetDetailView(TestCase):
     def test_success_get(self):
         User.objects.create_user(
@@ -70,6 +344,14 @@ class TestTweetDetailView(TestCase):
         self.assertEquals(response_get.status_code, 200)
         self.assertTemplateUsed(response_get, "tweet/tweet_detail.html")
         self.assertContains(response_get, data["content"])
+        self.assertFalse(response_get.context["tweet"].is_liked)
+
+        self.client.post(reverse("tweet:like", kwargs={"pk": tweet.pk}))
+        response_liked = self.client.get(
+            reverse("tweet:tweet_detail", kwargs={"pk": tweet.pk})
+        )
+        self.assertTrue(response_liked.context["tweet"].is_liked)
+        self.assertContains(response_liked, f'data-tweet-id="{tweet.pk}" data-liked="true"')
 
 
 class TestTweetDeleteView(TestCase):
@@ -129,6 +411,9 @@ class TestLikeView(TestCase):
         response = self.client.post(reverse("tweet:like", kwargs={"pk": self.tweet.pk}))
         self.assertEquals(response.status_code, 200)
         self.assertTrue(LikeForTweet.objects.filter(tweet=self.tweet, user=self.user).exists(), )
+        self.assertEqual(response.json()["liked_count"], 1)
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.like_count, 1)
 
     def test_failure_post_with_not_exist_tweet(self):
         response = self.client.post(
@@ -143,6 +428,7 @@ class TestLikeView(TestCase):
         response = self.client.post(reverse("tweet:like", kwargs={"pk": self.tweet.pk}))
         self.assertEquals(response.status_code, 200)
         self.assertEqual(LikeForTweet.objects.filter(tweet=self.tweet, user=self.user).count(), 1)
+        self.assertEqual(response.json()["liked_count"], 1)
 
 
 class TestUnlikeView(TestCase):
@@ -161,6 +447,9 @@ class TestUnlikeView(TestCase):
         response = self.client.post(reverse("tweet:unlike", kwargs={"pk": self.tweet.pk}))
         self.assertEquals(response.status_code, 200)
         self.assertFalse(LikeForTweet.objects.filter(tweet=self.tweet, user=self.user).exists())
+        self.assertEqual(response.json()["liked_count"], 0)
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.like_count, 0)
 
     def test_failure_post_with_not_exist_tweet(self):
         response = self.client.post(
@@ -177,3 +466,450 @@ class TestUnlikeView(TestCase):
         )
         self.assertEquals(response.status_code, 200)
         self.assertFalse(LikeForTweet.objects.filter(tweet=self.tweet, user=self.user).exists())
+        self.assertEqual(response.json()["liked_count"], 0)
+
+
+class TestAsyncViews(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.enterContext(async_views(True))
+        self.user = User.objects.create_user(username="async", email="async@mail.com")
+        self.async_client.force_login(self.user)
+        self.tweet = Tweet.objects.create(user=self.user, content="非同期")
+
+    def post(self, url):
+        # Django 4.0 の AsyncClient は空の multipart の本文を読み切れないので、JSON で送る
+        return self.async_client.post(url, content_type="application/json")
+
+    async def test_tweet_list(self):
+        response = await self.async_client.get(reverse("tweet:home"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([tweet.content for tweet in response.context["tweet_list"]], ["非同期"])
+        self.assertFalse(response.context["tweet_list"][0].is_liked)
+
+    async def test_like_and_unlike(self):
+        response = await self.post(reverse("tweet:like", kwargs={"pk": self.tweet.pk}))
+        self.assertEqual(response.json()["liked_count"], 1)
+        self.assertTrue(response.json()["is_liked"])
+        response = await self.post(reverse("tweet:unlike", kwargs={"pk": self.tweet.pk}))
+        self.assertEqual(response.json()["liked_count"], 0)
+        self.assertFalse(response.json()["is_liked"])
+
+    async def test_like_not_exist_tweet(self):
+        response = await self.post(reverse("tweet:like", kwargs={"pk": str(uuid.uuid4())}))
+        self.assertEqual(response.status_code, 404)
+
+    async def test_like_requires_post_and_login(self):
+        url = reverse("tweet:like", kwargs={"pk": self.tweet.pk})
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 405)
+        await sync_to_async(self.async_client.logout)()
+        response = await self.post(url)
+        self.assertRedirects(response, f"{reverse('accounts:login')}?next={url}", fetch_redirect_response=False)
+
+
+@override_settings(TWEET_STREAM=True, TWEET_STREAM_HEARTBEAT_SECONDS=0.05)
+class TestTweetEvents(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="stream", email="stream@mail.com")
+        self.client.force_login(self.user)
+        self.scope = {
+            "type": "http",
+            "method": "GET",
+            "path": "/stream/tweets/",
+            "headers": [(b"cookie", f"sessionid={self.client.session.session_key}".encode())],
+        }
+
+    async def wait_until(self, predicate):
+        for _ in range(200):
+            if predicate():
+                return
+            await asyncio.sleep(0.01)
+        self.fail("timed out")
+
+    def test_publish_tweet_and_like_count_on_commit(self):
+        with mock.patch.object(events.hub, "publish") as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse("tweet:tweet_create"), {"content": "ストリーム"})
+            tweet = Tweet.objects.get(content="ストリーム")
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse("tweet:like", kwargs={"pk": tweet.pk}))
+        (tweet_event, tweet_data), (like_event, like_data) = [call.args for call in publish.call_args_list]
+        self.assertEqual((tweet_event, tweet_data["id"], tweet_data["user"]), ("tweet", tweet.pk, "stream"))
+        self.assertEqual((like_event, like_data), ("like", {"tweet_id": tweet.pk, "like_count": 1}))
+
+    def test_stream_url_only_on_first_page(self):
+        Tweet.objects.bulk_create([Tweet(user=self.user, content=f"tweet{i}") for i in range(21)])
+        response = self.client.get(reverse("tweet:home"))
+        self.assertEqual(response.context["stream_url"], "/stream/tweets/")
+        self.assertContains(response, 'data-stream-url="/stream/tweets/"')
+        response = self.client.get(reverse("tweet:home"), {"cursor": response.context["page_obj"].next_cursor})
+        self.assertIsNone(response.context["stream_url"])
+        with override_settings(TWEET_STREAM=False):
+            response = self.client.get(reverse("tweet:home"))
+        self.assertIsNone(response.context["stream_url"])
+
+    async def test_stream(self):
+        sent = []
+        disconnected = asyncio.Event()
+
+        async def receive():
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+
+        def bodies():
+            return b"".join(message.get("body", b"") for message in sent)
+
+        application = asyncio.ensure_future(events.stream_application(self.scope, receive, send))
+        await self.wait_until(lambda: len(events.hub) == 1)
+        # 別のスレッド（同期ビューの on_commit）から publish する
+        await sync_to_async(events.hub.publish, thread_sensitive=False)("like", {"tweet_id": "x", "like_count": 2})
+        await self.wait_until(lambda: b'event: like\ndata: {"tweet_id":"x","like_count":2}\n\n' in bodies())
+        await self.wait_until(lambda: events.HEARTBEAT in bodies())
+        self.assertEqual(sent[0]["status"], 200)
+
+        disconnected.set()
+        await asyncio.wait_for(application, 1)
+        self.assertEqual(len(events.hub), 0)
+
+    async def test_stream_requires_login(self):
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        await events.stream_application({**self.scope, "headers": []}, None, send)
+        self.assertEqual(sent[0]["status"], 403)
+
+    async def test_backpressure_and_stream_cap(self):
+        hub = events.EventHub()
+        subscription = hub.subscribe(max_streams=1, queue_size=1)
+        with self.assertRaises(events.TooManyStreams):
+            hub.subscribe(max_streams=1, queue_size=1)
+        hub.publish("like", {"tweet_id": "x", "like_count": 1})
+        await asyncio.sleep(0)
+        message = await subscription.next_message(1)
+        self.assertEqual(message, events.format_event("like", {"tweet_id": "x", "like_count": 1}))
+
+        # 読まれないうちにキューがあふれたら、残りは捨てて resync を送る
+        hub.publish("like", {"tweet_id": "x", "like_count": 2})
+        hub.publish("like", {"tweet_id": "x", "like_count": 3})
+        await asyncio.sleep(0)
+        self.assertEqual(await subscription.next_message(1), events.RESYNC)
+        hub.unsubscribe(subscription)
+        self.assertEqual(len(hub), 0)
+
+
+class TestLikeBatchView(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="test", email="test@mail.com", password="test"
+        )
+        self.client.force_login(self.user)
+        self.liked, self.unliked = Tweet.objects.bulk_create(
+            [Tweet(user=self.user, content="いいね済み"), Tweet(user=self.user, content="未いいね")]
+        )
+        LikeForTweet.objects.like(self.user, self.liked)
+
+    def post(self, operations):
+        return self.client.post(
+            reverse("tweet:like_batch"), {"operations": operations}, content_type="application/json"
+        )
+
+    def test_success_post(self):
+        operations = [
+            {"tweet_id": str(self.liked.pk), "liked": False},
+            {"tweet_id": str(self.unliked.pk), "liked": False},
+            # 同じツイートへの操作は最後のものが使われる
+            {"tweet_id": str(self.unliked.pk), "liked": True},
+            {"tweet_id": str(uuid.uuid4()), "liked": True},
+        ]
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.post(operations)
+        self.assertEquals(response.status_code, 200)
+        self.assertCountEqual(
+            response.json()["tweets"],
+            [
+                {"tweet_id": str(self.liked.pk), "liked_count": 0, "is_liked": False},
+                {"tweet_id": str(self.unliked.pk), "liked_count": 1, "is_liked": True},
+            ],
+        )
+        self.assertEqual(
+            list(LikeForTweet.objects.filter(user=self.user).values_list("tweet", flat=True)), [self.unliked.pk]
+        )
+        self.assertEqual(Tweet.objects.get(pk=self.liked.pk).like_count, 0)
+
+    def test_unchanged_states_do_not_write(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post([{"tweet_id": str(self.liked.pk), "liked": True}])
+        self.assertEqual(response.json()["tweets"][0]["liked_count"], 1)
+        self.assertFalse([query for query in queries if query["sql"].startswith(("INSERT", "UPDATE", "DELETE"))])
+
+    def test_failure_post_with_invalid_body(self):
+        self.assertEquals(self.post([{"tweet_id": "not-a-uuid", "liked": True}]).status_code, 400)
+        for liked in ("false", 0, None):
+            with self.subTest(liked=liked):
+                self.assertEquals(self.post([{"tweet_id": str(self.unliked.pk), "liked": liked}]).status_code, 400)
+        self.assertFalse(LikeForTweet.objects.filter(tweet=self.unliked).exists())
+        response = self.client.post(reverse("tweet:like_batch"), "{", content_type="application/json")
+        self.assertEquals(response.status_code, 400)
+
+
+class TestTweetObjectCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            username="test", email="test@mail.com", password="test"
+        )
+        self.client.force_login(self.user)
+        self.tweet = Tweet.objects.create(user=self.user, content="よく見られる")
+
+    def test_detail_reads_tweet_from_cache(self):
+        url = reverse("tweet:tweet_detail", kwargs={"pk": self.tweet.pk})
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertContains(response, "よく見られる")
+        self.assertFalse([query for query in queries if '"tweet_tweet"."content"' in query["sql"]])
+
+    def test_like_count_is_invalidated(self):
+        self.assertEqual(tweet_cache.get(pk=self.tweet.pk).like_count, 0)
+        self.client.post(reverse("tweet:like", kwargs={"pk": self.tweet.pk}))
+        self.assertEqual(tweet_cache.get(pk=self.tweet.pk).like_count, 1)
+        response = self.client.post(reverse("tweet:like", kwargs={"pk": self.tweet.pk}))
+        self.assertEqual(response.json()["liked_count"], 1)
+
+    def test_deleted_tweet_is_not_found(self):
+        self.client.post(reverse("tweet:tweet_delete", kwargs={"pk": self.tweet.pk}))
+        with self.assertNumQueries(0):
+            self.assertIsNone(tweet_cache.get(pk=self.tweet.pk))
+        response = self.client.get(reverse("tweet:tweet_detail", kwargs={"pk": self.tweet.pk}))
+        self.assertEquals(response.status_code, 404)
+
+
+class TestTweetShards(TestCase):
+    def test_jump_hash_is_stable_and_moves_few_keys(self):
+        self.assertEqual([shards.jump_hash(key, 1) for key in range(100)], [0] * 100)
+        before = [shards.jump_hash(key, 3) for key in range(3000)]
+        self.assertEqual(before, [shards.jump_hash(key, 3) for key in range(3000)])
+        self.assertTrue(all(400 < before.count(bucket) < 1600 for bucket in range(3)))
+        # シャードを 1 つ足すと、移るキーは新しいシャードに行くものだけ（約 1/4）
+        after = [shards.jump_hash(key, 4) for key in range(3000)]
+        moved = [(b, a) for b, a in zip(before, after) if b != a]
+        self.assertTrue(all(a == 3 for _, a in moved))
+        self.assertLess(len(moved), 3000 / 3)
+
+    @override_settings(TWEET_SHARDS=[])
+    def test_unsharded_uses_router(self):
+        self.assertFalse(shards.is_sharded())
+        self.assertIsNone(shards.for_user(1))
+
+    @override_settings(TWEET_SHARDS=["default", "shard1"])
+    def test_router(self):
+        user = User(pk=1, username="shard")
+        db = shards.for_user(user.pk)
+        tweet = Tweet(user=user, content="シャード")
+        router = shards.TweetShardRouter()
+        self.assertEqual(router.db_for_write(Tweet, instance=tweet), db)
+        self.assertEqual(router.db_for_read(Tweet, instance=user), db)
+        self.assertEqual(router.db_for_write(LikeForTweet, instance=LikeForTweet(user=user, tweet=tweet)), db)
+        # ツイートから辿るユーザーは既定のデータベースから読む
+        self.assertEqual(router.db_for_read(User, instance=tweet), "default")
+        self.assertIsNone(router.db_for_read(Tweet))
+        self.assertTrue(router.allow_relation(tweet, user))
+        self.assertTrue(router.allow_migrate("shard1", "accounts"))
+
+
+@override_settings(TWEET_SHARDS=["default", "shard1"], DATABASE_ROUTERS=["tweet.shards.TweetShardRouter"])
+class TestShardedTweets(TestCase):
+    databases = {"default", "shard1"}
+
+    def setUp(self):
+        cache.clear()
+        # 2 つのシャードに 1 人ずつ投稿者を用意する
+        self.users = {}
+        created = []
+        while len(self.users) < 2:
+            i = len(created)
+            user = User.objects.create_user(username=f"shard{i}", email=f"shard{i}@mail.com", password="test")
+            created.append(user)
+            self.users.setdefault(shards.for_user(user.pk), user)
+        # 本番のシャードにユーザーの行はないが、TestCase は終了時に外部キーを検査するので同じ pk で置いておく
+        User.objects.using("shard1").bulk_create([copy.copy(user) for user in created])
+        self.viewer = self.users["default"]
+        FriendShip.objects.create(followee=self.viewer, follower=self.users["shard1"])
+        self.client.force_login(self.viewer)
+
+        now = timezone.now()
+        self.tweets = [
+            self.create_tweet(self.users[("default", "shard1")[i % 2]], f"シャードの話{i}", now - timedelta(minutes=i))
+            for i in range(25)
+        ]
+
+    def create_tweet(self, user, content, created_at=None):
+        # objects.create() はインスタンスなしでルーターに聞くので、シャードを指定する
+        return Tweet.objects.using(shards.for_user(user.pk)).create(
+            user=user, content=content, created_at=created_at or timezone.now()
+        )
+
+    def read_all_pages(self, url, **params):
+        tweets = []
+        while True:
+            response = self.client.get(url, params)
+            page = response.context["page_obj"]
+            tweets += list(page)
+            if not page.has_next():
+                return tweets
+            params["cursor"] = page.next_cursor
+
+    def test_tweets_are_placed_by_author(self):
+        self.assertEqual(Tweet.objects.using("default").count(), 13)
+        self.assertEqual(Tweet.objects.using("shard1").count(), 12)
+        self.assertFalse(Tweet.objects.using("default").filter(user=self.users["shard1"]).exists())
+
+    def test_create_and_delete_tweet_on_shard(self):
+        author = self.users["shard1"]
+        self.client.force_login(author)
+        self.client.post(reverse("tweet:tweet_create"), {"content": "シャードに書く"})
+        tweet = Tweet.objects.using("shard1").get(content="シャードに書く")
+        self.assertFalse(Tweet.objects.using("default").filter(content="シャードに書く").exists())
+        self.assertEqual(User.objects.get(pk=author.pk).tweets_count, 1)
+
+        self.client.post(reverse("tweet:tweet_delete", kwargs={"pk": tweet.pk}))
+        self.assertFalse(Tweet.objects.using("shard1").filter(pk=tweet.pk).exists())
+        self.assertEqual(User.objects.get(pk=author.pk).tweets_count, 0)
+
+    def test_create_tweet_is_rolled_back_on_shard(self):
+        self.client.force_login(self.users["shard1"])
+        with mock.patch.object(User.objects, "adjust_counts", side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.client.post(reverse("tweet:tweet_create"), {"content": "取り消される"})
+        # ツイートの INSERT もシャードのトランザクションの中で行われ、件数の更新と一緒に取り消される
+        self.assertTrue(connections["shard1"].needs_rollback)
+
+    def test_timelines_merge_shards(self):
+        for url in (reverse("tweet:home"), reverse("tweet:following")):
+            with self.subTest(url=url):
+                self.assertEqual(self.read_all_pages(url), self.tweets)
+
+    def test_search_merges_shards(self):
+        self.assertEqual(self.read_all_pages(reverse("tweet:search"), q="シャード"), self.tweets)
+        self.assertEqual(self.read_all_pages(reverse("tweet:search"), q="話1"), self.tweets[1:2] + self.tweets[10:20])
+
+    def test_like_and_unlike_on_shard(self):
+        tweet = self.tweets[1]
+        version = cards.attach_card_versions([tweet])[0].card_version
+        with self.captureOnCommitCallbacks(using="shard1") as callbacks:
+            response = self.client.post(reverse("tweet:like", kwargs={"pk": tweet.pk}))
+        self.assertEqual(response.json()["liked_count"], 1)
+        self.assertEqual(Tweet.objects.using("shard1").get(pk=tweet.pk).like_count, 1)
+        self.assertEqual(LikeForTweet.objects.using("shard1").filter(tweet=tweet).count(), 1)
+        self.assertFalse(LikeForTweet.objects.using("default").exists())
+        # カードのバージョンはシャードのトランザクションがコミットされてから上げる
+        self.assertEqual(cache.get(cards.version_key(tweet.pk)), version)
+        for callback in callbacks:
+            callback()
+        self.assertNotEqual(cache.get(cards.version_key(tweet.pk)), version)
+
+        with self.captureOnCommitCallbacks(using="shard1", execute=True):
+            response = self.client.post(reverse("tweet:unlike", kwargs={"pk": tweet.pk}))
+        self.assertEqual(response.json()["liked_count"], 0)
+        self.assertEqual(Tweet.objects.using("shard1").get(pk=tweet.pk).like_count, 0)
+        self.assertFalse(LikeForTweet.objects.using("shard1").exists())
+
+    def test_reconcile_like_counts_per_shard(self):
+        for tweet in self.tweets[:2]:
+            LikeForTweet.objects.like(self.viewer, tweet)
+            Tweet.objects.using(shards.for_tweet(tweet)).filter(pk=tweet.pk).update(like_count=5)
+        stdout = StringIO()
+        call_command("reconcile_like_counts", chunk_size=5, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), "checked 25 tweets, fixed 2\n")
+        for tweet in self.tweets[:2]:
+            self.assertEqual(Tweet.objects.using(shards.for_tweet(tweet)).get(pk=tweet.pk).like_count, 1)
+
+    def test_rebalance_moves_tweets_of_relocated_authors(self):
+        author = self.users["shard1"]
+        # シャードが 1 つのときに書かれ、default に置かれたツイート
+        with override_settings(TWEET_SHARDS=["default"]):
+            moved = [self.create_tweet(author, f"移す話{i}") for i in range(3)]
+            LikeForTweet.objects.like(self.viewer, moved[0])
+        self.assertEqual(Tweet.objects.using("default").filter(user=author).count(), 3)
+        versions = {tweet.pk: tweet.card_version for tweet in cards.attach_card_versions(moved)}
+
+        stdout = StringIO()
+        with self.captureOnCommitCallbacks(using="default", execute=True):
+            call_command("rebalance_tweet_shards", chunk_size=2, stdout=stdout)
+        self.assertIn("moved 3 tweets from default to shard1", stdout.getvalue())
+        self.assertFalse(Tweet.objects.using("default").filter(user=author).exists())
+        self.assertEqual(Tweet.objects.using("shard1").filter(pk__in=[tweet.pk for tweet in moved]).count(), 3)
+        self.assertEqual(LikeForTweet.objects.using("shard1").get(tweet=moved[0]).user_id, self.viewer.pk)
+        self.assertFalse(LikeForTweet.objects.using("default").exists())
+        self.assertEqual(tweet_cache.get(pk=moved[0].pk).like_count, 1)
+        for tweet in moved:
+            self.assertNotEqual(cache.get(cards.version_key(tweet.pk)), versions[tweet.pk])
+        self.assertCountEqual(self.read_all_pages(reverse("tweet:search"), q="移す"), moved)
+
+
+class TestTweetIds(TestCase):
+    def test_uuid7_is_time_ordered(self):
+        generated = [ids.uuid7() for _ in range(5000)]
+        self.assertEqual(sorted(generated), generated)
+        self.assertEqual(sorted(value.hex for value in generated), [value.hex for value in generated])
+        self.assertEqual({(value.version, value.variant) for value in generated}, {(7, uuid.RFC_4122)})
+        self.assertLess(abs(ids.datetime_of(generated[0]) - timezone.now()), timedelta(seconds=5))
+        self.assertIsNone(ids.datetime_of(uuid.uuid4()))
+
+    def test_paginate_new_tweets_by_id_alone(self):
+        user = User.objects.create_user(
+            username="test", email="test@mail.com", password="test"
+        )
+        for i in range(7):
+            Tweet.objects.create(user=user, content=f"tweet{i}")
+        by_id = KeysetPaginator(Tweet.objects.all(), ("-id",), 3)
+        page = by_id.page()
+        tweets = list(page)
+        while page.has_next():
+            page = by_id.page(page.next_cursor)
+            tweets += list(page)
+        self.assertEqual(tweets, list(Tweet.objects.order_by("-created_at", "-id")))
+
+    def test_bench_tweet_ids(self):
+        stdout = StringIO()
+        call_command("bench_tweet_ids", rows=200, batch_size=50, stdout=stdout)
+        self.assertEqual([line.split()[0] for line in stdout.getvalue().splitlines()[2:]], ["uuid4", "uuid7"])
+
+
+class TestReconcileLikeCounts(TestCase):
+    def test_fix_drifted_counts(self):
+        user = User.objects.create_user(
+            username="test", email="test@mail.com", password="test"
+        )
+        liked = Tweet.objects.create(user=user, content="いいねされた")
+        drifted = Tweet.objects.create(user=user, content="ずれた", like_count=5)
+        LikeForTweet.objects.create(user=user, tweet=liked)
+
+        call_command("reconcile_like_counts", chunk_size=1, stdout=StringIO())
+
+        liked.refresh_from_db()
+        drifted.refresh_from_db()
+        self.assertEqual(liked.like_count, 1)
+        self.assertEqual(drifted.like_count, 0)
+
+    def test_cached_card_shows_fixed_count(self):
+        cache.clear()
+        user = User.objects.create_user(
+            username="test", email="test@mail.com", password="test"
+        )
+        self.client.force_login(user)
+        tweet = Tweet.objects.create(user=user, content="ずれた")
+        count_html = '<span name="count_{}" class="count">{}</span>'
+        self.assertContains(self.client.get(reverse("tweet:home")), count_html.format(tweet.pk, 0), html=True)
+        # 件数を更新せずにいいねを入れ、キャッシュされたカードとずらす
+        LikeForTweet.objects.create(user=user, tweet=tweet)
+
+        call_command("reconcile_like_counts", stdout=StringIO())
+
+        self.assertContains(self.client.get(reverse("tweet:home")), count_html.format(tweet.pk, 1), html=True)
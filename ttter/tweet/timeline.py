@@ -0,0 +1,104 @@
+from operator import attrgetter
+
+from django.conf import settings
+
+from accounts.models import FriendShip
+from base.pagination import KeysetPaginator, MergedKeysetPaginator
+
+from . import shards
+from .models import TimelineEntry, Tweet
+
+# FriendShip は followee が「フォローする側」、follower が「フォローされる側」を指す
+# ツイートをシャードに分けている間は TimelineEntry を書かず、pull 方式で読む
+
+FANOUT_BATCH_SIZE = 500
+
+
+def fanout_threshold():
+    return getattr(settings, "TIMELINE_FANOUT_THRESHOLD", 1000)
+
+
+def is_fanout_skipped(user):
+    # フォロワーの多いアカウントは書き込み時に配らず、読み込み時にマージする
+    return user.followers_count > fanout_threshold()
+
+
+def fan_out(tweet):
+    if shards.is_sharded():
+        return
+    owner_ids = [tweet.user_id]
+    if not is_fanout_skipped(tweet.user):
+        owner_ids += FriendShip.objects.filter(follower=tweet.user_id).values_list("followee", flat=True)
+    TimelineEntry.objects.bulk_create(
+        [
+            TimelineEntry(owner_id=owner_id, tweet=tweet, author_id=tweet.user_id, created_at=tweet.created_at)
+            for owner_id in owner_ids
+        ],
+        batch_size=FANOUT_BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+
+
+def backfill(owner, author):
+    """フォローした直後のタイムラインに、相手の最近のツイートを書き込む。"""
+    if is_fanout_skipped(author) or shards.is_sharded():
+        return
+    size = getattr(settings, "TIMELINE_BACKFILL_SIZE", 100)
+    tweets = Tweet.objects.filter(user=author).order_by("-created_at", "-id").only("id", "created_at")[:size]
+    TimelineEntry.objects.bulk_create(
+        [TimelineEntry(owner=owner, tweet=tweet, author=author, created_at=tweet.created_at) for tweet in tweets],
+        batch_size=FANOUT_BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+
+
+def remove_author(owner, author):
+    TimelineEntry.objects.filter(owner=owner, author=author).delete()
+
+
+def skipped_followee_ids(user):
+    return list(
+        FriendShip.objects.filter(followee=user, follower__followers_count__gt=fanout_threshold())
+        .exclude(follower=user)
+        .values_list("follower", flat=True)
+    )
+
+
+def fanout_timeline_paginator(user, per_page):
+    entries = TimelineEntry.objects.filter(owner=user).select_related("tweet__user")
+    paginators = [KeysetPaginator(entries, ("-created_at", "-tweet_id"), per_page, transform=attrgetter("tweet"))]
+    skipped_ids = skipped_followee_ids(user)
+    if skipped_ids:
+        tweets = Tweet.objects.filter(user__in=skipped_ids).select_related("user")
+        paginators.append(KeysetPaginator(tweets, ("-created_at", "-id"), per_page))
+    return MergedKeysetPaginator(paginators, per_page)
+
+
+def pull_timeline_paginator(user, per_page):
+    """フォロー中の各ユーザーの最新ツイートを (user, created_at) インデックスで読み、heap でマージする。
+
+    読み込み量はページサイズ × フォロー数で決まり、ツイートの総数には依存しない。
+    """
+    author_ids = [user.pk]
+    author_ids += FriendShip.objects.filter(followee=user).exclude(follower=user).values_list("follower", flat=True)
+    tweets = Tweet.objects.with_user()
+    paginators = [
+        KeysetPaginator(
+            tweets.filter(user_id=author_id).using(shards.for_user(author_id)), ("-created_at", "-id"), per_page
+        )
+        for author_id in author_ids
+    ]
+    return MergedKeysetPaginator(paginators, per_page)
+
+
+ENGINES = {
+    "fanout": fanout_timeline_paginator,
+    "pull": pull_timeline_paginator,
+}
+
+
+def home_timeline_paginator(user, per_page, engine=None):
+    engine = engine or getattr(settings, "TIMELINE_ENGINE", "fanout")
+    if shards.is_sharded():
+        engine = "pull"
+    return ENGINES[engine](user, per_page)
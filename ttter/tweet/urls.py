@@ -1,13 +1,31 @@
+from django.conf import settings
 from django.urls import path
 
 from . import views
 
 app_name = "tweet"
+
+# ASGI で動かすときは、タイムラインといいねを async ビューにする
+if settings.ASYNC_VIEWS:
+    home_view = views.tweet_list_async
+    like_view = views.like_async
+    unlike_view = views.unlike_async
+else:
+    home_view = views.TweetListView.as_view()
+    like_view = views.LikeView.as_view()
+    unlike_view = views.UnlikeView.as_view()
+
 urlpatterns = [
     path("create/", views.TweetCreateView.as_view(), name="tweet_create"),
-    path("", views.TweetListView.as_view(), name="home"),
+    path("", home_view, name="home"),
+    path("following/", views.HomeTimelineView.as_view(), name="following"),
+    path("search/", views.TweetSearchView.as_view(), name="search"),
     path("detail/<uuid:pk>/", views.TweetDetailView.as_view(), name="tweet_detail"),
     path("delete/<uuid:pk>/", views.TweetDeleteViwe.as_view(), name="tweet_delete"),
-    path("like/<uuid:pk>/", views.LikeView.as_view(), name="like"),
-    path("unlike/<uuid:pk>/", views.UnlikeView.as_view(), name="unlike"),
+    path("like/<uuid:pk>/", like_view, name="like"),
+    path("unlike/<uuid:pk>/", unlike_view, name="unlike"),
+    path("like/batch/", views.LikeBatchView.as_view(), name="like_batch"),
+    path("api/timeline/", views.TimelineApiView.as_view(), name="api_timeline"),
+    path("api/users/<str:username>/tweets/", views.UserTweetsApiView.as_view(), name="api_user_tweets"),
+    path("api/tweets/<uuid:pk>/", views.TweetApiView.as_view(), name="api_tweet"),
 ]
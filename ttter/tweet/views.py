@@ -1,11 +1,29 @@
+import hashlib
+import json
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
+from django.db import transaction
 from django.http import JsonResponse
-from django.shortcuts import get_object_or_404
-from django.urls import reverse_lazy
+from django.shortcuts import render
+from django.urls import reverse, reverse_lazy
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
 from django.views.generic import CreateView, DeleteView, DetailView, ListView, View
 
+from accounts.models import user_cache
+from base.asyncviews import async_login_required, async_require_http_methods, get_cursor_page
+from base.pagination import KeysetPaginationMixin, pagination_query
+from base.routers import ReplicaReadMixin, use_replica_for
+
+from . import cards, events, search, shards, timeline
 from .forms import TweetForm
-from .models import LikeForTweet, Tweet
+from .loaders import attach_like_state, prepare_tweets
+from .models import LikeForTweet, TimelineEntry, Tweet, tweet_cache
+
+User = get_user_model()
 
 
 class TweetCreateView(LoginRequiredMixin, CreateView):
@@ -15,42 +33,115 @@ class TweetCreateView(LoginRequiredMixin, CreateView):
 
     def form_valid(self, form):
         form.instance.user = self.request.user
-        return super().form_valid(form)
+        # ツイートはシャードに、件数は default に書くので、両方のトランザクションに入れる。コミットは別々なので、
+        # その間で落ちたときのずれは recompute_user_counts で直す
+        with transaction.atomic(), transaction.atomic(using=shards.for_user(self.request.user.pk), savepoint=False):
+            response = super().form_valid(form)
+            User.objects.adjust_counts(self.request.user.pk, tweets_count=1)
+        timeline.fan_out(self.object)
+        events.publish_tweet(self.object)
+        return response
 
 
-class TweetListView(LoginRequiredMixin, ListView):
+class TweetListView(LoginRequiredMixin, ReplicaReadMixin, KeysetPaginationMixin, ListView):
     template_name = "tweet/tweet_list.html"
     model = Tweet
-    queryset = Tweet.objects.select_related("user").prefetch_related("likefortweet_set").all().order_by("-created_at")
+    queryset = Tweet.objects.timeline()
+
+    def get_keyset_paginator(self, queryset, page_size):
+        return shards.scatter_paginator(queryset, self.cursor_ordering, page_size)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        prepare_tweets(context["object_list"], self.request.user)
+        context["stream_url"] = events.stream_url(self.request, self.cursor_kwarg)
+        return context
+
+
+class HomeTimelineView(LoginRequiredMixin, ReplicaReadMixin, KeysetPaginationMixin, ListView):
+    template_name = "tweet/tweet_list.html"
+    context_object_name = "tweet_list"
+
+    def get_queryset(self):
+        return TimelineEntry.objects.filter(owner=self.request.user)
+
+    def get_keyset_paginator(self, queryset, page_size):
+        # ?engine=pull などで読み込み方式を切り替えて比較できるようにする
+        engine = self.request.GET.get("engine")
+        if engine not in timeline.ENGINES:
+            engine = None
+        return timeline.home_timeline_paginator(self.request.user, page_size, engine)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        prepare_tweets(context["object_list"], self.request.user)
+        return context
+
+
+class TweetSearchView(LoginRequiredMixin, ReplicaReadMixin, KeysetPaginationMixin, ListView):
+    template_name = "tweet/tweet_search.html"
+    context_object_name = "tweet_list"
+
+    def get_query(self):
+        return self.request.GET.get("q", "").strip()
+
+    def get_queryset(self):
+        return Tweet.objects.none()
+
+    def get_keyset_paginator(self, queryset, page_size):
+        return search.search_paginator(self.get_query(), page_size)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        user = self.request.user
-        context["liked_tweet"] = user.likefortweet_set.values_list("tweet", flat=True)
+        context["query"] = self.get_query()
+        prepare_tweets(context["object_list"], self.request.user)
         return context
 
 
-class TweetDetailView(LoginRequiredMixin, DetailView):
+def get_cached_tweet(pk):
+    """ツイートと投稿者をオブジェクトキャッシュから取得する。"""
+    tweet = tweet_cache.get_or_404(pk=pk)
+    tweet.user = user_cache.get_or_404(pk=tweet.user_id)
+    return tweet
+
+
+class TweetDetailView(LoginRequiredMixin, ReplicaReadMixin, DetailView):
     template_name = "tweet/tweet_detail.html"
     model = Tweet
 
+    def get_object(self, queryset=None):
+        tweet = get_cached_tweet(self.kwargs["pk"])
+        attach_like_state([tweet], self.request.user)
+        return tweet
+
 
 class TweetDeleteViwe(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
     model = Tweet
     template_name = "tweet/tweet_delete.html"
     success_url = reverse_lazy("tweet:home")
 
+    def get_object(self, queryset=None):
+        return tweet_cache.get_or_404(pk=self.kwargs["pk"])
+
     def test_func(self):
         self.object = self.get_object()
-        return self.object.user == self.request.user
+        return self.object.user_id == self.request.user.pk
+
+    def form_valid(self, form):
+        # ツイートはシャードから、件数は default から消すので、両方のトランザクションに入れる（TweetCreateView と同じ）
+        with transaction.atomic(), transaction.atomic(using=shards.for_tweet(self.object), savepoint=False):
+            response = super().form_valid(form)
+            User.objects.adjust_counts(self.object.user_id, tweets_count=-1)
+        cards.bump_card_version(self.object.pk)
+        return response
 
 
 class LikeView(View, LoginRequiredMixin):
     def post(self, request, *arg, **kwargs):
         user = request.user
-        tweet = get_object_or_404(Tweet, pk=kwargs["pk"])
-        LikeForTweet.objects.get_or_create(user=user, tweet=tweet)
-        likes_count = tweet.likefortweet_set.count()
+        tweet = tweet_cache.get_or_404(pk=kwargs["pk"])
+        likes_count = LikeForTweet.objects.like(user, tweet)
+        events.publish_like_count(tweet.id, likes_count)
         context = {
             "liked_count": likes_count,
             "tweet_id": tweet.id,
@@ -63,12 +154,180 @@ class LikeView(View, LoginRequiredMixin):
 class UnlikeView(LoginRequiredMixin, View):
     def post(self, request, *arg, **kwargs):
         user = request.user
-        tweet = get_object_or_404(Tweet, pk=kwargs["pk"])
-        LikeForTweet.objects.filter(user=user, tweet=tweet).delete()
-        likes_count = tweet.likefortweet_set.count()
+        tweet = tweet_cache.get_or_404(pk=kwargs["pk"])
+        likes_count = LikeForTweet.objects.unlike(user, tweet)
+        events.publish_like_count(tweet.id, likes_count)
         context = {
             "liked_count": likes_count,
             "tweet_id": tweet.id,
             "is_liked": False,
         }
         return JsonResponse(context)
+
+
+class LikeBatchView(LoginRequiredMixin, View):
+    """いいね・いいね解除をまとめて反映する。
+
+    リクエスト: {"operations": [{"tweet_id": "...", "liked": true}, ...]}
+    同じツイートへの操作が複数あれば最後のものを使う。
+    """
+
+    max_operations = 100
+
+    def post(self, request, *args, **kwargs):
+        try:
+            operations = json.loads(request.body)["operations"]
+            # "false" などの文字列をいいねとして扱わないよう、JSON の真偽値だけを受け付ける
+            if not all(isinstance(op["liked"], bool) for op in operations):
+                raise TypeError("liked must be a boolean")
+            states = {uuid.UUID(str(op["tweet_id"])): op["liked"] for op in operations}
+        except (ValueError, KeyError, TypeError):
+            return JsonResponse({"error": "不正なリクエストです。"}, status=400)
+        if len(states) > self.max_operations:
+            return JsonResponse({"error": f"一度に送れる操作は{self.max_operations}件までです。"}, status=400)
+
+        counts = LikeForTweet.objects.apply(request.user, states)
+        for tweet_id, count in counts.items():
+            events.publish_like_count(tweet_id, count)
+        return JsonResponse(
+            {
+                "tweets": [
+                    {"tweet_id": tweet_id, "liked_count": count, "is_liked": states[tweet_id]}
+                    for tweet_id, count in counts.items()
+                ]
+            }
+        )
+
+
+def serialize_tweet(tweet):
+    return {
+        "id": tweet.id,
+        "user": tweet.user.username,
+        "content": tweet.content,
+        "created_at": tweet.created_at,
+        "like_count": tweet.like_count,
+        "is_liked": tweet.is_liked,
+        "url": reverse("tweet:tweet_detail", kwargs={"pk": tweet.pk}),
+    }
+
+
+class ConditionalJsonView(LoginRequiredMixin, ReplicaReadMixin, View):
+    """ETag / Last-Modified を付けた JSON を返し、変化がなければシリアライズせずに 304 を返す。
+
+    いいね数や閲覧者のいいね状態は時刻を残さずに変わるので、304 を返すかは ETag だけで決める
+    （If-Modified-Since だけの条件付き GET には常に本文を返す）。
+    """
+
+    def get_tweets(self):
+        raise NotImplementedError
+
+    def get_data(self, tweets):
+        raise NotImplementedError
+
+    def get_etag(self, tweets):
+        # 表示内容を決める値だけからハッシュを作る（閲覧者のいいね状態も含む）
+        state = ";".join(f"{tweet.pk}:{tweet.like_count}:{int(tweet.is_liked)}" for tweet in tweets)
+        return '"%s"' % hashlib.sha1(f"{self.request.get_full_path()}|{state}".encode()).hexdigest()
+
+    def get(self, request, *args, **kwargs):
+        tweets = attach_like_state(self.get_tweets(), request.user)
+        etag = self.get_etag(tweets)
+        last_modified = max((tweet.created_at for tweet in tweets), default=None)
+        last_modified = int(last_modified.timestamp()) if last_modified else None
+
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = JsonResponse(self.get_data(tweets))
+        response.headers["ETag"] = etag
+        if last_modified is not None:
+            response.headers["Last-Modified"] = http_date(last_modified)
+        # 個人ごとの内容なので共有キャッシュさせず、毎回再検証させる
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ["Cookie"])
+        return response
+
+
+class CursorPageJsonView(KeysetPaginationMixin, ConditionalJsonView):
+    def get_tweet_queryset(self):
+        raise NotImplementedError
+
+    def get_tweets(self):
+        paginator = self.get_keyset_paginator(self.get_tweet_queryset(), self.paginate_by)
+        self.page = self.get_cursor_page(paginator)
+        return self.page.object_list
+
+    def get_data(self, tweets):
+        return {
+            "tweets": [serialize_tweet(tweet) for tweet in tweets],
+            "next_cursor": self.page.next_cursor,
+            "previous_cursor": self.page.previous_cursor,
+        }
+
+
+class TimelineApiView(CursorPageJsonView):
+    def get_tweet_queryset(self):
+        return TweetListView.queryset
+
+    def get_keyset_paginator(self, queryset, page_size):
+        return shards.scatter_paginator(queryset, self.cursor_ordering, page_size)
+
+
+class UserTweetsApiView(CursorPageJsonView):
+    def get_tweet_queryset(self):
+        user = user_cache.get_or_404(username=self.kwargs["username"])
+        return Tweet.objects.posted_by(user)
+
+
+class TweetApiView(ConditionalJsonView):
+    def get_tweets(self):
+        return [get_cached_tweet(self.kwargs["pk"])]
+
+    def get_data(self, tweets):
+        return serialize_tweet(tweets[0])
+
+
+# ASGI 用の async ビュー。settings.ASYNC_VIEWS のとき urls.py が同期ビューの代わりに割り当てる
+
+
+@async_login_required
+@async_require_http_methods(["GET", "HEAD"])
+async def tweet_list_async(request):
+    """TweetListView の async 版。シャードに分けていれば、各シャードのページを同時に読む。"""
+    use_replica_for(request)
+    view = TweetListView()
+    view.setup(request)
+    paginator = view.get_keyset_paginator(view.get_queryset(), view.paginate_by)
+    page = await get_cursor_page(paginator, request.GET.get(view.cursor_kwarg))
+    tweets = await sync_to_async(prepare_tweets)(page.object_list, request.user)
+    context = {
+        "object_list": tweets,
+        "tweet_list": tweets,
+        "page_obj": page,
+        "is_paginated": page.has_other_pages(),
+        "pagination_query": pagination_query(request, view.cursor_kwarg),
+        "stream_url": events.stream_url(request, view.cursor_kwarg),
+    }
+    # テンプレートの描画でもセッション（メッセージ）やキャッシュを読むのでスレッドで行う
+    return await sync_to_async(render)(request, view.template_name, context)
+
+
+def set_like(user, pk, liked):
+    tweet = tweet_cache.get_or_404(pk=pk)
+    if liked:
+        likes_count = LikeForTweet.objects.like(user, tweet)
+    else:
+        likes_count = LikeForTweet.objects.unlike(user, tweet)
+    events.publish_like_count(tweet.id, likes_count)
+    return {"liked_count": likes_count, "tweet_id": tweet.id, "is_liked": liked}
+
+
+@async_login_required
+@async_require_http_methods(["POST"])
+async def like_async(request, pk):
+    return JsonResponse(await sync_to_async(set_like)(request.user, pk, True))
+
+
+@async_login_required
+@async_require_http_methods(["POST"])
+async def unlike_async(request, pk):
+    return JsonResponse(await sync_to_async(set_like)(request.user, pk, False))